@@ -0,0 +1,177 @@
+import hashlib
+import marshal
+import os
+import struct
+from array import array
+from chunk import *
+from value import *
+from object import *
+from compiler import *
+from ircompiler import *
+
+class BytecodeCache:
+	"""Stores compiled scripts in a .loxc file next to the source file
+
+	The file starts with a header holding a magic number, the format
+	version and a SHA-256 hash of the source code and the compiler
+	options that change the generated bytecode. The header is followed
+	by the names of the global variable slots and the top-level
+	ObjFunction, with its chunk, constants and nested functions converted
+	to tuples, lists and strings that marshal can write. The cached
+	function is only used if the header matches.
+	"""
+
+	MAGIC = b"LOXC"
+	# Increment whenever the layout of the serialized functions or the
+	# bytecode that the compiler generates changes.
+	FORMAT_VERSION = 10
+	HEADER = struct.Struct(">4sH32s")
+
+	# Tags for the types of constants
+	CONSTANT_NIL = 0
+	CONSTANT_BOOL = 1
+	CONSTANT_NUMBER = 2
+	CONSTANT_STRING = 3
+	CONSTANT_FUNCTION = 4
+
+	def cachePath(self, path):
+		"""Return name of cache file for a source file"""
+		return os.path.splitext(path)[0] + ".loxc"
+
+	def sourceHash(self, source):
+		h = hashlib.sha256(source.encode("utf-8"))
+		h.update(bytes([Compiler.OPTIMIZE, Compiler.SUPERINSTRUCTIONS, Compiler.TAIL_CALLS,
+			Compiler.USE_IR]))
+		return h.digest()
+
+	def compile(self, path, source, globals, rebuild=False):
+		"""Return compiled script function, from cache file if it is valid
+
+		Global variable slots are allocated in globals. Returns None if
+		the source has a compile error.
+		"""
+		cachePath = self.cachePath(path)
+		digest = self.sourceHash(source)
+		if not rebuild:
+			function = self.load(cachePath, digest, globals)
+			if function != None:
+				return function
+
+		if Compiler.USE_IR == 1:
+			c = IRCompiler(None, FunctionType.TYPE_SCRIPT, globals)
+		else:
+			c = Compiler(None, FunctionType.TYPE_SCRIPT, globals)
+		function = c.compile(source)
+		if function != None:
+			self.save(cachePath, digest, function, globals)
+		return function
+
+	def load(self, cachePath, digest, globals):
+		"""Read function from cache file, or None if missing or out of date"""
+		try:
+			with open(cachePath, "rb") as f:
+				data = f.read()
+		except OSError:
+			return None
+
+		if len(data) < self.HEADER.size:
+			return None
+		magic, version, fileDigest = self.HEADER.unpack_from(data)
+		if magic != self.MAGIC or version != self.FORMAT_VERSION or fileDigest != digest:
+			return None
+		try:
+			globalNames, function = marshal.loads(data[self.HEADER.size:])
+			# Slot numbers in the cached code are for the global variables
+			# at the time it was compiled, these are moved to the slots
+			# used by globals.
+			self.globalSlots = [globals.slot(name) for name in globalNames]
+			self.globalNames = globals.names
+			return self.readFunction(function)
+		except (EOFError, ValueError, TypeError, IndexError):
+			return None
+
+	def save(self, cachePath, digest, function, globals):
+		"""Write function to cache file, ignoring any error writing it"""
+		data = self.HEADER.pack(self.MAGIC, self.FORMAT_VERSION, digest)
+		data += marshal.dumps((globals.names, self.writeFunction(function)))
+		tmpPath = "{0}.{1}.tmp".format(cachePath, os.getpid())
+		try:
+			with open(tmpPath, "wb") as f:
+				f.write(data)
+			os.replace(tmpPath, cachePath)
+		except OSError:
+			try:
+				os.remove(tmpPath)
+			except OSError:
+				pass
+
+	def writeFunction(self, function):
+		if function.getName() != None:
+			name = function.getName().AS_STRING()
+		else:
+			name = None
+		upvalues = [(u.isLocal, u.index) for u in function.upvalues]
+		chunk = function.chunk
+		code = bytes(chunk.code)
+		constants = []
+		i = 0
+		while i < chunk.constants.len():
+			constants.append(self.writeConstant(chunk.constants[i]))
+			i += 1
+		return (name, function.arity, function.maxStack, upvalues, code, list(chunk.lines), constants)
+
+	def writeConstant(self, value):
+		if value.IS_BOOL():
+			return (self.CONSTANT_BOOL, value.AS_BOOL())
+		if value.IS_NUMBER():
+			return (self.CONSTANT_NUMBER, float(value.AS_NUMBER()))
+		if value.IS_OBJ():
+			obj = value.AS_OBJ()
+			if obj.OBJ_TYPE() == ObjType.OBJ_STRING:
+				return (self.CONSTANT_STRING, obj.AS_STRING())
+			return (self.CONSTANT_FUNCTION, self.writeFunction(obj))
+		return (self.CONSTANT_NIL, None)
+
+	def readFunction(self, data):
+		name, arity, maxStack, upvalues, code, lines, constants = data
+		if name != None:
+			function = ObjFunction(copyString(name))
+		else:
+			function = ObjFunction(None)
+		function.arity = arity
+		function.maxStack = maxStack
+		for isLocal, index in upvalues:
+			u = Upvalue()
+			u.isLocal = isLocal
+			u.index = index
+			function.upvalues.append(u)
+		chunk = function.chunk
+		chunk.code = bytearray(code)
+		chunk.lines = array('i', lines)
+		code = chunk.code
+		chunk.globalNames = self.globalNames
+		for constant in constants:
+			# Not addConstant(), the indexes must stay the same.
+			chunk.constants.writeValueArray(self.readConstant(constant))
+
+		offset = 0
+		while offset < len(code):
+			if code[offset] in (OpCode.OP_GET_GLOBAL, OpCode.OP_DEFINE_GLOBAL,
+				OpCode.OP_SET_GLOBAL, OpCode.OP_CALL_GLOBAL):
+				slot = self.globalSlots[(code[offset + 1] << 8) | code[offset + 2]]
+				code[offset + 1] = (slot >> 8) & 0xff
+				code[offset + 2] = slot & 0xff
+			offset += chunk.instructionSize(offset)
+		return function
+
+	def readConstant(self, data):
+		tag, value = data
+		if tag == self.CONSTANT_BOOL:
+			return Value.BOOL_VAL(value)
+		if tag == self.CONSTANT_NUMBER:
+			return Value.NUMBER_VAL(value)
+		if tag == self.CONSTANT_STRING:
+			return Value.OBJ_VAL(copyString(value))
+		if tag == self.CONSTANT_FUNCTION:
+			return Value.OBJ_VAL(self.readFunction(value))
+		return Value.NIL_VAL()
@@ -1,4 +1,5 @@
 from enum import IntEnum
+from array import array
 from valuearray import *
 from value import *
 
@@ -41,32 +42,275 @@ class OpCode(IntEnum):
 	OP_CLASS = 35
 	OP_INHERIT = 36
 	OP_METHOD = 37
+	OP_CONSTANT_LONG = 38
+	OP_GET_PROPERTY_LONG = 39
+	OP_SET_PROPERTY_LONG = 40
+	OP_GET_SUPER_LONG = 41
+	OP_INVOKE_LONG = 42
+	OP_SUPER_INVOKE_LONG = 43
+	OP_CLOSURE_LONG = 44
+	OP_CLASS_LONG = 45
+	OP_METHOD_LONG = 46
+	OP_ADD_LOCAL_LOCAL = 47
+	OP_ADD_LOCAL_CONSTANT = 48
+	OP_SUBTRACT_LOCAL_CONSTANT = 49
+	OP_SET_LOCAL_POP = 50
+	OP_CALL_GLOBAL = 51
+	OP_NOT_EQUAL = 52
+	OP_GREATER_EQUAL = 53
+	OP_LESS_EQUAL = 54
+	OP_JUMP_IF_NOT_EQUAL = 55
+	OP_JUMP_IF_EQUAL = 56
+	OP_JUMP_IF_NOT_GREATER = 57
+	OP_JUMP_IF_NOT_GREATER_EQUAL = 58
+	OP_JUMP_IF_NOT_LESS = 59
+	OP_JUMP_IF_NOT_LESS_EQUAL = 60
+	OP_TAIL_CALL = 61
 
 
 class Chunk:
-	"""A chunk of bytecode that was compiled and is executed by VM"""
+	"""A chunk of bytecode that was compiled and is executed by VM
+
+	code is a bytearray of opcodes and operands. lines holds the source
+	line of each byte, run-length encoded as pairs of a line and the
+	number of bytes in a row on it, and is read with getLine().
+	"""
+
+	# Variants of the instructions with an index into constants as operand
+	# that take a 16-bit index instead of a single byte, used when a
+	# chunk has more than 256 constants.
+	LONG_OPCODES = {
+		OpCode.OP_CONSTANT: OpCode.OP_CONSTANT_LONG,
+		OpCode.OP_GET_PROPERTY: OpCode.OP_GET_PROPERTY_LONG,
+		OpCode.OP_SET_PROPERTY: OpCode.OP_SET_PROPERTY_LONG,
+		OpCode.OP_GET_SUPER: OpCode.OP_GET_SUPER_LONG,
+		OpCode.OP_INVOKE: OpCode.OP_INVOKE_LONG,
+		OpCode.OP_SUPER_INVOKE: OpCode.OP_SUPER_INVOKE_LONG,
+		OpCode.OP_CLOSURE: OpCode.OP_CLOSURE_LONG,
+		OpCode.OP_CLASS: OpCode.OP_CLASS_LONG,
+		OpCode.OP_METHOD: OpCode.OP_METHOD_LONG,
+	}
+	SHORT_OPCODES = {long: short for short, long in LONG_OPCODES.items()}
+
+	# Jumps that pop and compare the top two values on the stack, each
+	# is a comparison followed by OP_JUMP_IF_FALSE and OP_POP.
+	COMPARE_JUMPS = {
+		OpCode.OP_EQUAL: OpCode.OP_JUMP_IF_NOT_EQUAL,
+		OpCode.OP_NOT_EQUAL: OpCode.OP_JUMP_IF_EQUAL,
+		OpCode.OP_GREATER: OpCode.OP_JUMP_IF_NOT_GREATER,
+		OpCode.OP_GREATER_EQUAL: OpCode.OP_JUMP_IF_NOT_GREATER_EQUAL,
+		OpCode.OP_LESS: OpCode.OP_JUMP_IF_NOT_LESS,
+		OpCode.OP_LESS_EQUAL: OpCode.OP_JUMP_IF_NOT_LESS_EQUAL,
+	}
 
 	def __init__(self):
-		self.code = []
-		self.lines = []
+		self.code = bytearray()
+		self.lines = array('i')
 		self.constants = ValueArray()
+		# Index in constants of each key passed to addConstant()
+		self.constantIndexes = {}
+		# Key passed to addConstant() for each constant, for removeConstants()
+		self.constantKeys = []
+		# Names of global variable slots, for disassembly
+		self.globalNames = []
 
 	def writeChunk(self, b, line):
 		"""Add a single byte to chunk"""
 		self.code.append(b)
-		self.lines.append(line)
+		lines = self.lines
+		if len(lines) > 0 and lines[-2] == line:
+			lines[-1] += 1
+		else:
+			lines.append(line)
+			lines.append(1)
+
+	def removeCode(self, start):
+		"""Remove the bytes from offset start onwards"""
+		count = len(self.code) - start
+		del self.code[start:]
+		lines = self.lines
+		while count > 0:
+			if lines[-1] > count:
+				lines[-1] -= count
+				break
+			count -= lines[-1]
+			del lines[-2:]
+
+	def getLine(self, offset):
+		"""Return source line of the byte at offset"""
+		lines = self.lines
+		i = 0
+		while i < len(lines):
+			offset -= lines[i + 1]
+			if offset < 0:
+				return lines[i]
+			i += 2
+		raise IndexError("offset out of range")
+
+	def getLines(self):
+		"""Return list of the source line of each byte"""
+		result = []
+		i = 0
+		while i < len(self.lines):
+			result.extend([self.lines[i]] * self.lines[i + 1])
+			i += 2
+		return result
+
+	def setLines(self, lines):
+		"""Replace source lines with lines, a list with one for each byte"""
+		del self.lines[:]
+		for line in lines:
+			if len(self.lines) > 0 and self.lines[-2] == line:
+				self.lines[-1] += 1
+			else:
+				self.lines.append(line)
+				self.lines.append(1)
 
 	def freeChunk(self):
 		"""Throw away memory used by chunk"""
-		self.code.clear()
-		self.lines.clear()
+		del self.code[:]
+		del self.lines[:]
 		self.constants.clear()
+		self.constantIndexes.clear()
 
-	def addConstant(self, value):
-		"""Add a constant value to the chunk"""
+	def addConstant(self, value, key=None):
+		"""Add a constant value to the chunk, returns its index
+
+		If key is given and a constant was already added with the same
+		key, the index of the existing constant is returned instead.
+		"""
+		if key != None and key in self.constantIndexes:
+			return self.constantIndexes[key]
 		self.constants.writeValueArray(value)
-		return self.constants.len() - 1
-		
+		index = self.constants.len() - 1
+		self.constantKeys.append(key)
+		if key != None:
+			self.constantIndexes[key] = index
+		return index
+
+	def removeConstants(self, count):
+		"""Remove the constants added after the first count"""
+		while len(self.constantKeys) > count:
+			key = self.constantKeys.pop()
+			if key != None:
+				del self.constantIndexes[key]
+		self.constants.truncate(count)
+
+	def constantIndex(self, offset):
+		"""Return operand of instruction at offset that is an index into constants"""
+		if self.code[offset] in self.SHORT_OPCODES:
+			return (self.code[offset + 1] << 8) | self.code[offset + 2]
+		return self.code[offset + 1]
+
+	def instructionSize(self, offset):
+		"""Return number of bytes of instruction at offset, including operands"""
+		op = self.code[offset]
+		if op in (OpCode.OP_CONSTANT, OpCode.OP_GET_LOCAL, OpCode.OP_SET_LOCAL,
+			OpCode.OP_GET_UPVALUE, OpCode.OP_SET_UPVALUE, OpCode.OP_GET_PROPERTY,
+			OpCode.OP_SET_PROPERTY, OpCode.OP_GET_SUPER, OpCode.OP_CALL,
+			OpCode.OP_CLASS, OpCode.OP_METHOD, OpCode.OP_SET_LOCAL_POP, OpCode.OP_TAIL_CALL):
+			return 2
+		if op in (OpCode.OP_GET_GLOBAL, OpCode.OP_DEFINE_GLOBAL, OpCode.OP_SET_GLOBAL,
+			OpCode.OP_JUMP, OpCode.OP_JUMP_IF_FALSE, OpCode.OP_LOOP,
+			OpCode.OP_INVOKE, OpCode.OP_SUPER_INVOKE, OpCode.OP_CONSTANT_LONG,
+			OpCode.OP_GET_PROPERTY_LONG, OpCode.OP_SET_PROPERTY_LONG,
+			OpCode.OP_GET_SUPER_LONG, OpCode.OP_CLASS_LONG, OpCode.OP_METHOD_LONG,
+			OpCode.OP_ADD_LOCAL_LOCAL, OpCode.OP_ADD_LOCAL_CONSTANT,
+			OpCode.OP_SUBTRACT_LOCAL_CONSTANT) or op in self.COMPARE_JUMPS.values():
+			return 3
+		if op in (OpCode.OP_INVOKE_LONG, OpCode.OP_SUPER_INVOKE_LONG, OpCode.OP_CALL_GLOBAL):
+			return 4
+		if op in (OpCode.OP_CLOSURE, OpCode.OP_CLOSURE_LONG):
+			function = self.constants[self.constantIndex(offset)].AS_OBJ()
+			if op == OpCode.OP_CLOSURE_LONG:
+				return 3 + 2 * len(function.upvalues)
+			return 2 + 2 * len(function.upvalues)
+		return 1
+
+	def jumpTarget(self, offset):
+		"""Return offset that the jump at offset goes to, or None if not a jump"""
+		op = self.code[offset]
+		if op == OpCode.OP_LOOP:
+			jump = (self.code[offset + 1] << 8) | self.code[offset + 2]
+			return offset + 3 - jump
+		if op in (OpCode.OP_JUMP, OpCode.OP_JUMP_IF_FALSE) or op in self.COMPARE_JUMPS.values():
+			jump = (self.code[offset + 1] << 8) | self.code[offset + 2]
+			return offset + 3 + jump
+		return None
+
+	def stackEffect(self, offset):
+		"""Return change in number of values on the stack from instruction at offset"""
+		op = self.code[offset]
+		if op in (OpCode.OP_CALL, OpCode.OP_TAIL_CALL):
+			# The function and arguments are replaced by the result.
+			return -self.code[offset + 1]
+		if op == OpCode.OP_CALL_GLOBAL:
+			return 1 - self.code[offset + 3]
+		if op in (OpCode.OP_INVOKE, OpCode.OP_INVOKE_LONG):
+			return -self.code[offset + self.instructionSize(offset) - 1]
+		if op in (OpCode.OP_SUPER_INVOKE, OpCode.OP_SUPER_INVOKE_LONG):
+			return -self.code[offset + self.instructionSize(offset) - 1] - 1
+		if op in self.COMPARE_JUMPS.values():
+			return -2
+		if op in (OpCode.OP_CONSTANT, OpCode.OP_CONSTANT_LONG, OpCode.OP_NIL, OpCode.OP_TRUE,
+			OpCode.OP_FALSE, OpCode.OP_GET_LOCAL, OpCode.OP_GET_GLOBAL, OpCode.OP_GET_UPVALUE,
+			OpCode.OP_CLOSURE, OpCode.OP_CLOSURE_LONG, OpCode.OP_CLASS, OpCode.OP_CLASS_LONG,
+			OpCode.OP_ADD_LOCAL_LOCAL, OpCode.OP_ADD_LOCAL_CONSTANT,
+			OpCode.OP_SUBTRACT_LOCAL_CONSTANT):
+			return 1
+		if op in (OpCode.OP_SET_LOCAL, OpCode.OP_SET_GLOBAL, OpCode.OP_SET_UPVALUE,
+			OpCode.OP_GET_PROPERTY, OpCode.OP_GET_PROPERTY_LONG, OpCode.OP_NOT, OpCode.OP_NEGATE,
+			OpCode.OP_JUMP, OpCode.OP_JUMP_IF_FALSE, OpCode.OP_LOOP):
+			return 0
+		# Everything else takes one value: OP_POP, binary operators,
+		# OP_PRINT, OP_RETURN, OP_SET_PROPERTY, OP_GET_SUPER, ...
+		return -1
+
+	def liveDepths(self, depth):
+		"""Return the stack depth at the start of each instruction that can run
+
+		depth is the number of values on the stack when the chunk starts.
+		Instructions only reached from code after OP_RETURN, OP_JUMP or
+		OP_LOOP, like a statement after a return, are left out, so the
+		offsets in the result are the code that can run.
+		"""
+		depths = {}
+		pending = [(0, depth)]
+		while len(pending) > 0:
+			offset, depth = pending.pop()
+			while offset < len(self.code) and offset not in depths:
+				depths[offset] = depth
+				depth += self.stackEffect(offset)
+				target = self.jumpTarget(offset)
+				if target != None:
+					pending.append((target, depth))
+				if self.code[offset] in (OpCode.OP_RETURN, OpCode.OP_JUMP, OpCode.OP_LOOP):
+					break
+				offset += self.instructionSize(offset)
+		return depths
+
+	def maxStackDepth(self, depth):
+		"""Return the most values on the stack while running the chunk
+
+		depth is the number of values on the stack when it starts, the
+		function and its arguments.
+		"""
+		maxDepth = depth
+		for offset, depth in self.liveDepths(depth).items():
+			op = self.code[offset]
+			if op == OpCode.OP_CALL_GLOBAL:
+				# The function is put below the arguments before the call.
+				depth += 1
+			elif op in (OpCode.OP_ADD_LOCAL_LOCAL, OpCode.OP_ADD_LOCAL_CONSTANT,
+				OpCode.OP_SUBTRACT_LOCAL_CONSTANT):
+				# The switch engine pushes both operands before adding.
+				depth += 2
+			else:
+				depth += self.stackEffect(offset)
+			if depth > maxDepth:
+				maxDepth = depth
+		return maxDepth
+
 	def disassembleChunk(self, name):
 		"""Print human readable representation of chunk"""
 		print("===", name, "===")
@@ -76,10 +320,11 @@ class Chunk:
 
 	def disassembleInstruction(self, offset):
 		print('{0:04d} '.format(offset), end='')
-		if offset > 0 and self.lines[offset] == self.lines[offset - 1]:
+		line = self.getLine(offset)
+		if offset > 0 and line == self.getLine(offset - 1):
 			print('   | ', end='')
 		else:
-			print('{0:4d} '.format(self.lines[offset]), end='')
+			print('{0:4d} '.format(line), end='')
 		op = self.code[offset]
 		if op == OpCode.OP_CONSTANT:
 			return self.constantInstruction("OP_CONSTANT", offset)
@@ -103,13 +348,13 @@ class Chunk:
 			return self.byteInstruction("OP_SET_LOCAL", offset)
 
 		if op == OpCode.OP_GET_GLOBAL:
-			return self.constantInstruction("OP_GET_GLOBAL", offset)
+			return self.globalInstruction("OP_GET_GLOBAL", offset)
 
 		if op == OpCode.OP_DEFINE_GLOBAL:
-			return self.constantInstruction("OP_DEFINE_GLOBAL", offset)
+			return self.globalInstruction("OP_DEFINE_GLOBAL", offset)
 
 		if op == OpCode.OP_SET_GLOBAL:
-			return self.constantInstruction("OP_SET_GLOBAL", offset)
+			return self.globalInstruction("OP_SET_GLOBAL", offset)
 
 		if op == OpCode.OP_GET_UPVALUE:
 			return self.byteInstruction("OP_GET_UPVALUE", offset)
@@ -168,6 +413,9 @@ class Chunk:
 		if op == OpCode.OP_CALL:
 			return self.byteInstruction("OP_CALL", offset)
 
+		if op == OpCode.OP_TAIL_CALL:
+			return self.byteInstruction("OP_TAIL_CALL", offset)
+
 		if op == OpCode.OP_INVOKE:
 			return self.invokeInstruction("OP_INVOKE", offset)
 
@@ -175,26 +423,7 @@ class Chunk:
 			return self.invokeInstruction("OP_SUPER_INVOKE", offset)
 
 		if op == OpCode.OP_CLOSURE:
-			offset += 1
-			constant = self.code[offset]
-			offset += 1
-			print("{0:<16} {1:4d} '".format("OP_CLOSURE", constant), end='')
-			self.printValue(self.constants[constant])
-			print("'")
-			function = self.constants[constant].AS_OBJ()
-			j = 0
-			while j < len(function.upvalues):
-				isLocal = self.code[offset]
-				if isLocal == 1:
-					type = "local"
-				else:
-					type = "upvalue"
-				offset += 1
-				index = self.code[offset]
-				offset += 1
-				print("{0:04d}    | {1:>27} {2:d} '".format(offset - 2, type, index))
-				j += 1
-			return offset
+			return self.closureInstruction("OP_CLOSURE", offset)
 
 		if op == OpCode.OP_CLOSE_UPVALUE:
 			return self.simpleInstruction("OP_CLOSE_UPVALUE", offset)
@@ -211,23 +440,122 @@ class Chunk:
 		if op == OpCode.OP_METHOD:
 			return self.constantInstruction("OP_METHOD", offset)
 
+		if op == OpCode.OP_CONSTANT_LONG:
+			return self.constantInstruction("OP_CONSTANT_LONG", offset)
+
+		if op == OpCode.OP_GET_PROPERTY_LONG:
+			return self.constantInstruction("OP_GET_PROPERTY_LONG", offset)
+
+		if op == OpCode.OP_SET_PROPERTY_LONG:
+			return self.constantInstruction("OP_SET_PROPERTY_LONG", offset)
+
+		if op == OpCode.OP_GET_SUPER_LONG:
+			return self.constantInstruction("OP_GET_SUPER_LONG", offset)
+
+		if op == OpCode.OP_INVOKE_LONG:
+			return self.invokeInstruction("OP_INVOKE_LONG", offset)
+
+		if op == OpCode.OP_SUPER_INVOKE_LONG:
+			return self.invokeInstruction("OP_SUPER_INVOKE_LONG", offset)
+
+		if op == OpCode.OP_CLOSURE_LONG:
+			return self.closureInstruction("OP_CLOSURE_LONG", offset)
+
+		if op == OpCode.OP_CLASS_LONG:
+			return self.constantInstruction("OP_CLASS_LONG", offset)
+
+		if op == OpCode.OP_METHOD_LONG:
+			return self.constantInstruction("OP_METHOD_LONG", offset)
+
+		if op == OpCode.OP_NOT_EQUAL:
+			return self.simpleInstruction("OP_NOT_EQUAL", offset)
+
+		if op == OpCode.OP_GREATER_EQUAL:
+			return self.simpleInstruction("OP_GREATER_EQUAL", offset)
+
+		if op == OpCode.OP_LESS_EQUAL:
+			return self.simpleInstruction("OP_LESS_EQUAL", offset)
+
+		if op in self.COMPARE_JUMPS.values():
+			return self.jumpInstruction(OpCode(op).name, 1, offset)
+
+		if op == OpCode.OP_ADD_LOCAL_LOCAL:
+			slot1 = self.code[offset + 1]
+			slot2 = self.code[offset + 2]
+			print('{0:<16} {1:4d} {2:4d}'.format("OP_ADD_LOCAL_LOCAL", slot1, slot2))
+			return offset + 3
+
+		if op == OpCode.OP_ADD_LOCAL_CONSTANT:
+			return self.localConstantInstruction("OP_ADD_LOCAL_CONSTANT", offset)
+
+		if op == OpCode.OP_SUBTRACT_LOCAL_CONSTANT:
+			return self.localConstantInstruction("OP_SUBTRACT_LOCAL_CONSTANT", offset)
+
+		if op == OpCode.OP_SET_LOCAL_POP:
+			return self.byteInstruction("OP_SET_LOCAL_POP", offset)
+
+		if op == OpCode.OP_CALL_GLOBAL:
+			slot = (self.code[offset + 1] << 8) | self.code[offset + 2]
+			argCount = self.code[offset + 3]
+			print("{0:<16} ({1:d} args) {2:4d} '".format("OP_CALL_GLOBAL", argCount, slot), end='')
+			if slot < len(self.globalNames):
+				print(self.globalNames[slot], end='')
+			print("'")
+			return offset + 4
+
 		print("Unknown opcode {0}".format(self.code[offset]))
 		return offset + 1
 
 	def constantInstruction(self, name, offset):
-		constant = self.code[offset + 1]
+		constant = self.constantIndex(offset)
 		print("{0:<16} {1:4d} '".format(name, constant), end='')
 		self.printValue(self.constants[constant])
 		print("'")
-		return offset + 2
+		return offset + self.instructionSize(offset)
+
+	def localConstantInstruction(self, name, offset):
+		slot = self.code[offset + 1]
+		constant = self.code[offset + 2]
+		print("{0:<16} {1:4d} {2:4d} '".format(name, slot, constant), end='')
+		self.printValue(self.constants[constant])
+		print("'")
+		return offset + 3
+
+	def globalInstruction(self, name, offset):
+		slot = (self.code[offset + 1] << 8) | self.code[offset + 2]
+		print("{0:<16} {1:4d} '".format(name, slot), end='')
+		if slot < len(self.globalNames):
+			print(self.globalNames[slot], end='')
+		print("'")
+		return offset + 3
 
 	def invokeInstruction(self, name, offset):
-		constant = self.code[offset + 1]
-		argCount = self.code[offset + 2]
+		constant = self.constantIndex(offset)
+		next = offset + self.instructionSize(offset)
+		argCount = self.code[next - 1]
 		print("{0:<16} ({1:d} args) {2:4d} '".format(name, argCount, constant), end='')
 		self.printValue(self.constants[constant])
 		print("'")
-		return offset + 3
+		return next
+
+	def closureInstruction(self, name, offset):
+		constant = self.constantIndex(offset)
+		next = offset + self.instructionSize(offset)
+		print("{0:<16} {1:4d} '".format(name, constant), end='')
+		self.printValue(self.constants[constant])
+		print("'")
+		offset = next - 2 * len(self.constants[constant].AS_OBJ().upvalues)
+		while offset < next:
+			isLocal = self.code[offset]
+			if isLocal == 1:
+				type = "local"
+			else:
+				type = "upvalue"
+			offset += 1
+			index = self.code[offset]
+			offset += 1
+			print("{0:04d}    | {1:>27} {2:d} '".format(offset - 2, type, index))
+		return offset
 
 	def printValue(self, value):
 		if value.IS_BOOL():
@@ -0,0 +1,933 @@
+import operator
+import sys
+from chunk import *
+from object import *
+from table import *
+
+class LoxRuntimeError(Exception):
+	"""Raised by the closures from ClosureCompiler for a runtime error"""
+	def __init__(self, message):
+		self.message = message
+		# Closure and ip of each call frame, innermost first
+		self.frames = []
+
+def runtimeError(regs, ip, message):
+	"""Raise LoxRuntimeError for the instruction before ip of the running function"""
+	e = LoxRuntimeError(message)
+	e.frames.append((regs[-1], ip))
+	raise e
+
+def lookupMethod(regs, ip, cache, key, klass, name):
+	method = klass.findMethod(name)
+	if method == None:
+		runtimeError(regs, ip, "Undefined property '{0}'.".format(name.AS_STRING()))
+	cache[0] = key
+	cache[1] = -1
+	cache[2] = klass.version
+	cache[3] = method
+	return method
+
+def greaterEqual(a, b):
+	return not (a < b)
+
+def lessEqual(a, b):
+	return not (a > b)
+
+def valuesEqual(a, b):
+	return type(a) is type(b) and a == b
+
+def valuesNotEqual(a, b):
+	return type(a) is not type(b) or a != b
+
+class TailCall:
+	"""Returned by the closure of OP_TAIL_CALL for callClosure() to call"""
+	def __init__(self, closure, receiver, args):
+		self.closure = closure
+		self.receiver = receiver
+		self.args = args
+
+class ClosureCode:
+	"""Python closures compiled from the bytecode of a function"""
+	def __init__(self, run, frameSize):
+		# run(regs) runs the function and returns its result
+		self.run = run
+		# Number of local variable slots, the closure is after them
+		self.frameSize = frameSize
+
+class ClosureCompiler:
+	"""Compiles the bytecode of functions to trees of Python closures
+
+	Each expression becomes a closure that calls the closures of its
+	operands and returns its value, and each statement a closure that
+	runs it. They take the list of local variable slots of the call, and
+	the ObjClosure being run is in the last entry of the list. Statements
+	between jumps are grouped into blocks, which return the index of the
+	block to run next, or -1 after storing the result of the function in
+	slot zero.
+
+	The tree is rebuilt from the stack bytecode by simulating the stack:
+	pushing a constant or local variable and each instruction that takes
+	values off the stack build up an expression, which is only stored in
+	its slot when it has to be. To keep the order in which the
+	expressions have side effects, every expression still on the
+	simulated stack is stored in its slot before a statement or
+	assignment, call or other instruction with side effects.
+
+	Calls to Lox functions go straight from the closure of the call
+	expression to the function, without a CallFrame. A runtime error is
+	raised as LoxRuntimeError, which collects the function and ip of each
+	call as it goes back up.
+	"""
+
+	# Entries in the simulated stack
+	REGISTER = 0
+	CONSTANT = 1
+	EXPRESSION = 2
+
+	NUMBER_OPERATORS = {
+		OpCode.OP_GREATER: operator.gt,
+		OpCode.OP_GREATER_EQUAL: greaterEqual,
+		OpCode.OP_LESS: operator.lt,
+		OpCode.OP_LESS_EQUAL: lessEqual,
+		OpCode.OP_SUBTRACT: operator.sub,
+		OpCode.OP_MULTIPLY: operator.mul,
+		OpCode.OP_DIVIDE: operator.truediv,
+	}
+	# Test for each compare-and-jump instruction that is true when it
+	# does not jump, and whether the operands must be numbers
+	COMPARE_JUMPS = {
+		OpCode.OP_JUMP_IF_NOT_EQUAL: (valuesEqual, False),
+		OpCode.OP_JUMP_IF_EQUAL: (valuesNotEqual, False),
+		OpCode.OP_JUMP_IF_NOT_GREATER: (operator.gt, True),
+		OpCode.OP_JUMP_IF_NOT_GREATER_EQUAL: (greaterEqual, True),
+		OpCode.OP_JUMP_IF_NOT_LESS: (operator.lt, True),
+		OpCode.OP_JUMP_IF_NOT_LESS_EQUAL: (lessEqual, True),
+	}
+
+	def __init__(self, vm):
+		self.vm = vm
+		self.globalValues = vm.globals.values
+		self.globalNames = vm.globals.names
+		# Number of active calls, counting the script
+		self.depth = 0
+
+	def run(self, closure):
+		"""Run the closure of the top-level code of a script"""
+		# Left-nested expressions like a + b + c + ... call the closure of
+		# each operand from the one before.
+		if sys.getrecursionlimit() < 10000:
+			sys.setrecursionlimit(10000)
+		function = closure.AS_CLOSURE()
+		code = function.closureCode
+		if code == None:
+			code = self.compileFunction(function)
+		regs = [closure] + [None] * (code.frameSize - 1) + [closure]
+		self.depth = 1
+		code.run(regs)
+
+	def callClosure(self, closure, receiver, args):
+		"""Call closure with receiver in slot zero and return its result
+
+		A TailCall returned by the function is called in its place, at the
+		same depth.
+		"""
+		function = closure.AS_CLOSURE()
+		if len(args) != function.arity:
+			raise LoxRuntimeError("Expected {0} arguments but got {1}.".format(function.arity, len(args)))
+		if self.depth == 64:
+			raise LoxRuntimeError("Stack overflow.")
+		self.depth += 1
+		while True:
+			code = function.closureCode
+			if code == None:
+				code = self.compileFunction(function)
+			regs = [receiver]
+			regs += args
+			if code.frameSize > len(regs):
+				regs += [None] * (code.frameSize - len(regs))
+			regs.append(closure)
+			result = code.run(regs)
+			if type(result) is not TailCall:
+				break
+			closure = result.closure
+			receiver = result.receiver
+			args = result.args
+			function = closure.AS_CLOSURE()
+		self.depth -= 1
+		return result
+
+	def callValue(self, callee, args):
+		"""Call any callable value and return its result"""
+		if type(callee) is ObjClosure:
+			return self.callClosure(callee, callee, args)
+		if type(callee) is ObjBoundMethod:
+			return self.callClosure(callee.method, callee.receiver, args)
+		if type(callee) is ObjClass:
+			instance = ObjInstance(callee)
+			initializer = callee.initializer
+			if initializer != None:
+				return self.callClosure(initializer, instance, args)
+			if len(args) != 0:
+				raise LoxRuntimeError("Expected 0 arguments but got {0}.".format(len(args)))
+			return instance
+		if type(callee) is ObjNative:
+			return callee.AS_NATIVE()(len(args), args)
+		raise LoxRuntimeError("Can only call functions and classes.")
+
+	def compileFunction(self, function):
+		"""Compile bytecode of function to ClosureCode"""
+		chunk = function.chunk
+		code = chunk.code
+		constants = chunk.constants.rawValues()
+
+		# A block starts at each jump target and after each jump or return.
+		starts = set([0])
+		# Whether closures may capture the slots of calls
+		self.capturesLocals = False
+		offset = 0
+		while offset < len(code):
+			op = code[offset]
+			size = chunk.instructionSize(offset)
+			if op in (OpCode.OP_CLOSURE, OpCode.OP_CLOSURE_LONG):
+				self.capturesLocals = True
+			target = chunk.jumpTarget(offset)
+			if target != None:
+				starts.add(target)
+			if target != None or op == OpCode.OP_RETURN:
+				starts.add(offset + size)
+			offset += size
+		starts.discard(len(code))
+		self.blockIndex = {}
+		for start in sorted(starts):
+			self.blockIndex[start] = len(self.blockIndex)
+		blocks = [None] * len(starts)
+
+		self.stack = [(self.REGISTER, slot) for slot in range(function.arity + 1)]
+		self.frameSize = len(self.stack)
+		self.statements = []
+		# Stack depth at each instruction that can run
+		depths = chunk.liveDepths(len(self.stack))
+		block = 0
+		ended = False
+		offset = 0
+		while offset < len(code):
+			op = code[offset]
+			size = chunk.instructionSize(offset)
+			self.ip = offset + size
+			if offset not in depths:
+				# Never runs, like code after a return, so its block is
+				# left out.
+				ended = True
+				offset += size
+				continue
+			if offset > 0 and offset in self.blockIndex:
+				if not ended:
+					self.flush(len(self.stack), True)
+					blocks[block] = self.block(self.goto(offset))
+				block = self.blockIndex[offset]
+				ended = False
+				self.stack = [(self.REGISTER, slot) for slot in range(depths[offset])]
+
+			if op in (OpCode.OP_CONSTANT, OpCode.OP_CONSTANT_LONG):
+				self.push((self.CONSTANT, constants[chunk.constantIndex(offset)]))
+			elif op == OpCode.OP_NIL:
+				self.push((self.CONSTANT, None))
+			elif op == OpCode.OP_TRUE:
+				self.push((self.CONSTANT, True))
+			elif op == OpCode.OP_FALSE:
+				self.push((self.CONSTANT, False))
+			elif op == OpCode.OP_POP:
+				entry = self.stack.pop()
+				if entry[0] == self.EXPRESSION:
+					self.statement(entry[1])
+			elif op == OpCode.OP_CLOSE_UPVALUE:
+				# The variable is stored in its slot before it is closed.
+				self.flush(len(self.stack), True)
+				self.stack.pop()
+				self.statement(self.closeUpvalues(len(self.stack)))
+			elif op == OpCode.OP_GET_LOCAL:
+				self.getLocal(code[offset + 1])
+			elif op == OpCode.OP_SET_LOCAL:
+				self.push(self.setLocal(code[offset + 1]))
+			elif op == OpCode.OP_SET_LOCAL_POP:
+				self.statement(self.setLocal(code[offset + 1])[1])
+			elif op == OpCode.OP_GET_GLOBAL:
+				self.push((self.EXPRESSION, self.getGlobal((code[offset + 1] << 8) | code[offset + 2])))
+			elif op == OpCode.OP_DEFINE_GLOBAL:
+				self.statement(self.defineGlobal((code[offset + 1] << 8) | code[offset + 2]))
+			elif op == OpCode.OP_SET_GLOBAL:
+				self.push((self.EXPRESSION, self.setGlobal((code[offset + 1] << 8) | code[offset + 2])))
+			elif op == OpCode.OP_GET_UPVALUE:
+				self.push((self.EXPRESSION, self.getUpvalue(code[offset + 1])))
+			elif op == OpCode.OP_SET_UPVALUE:
+				self.push((self.EXPRESSION, self.setUpvalue(code[offset + 1])))
+			elif op in (OpCode.OP_GET_PROPERTY, OpCode.OP_GET_PROPERTY_LONG):
+				self.push((self.EXPRESSION, self.getProperty(constants[chunk.constantIndex(offset)])))
+			elif op in (OpCode.OP_SET_PROPERTY, OpCode.OP_SET_PROPERTY_LONG):
+				self.push((self.EXPRESSION, self.setProperty(constants[chunk.constantIndex(offset)])))
+			elif op in (OpCode.OP_GET_SUPER, OpCode.OP_GET_SUPER_LONG):
+				self.push((self.EXPRESSION, self.getSuper(constants[chunk.constantIndex(offset)])))
+			elif op in (OpCode.OP_EQUAL, OpCode.OP_NOT_EQUAL):
+				self.push((self.EXPRESSION, self.equal(op == OpCode.OP_EQUAL)))
+			elif op in self.NUMBER_OPERATORS:
+				self.push((self.EXPRESSION, self.numberOperator(self.NUMBER_OPERATORS[op])))
+			elif op == OpCode.OP_ADD:
+				self.push((self.EXPRESSION, self.add()))
+			elif op == OpCode.OP_ADD_LOCAL_LOCAL:
+				self.getLocal(code[offset + 1])
+				self.getLocal(code[offset + 2])
+				self.push((self.EXPRESSION, self.add()))
+			elif op == OpCode.OP_ADD_LOCAL_CONSTANT:
+				self.getLocal(code[offset + 1])
+				self.push((self.CONSTANT, constants[code[offset + 2]]))
+				self.push((self.EXPRESSION, self.add()))
+			elif op == OpCode.OP_SUBTRACT_LOCAL_CONSTANT:
+				self.getLocal(code[offset + 1])
+				self.push((self.CONSTANT, constants[code[offset + 2]]))
+				self.push((self.EXPRESSION, self.numberOperator(operator.sub)))
+			elif op == OpCode.OP_NOT:
+				self.push((self.EXPRESSION, self.negation()))
+			elif op == OpCode.OP_NEGATE:
+				self.push((self.EXPRESSION, self.negate()))
+			elif op == OpCode.OP_PRINT:
+				self.statement(self.printStatement())
+			elif op in (OpCode.OP_JUMP, OpCode.OP_LOOP):
+				self.flush(len(self.stack), True)
+				blocks[block] = self.block(self.goto(chunk.jumpTarget(offset)))
+				ended = True
+			elif op == OpCode.OP_JUMP_IF_FALSE:
+				target = chunk.jumpTarget(offset)
+				terminator = self.jumpIfFalse(target, offset + size)
+				blocks[block] = self.block(terminator)
+				ended = True
+			elif op in self.COMPARE_JUMPS:
+				target = chunk.jumpTarget(offset)
+				terminator = self.compareJump(op, target, offset + size)
+				blocks[block] = self.block(terminator)
+				ended = True
+			elif op == OpCode.OP_CALL:
+				self.push((self.EXPRESSION, self.call(code[offset + 1])))
+			elif op == OpCode.OP_TAIL_CALL:
+				self.push((self.EXPRESSION, self.tailCall(code[offset + 1])))
+			elif op == OpCode.OP_CALL_GLOBAL:
+				self.push((self.EXPRESSION, self.callGlobal((code[offset + 1] << 8) | code[offset + 2],
+					code[offset + 3])))
+			elif op in (OpCode.OP_INVOKE, OpCode.OP_INVOKE_LONG):
+				self.push((self.EXPRESSION, self.invoke(constants[chunk.constantIndex(offset)],
+					code[offset + size - 1])))
+			elif op in (OpCode.OP_SUPER_INVOKE, OpCode.OP_SUPER_INVOKE_LONG):
+				self.push((self.EXPRESSION, self.superInvoke(constants[chunk.constantIndex(offset)],
+					code[offset + size - 1])))
+			elif op in (OpCode.OP_CLOSURE, OpCode.OP_CLOSURE_LONG):
+				closureFunction = constants[chunk.constantIndex(offset)]
+				self.push((self.EXPRESSION, self.closure(closureFunction)))
+			elif op == OpCode.OP_RETURN:
+				blocks[block] = self.block(self.returnStatement())
+				ended = True
+			elif op in (OpCode.OP_CLASS, OpCode.OP_CLASS_LONG):
+				self.push((self.EXPRESSION, self.newClass(constants[chunk.constantIndex(offset)])))
+			elif op == OpCode.OP_INHERIT:
+				self.statement(self.inherit())
+			elif op in (OpCode.OP_METHOD, OpCode.OP_METHOD_LONG):
+				self.statement(self.method(constants[chunk.constantIndex(offset)]))
+			else:
+				raise ValueError("Unknown opcode {0}".format(op))
+			offset += size
+
+		blocks = tuple(blocks)
+		if len(blocks) == 1:
+			only = blocks[0]
+			def run(regs):
+				only(regs)
+				return regs[0]
+		else:
+			def run(regs):
+				i = 0
+				while i >= 0:
+					i = blocks[i](regs)
+				return regs[0]
+		function.closureCode = ClosureCode(run, self.frameSize)
+		return function.closureCode
+
+	def push(self, entry):
+		self.stack.append(entry)
+		if len(self.stack) > self.frameSize:
+			self.frameSize = len(self.stack)
+
+	def node(self, entry):
+		"""Return closure that evaluates a stack entry"""
+		kind, value = entry
+		if kind == self.EXPRESSION:
+			return value
+		if kind == self.CONSTANT:
+			return lambda regs: value
+		return lambda regs: regs[value]
+
+	def flush(self, limit, constants=False):
+		"""Store the entries on the stack below limit in their slots
+
+		Constants are only stored if constants is True, as they have no
+		side effects and do not change.
+		"""
+		for slot in range(limit):
+			kind, value = self.stack[slot]
+			if kind == self.REGISTER:
+				if value == slot:
+					continue
+				def store(regs, slot=slot, value=value):
+					regs[slot] = regs[value]
+			elif kind == self.CONSTANT:
+				if not constants:
+					continue
+				def store(regs, slot=slot, value=value):
+					regs[slot] = value
+			else:
+				def store(regs, slot=slot, value=value):
+					regs[slot] = value(regs)
+			self.statements.append(store)
+			self.stack[slot] = (self.REGISTER, slot)
+
+	def pop(self, count):
+		"""Remove count entries from the stack, storing the entries below them"""
+		entries = self.stack[len(self.stack) - count:]
+		del self.stack[len(self.stack) - count:]
+		self.flush(len(self.stack))
+		return entries
+
+	def statement(self, statement):
+		"""Add statement to the block, after storing the entries on the stack"""
+		self.flush(len(self.stack))
+		self.statements.append(statement)
+
+	def block(self, terminator):
+		"""Return closure that runs the statements and then terminator"""
+		statements = tuple(self.statements)
+		self.statements = []
+		if len(statements) == 0:
+			return terminator
+		if len(statements) == 1:
+			first = statements[0]
+			def block(regs):
+				first(regs)
+				return terminator(regs)
+		else:
+			def block(regs):
+				for statement in statements:
+					statement(regs)
+				return terminator(regs)
+		return block
+
+	def goto(self, offset):
+		index = self.blockIndex[offset]
+		return lambda regs: index
+
+	def getLocal(self, slot):
+		entry = self.stack[slot]
+		if entry[0] == self.EXPRESSION:
+			self.flush(slot + 1)
+			entry = self.stack[slot]
+		self.push(entry)
+
+	def setLocal(self, slot):
+		"""Return expression entry that assigns the value on top of the stack"""
+		entry = self.pop(1)[0]
+		self.stack[slot] = (self.REGISTER, slot)
+		if entry[0] == self.CONSTANT:
+			value = entry[1]
+			def assign(regs):
+				regs[slot] = value
+				return value
+		elif entry[0] == self.REGISTER:
+			source = entry[1]
+			def assign(regs):
+				value = regs[slot] = regs[source]
+				return value
+		else:
+			node = entry[1]
+			def assign(regs):
+				value = regs[slot] = node(regs)
+				return value
+		return (self.EXPRESSION, assign)
+
+	def getGlobal(self, slot):
+		ip = self.ip
+		globalValues = self.globalValues
+		name = self.globalNames[slot]
+		def node(regs):
+			value = globalValues[slot]
+			if value is UNDEFINED:
+				runtimeError(regs, ip, "Undefined variable '{0}'".format(name))
+			return value
+		return node
+
+	def defineGlobal(self, slot):
+		value = self.node(self.pop(1)[0])
+		globalValues = self.globalValues
+		def statement(regs):
+			globalValues[slot] = value(regs)
+		return statement
+
+	def setGlobal(self, slot):
+		ip = self.ip
+		value = self.node(self.pop(1)[0])
+		globalValues = self.globalValues
+		name = self.globalNames[slot]
+		def node(regs):
+			result = value(regs)
+			if globalValues[slot] is UNDEFINED:
+				runtimeError(regs, ip, "Undefined variable '{0}'".format(name))
+			globalValues[slot] = result
+			return result
+		return node
+
+	def getUpvalue(self, index):
+		def node(regs):
+			upvalue = regs[-1].upvalues[index]
+			return upvalue.values[upvalue.location]
+		return node
+
+	def setUpvalue(self, index):
+		value = self.node(self.pop(1)[0])
+		def node(regs):
+			upvalue = regs[-1].upvalues[index]
+			result = upvalue.values[upvalue.location] = value(regs)
+			return result
+		return node
+
+	def closeUpvalues(self, slot):
+		closeUpvalues = self.vm.closeUpvalues
+		return lambda regs: closeUpvalues(regs, slot)
+
+	def getProperty(self, name):
+		ip = self.ip
+		instanceNode = self.node(self.stack.pop())
+		cache = self.vm.newInlineCache()
+		def node(regs):
+			instance = instanceNode(regs)
+			if type(instance) is not ObjInstance:
+				runtimeError(regs, ip, "Only instances have properties.")
+			shape = instance.shape
+			if shape is cache[0]:
+				offset = cache[1]
+				if offset >= 0:
+					return instance.slots[offset]
+				if cache[2] == instance.klass.version:
+					return ObjBoundMethod(instance, cache[3])
+			offset = shape.fields.get(name)
+			if offset != None:
+				cache[0] = shape
+				cache[1] = offset
+				return instance.slots[offset]
+			method = lookupMethod(regs, ip, cache, shape, instance.klass, name)
+			return ObjBoundMethod(instance, method)
+		return node
+
+	def setProperty(self, name):
+		ip = self.ip
+		instanceEntry, valueEntry = self.pop(2)
+		instanceNode = self.node(instanceEntry)
+		valueNode = self.node(valueEntry)
+		cache = self.vm.newInlineCache()
+		def node(regs):
+			instance = instanceNode(regs)
+			value = valueNode(regs)
+			if type(instance) is not ObjInstance:
+				runtimeError(regs, ip, "Only instances have fields.")
+			shape = instance.shape
+			if shape is not cache[0]:
+				offset = shape.fields.get(name)
+				cache[0] = shape
+				if offset != None:
+					cache[1] = offset
+					cache[3] = None
+				else:
+					cache[1] = len(instance.slots)
+					cache[3] = shape.addField(name)
+			if cache[3] == None:
+				instance.slots[cache[1]] = value
+			else:
+				instance.slots.append(value)
+				instance.shape = cache[3]
+			return value
+		return node
+
+	def getSuper(self, name):
+		ip = self.ip
+		receiverEntry, superclassEntry = self.stack[-2:]
+		del self.stack[-2:]
+		receiverNode = self.node(receiverEntry)
+		superclassNode = self.node(superclassEntry)
+		cache = self.vm.newInlineCache()
+		def node(regs):
+			receiver = receiverNode(regs)
+			superclass = superclassNode(regs)
+			if cache[0] is superclass and cache[2] == superclass.version:
+				method = cache[3]
+			else:
+				method = lookupMethod(regs, ip, cache, superclass, superclass, name)
+			return ObjBoundMethod(receiver, method)
+		return node
+
+	def operands(self):
+		"""Take two operands off the stack
+
+		Returns the slots or values of the operands when they are locals
+		or constants, for closures that read them directly, and closures
+		that evaluate them.
+		"""
+		left, right = self.stack[-2:]
+		del self.stack[-2:]
+		return left, right, self.node(left), self.node(right)
+
+	def equal(self, equal):
+		left, right, leftNode, rightNode = self.operands()
+		if equal:
+			def node(regs):
+				a = leftNode(regs)
+				b = rightNode(regs)
+				return type(a) is type(b) and a == b
+		else:
+			def node(regs):
+				a = leftNode(regs)
+				b = rightNode(regs)
+				return type(a) is not type(b) or a != b
+		return node
+
+	def numberOperator(self, function):
+		"""Return closure applying function to two numbers"""
+		ip = self.ip
+		left, right, leftNode, rightNode = self.operands()
+		if left[0] == self.REGISTER and right[0] == self.CONSTANT and type(right[1]) is float:
+			slot = left[1]
+			b = right[1]
+			def node(regs):
+				a = regs[slot]
+				if type(a) is not float:
+					runtimeError(regs, ip, "Operands must be numbers.")
+				return function(a, b)
+		elif left[0] == self.REGISTER and right[0] == self.REGISTER:
+			slotA = left[1]
+			slotB = right[1]
+			def node(regs):
+				a = regs[slotA]
+				b = regs[slotB]
+				if type(a) is not float or type(b) is not float:
+					runtimeError(regs, ip, "Operands must be numbers.")
+				return function(a, b)
+		else:
+			def node(regs):
+				a = leftNode(regs)
+				b = rightNode(regs)
+				if type(a) is not float or type(b) is not float:
+					runtimeError(regs, ip, "Operands must be numbers.")
+				return function(a, b)
+		return node
+
+	def add(self):
+		ip = self.ip
+		left, right, leftNode, rightNode = self.operands()
+		if left[0] == self.REGISTER and right[0] == self.CONSTANT and type(right[1]) is float:
+			slot = left[1]
+			b = right[1]
+			def node(regs):
+				a = regs[slot]
+				if type(a) is not float:
+					runtimeError(regs, ip, "Operands must be numbers.")
+				return a + b
+			return node
+		def node(regs):
+			a = leftNode(regs)
+			b = rightNode(regs)
+			if type(a) is float and type(b) is float:
+				return a + b
+			if type(a) is ObjString and type(b) is ObjString:
+				return copyString(a.AS_STRING() + b.AS_STRING())
+			runtimeError(regs, ip, "Operands must be numbers.")
+		return node
+
+	def negation(self):
+		value = self.node(self.stack.pop())
+		def node(regs):
+			result = value(regs)
+			return result is None or result is False
+		return node
+
+	def negate(self):
+		ip = self.ip
+		value = self.node(self.stack.pop())
+		def node(regs):
+			result = value(regs)
+			if type(result) is not float:
+				runtimeError(regs, ip, "Operand must be a number.")
+			return -result
+		return node
+
+	def printStatement(self):
+		value = self.node(self.pop(1)[0])
+		printValue = self.vm.printValue
+		def statement(regs):
+			printValue(value(regs))
+			print()
+		return statement
+
+	def jumpIfFalse(self, target, next):
+		"""Return terminator for OP_JUMP_IF_FALSE, which leaves the value in its slot"""
+		self.flush(len(self.stack) - 1, True)
+		slot = len(self.stack) - 1
+		entry = self.stack[slot]
+		targetIndex = self.blockIndex[target]
+		nextIndex = self.blockIndex[next]
+		if entry == (self.REGISTER, slot):
+			def terminator(regs):
+				value = regs[slot]
+				if value is None or value is False:
+					return targetIndex
+				return nextIndex
+		else:
+			valueNode = self.node(entry)
+			def terminator(regs):
+				value = regs[slot] = valueNode(regs)
+				if value is None or value is False:
+					return targetIndex
+				return nextIndex
+		self.stack[slot] = (self.REGISTER, slot)
+		return terminator
+
+	def compareJump(self, op, target, next):
+		ip = self.ip
+		test, numbers = self.COMPARE_JUMPS[op]
+		left, right, leftNode, rightNode = self.operands()
+		self.flush(len(self.stack), True)
+		targetIndex = self.blockIndex[target]
+		nextIndex = self.blockIndex[next]
+		if not numbers:
+			def terminator(regs):
+				if test(leftNode(regs), rightNode(regs)):
+					return nextIndex
+				return targetIndex
+		elif left[0] == self.REGISTER and right[0] == self.CONSTANT and type(right[1]) is float:
+			slot = left[1]
+			b = right[1]
+			def terminator(regs):
+				a = regs[slot]
+				if type(a) is not float:
+					runtimeError(regs, ip, "Operands must be numbers.")
+				if test(a, b):
+					return nextIndex
+				return targetIndex
+		else:
+			def terminator(regs):
+				a = leftNode(regs)
+				b = rightNode(regs)
+				if type(a) is not float or type(b) is not float:
+					runtimeError(regs, ip, "Operands must be numbers.")
+				if test(a, b):
+					return nextIndex
+				return targetIndex
+		return terminator
+
+	def arguments(self, entries):
+		"""Return closure that evaluates the arguments of a call to a list"""
+		nodes = [self.node(entry) for entry in entries]
+		if len(nodes) == 0:
+			return lambda regs: []
+		if len(nodes) == 1:
+			first = nodes[0]
+			return lambda regs: [first(regs)]
+		if len(nodes) == 2:
+			first, second = nodes
+			return lambda regs: [first(regs), second(regs)]
+		nodes = tuple(nodes)
+		return lambda regs: [node(regs) for node in nodes]
+
+	def call(self, argCount):
+		ip = self.ip
+		entries = self.pop(argCount + 1)
+		calleeNode = self.node(entries[0])
+		arguments = self.arguments(entries[1:])
+		callClosure = self.callClosure
+		callValue = self.callValue
+		def node(regs):
+			callee = calleeNode(regs)
+			args = arguments(regs)
+			try:
+				if type(callee) is ObjClosure:
+					return callClosure(callee, callee, args)
+				return callValue(callee, args)
+			except LoxRuntimeError as e:
+				e.frames.append((regs[-1], ip))
+				raise
+		return node
+
+	def tailCall(self, argCount):
+		"""OP_TAIL_CALL returns a TailCall for a Lox function, which the
+		OP_RETURN after it returns to callClosure()"""
+		ip = self.ip
+		entries = self.pop(argCount + 1)
+		calleeNode = self.node(entries[0])
+		arguments = self.arguments(entries[1:])
+		callValue = self.callValue
+		def node(regs):
+			callee = calleeNode(regs)
+			args = arguments(regs)
+			if type(callee) is ObjClosure:
+				receiver = callee
+			elif type(callee) is ObjBoundMethod:
+				receiver = callee.receiver
+				callee = callee.method
+			else:
+				try:
+					return callValue(callee, args)
+				except LoxRuntimeError as e:
+					e.frames.append((regs[-1], ip))
+					raise
+			function = callee.AS_CLOSURE()
+			if len(args) != function.arity:
+				runtimeError(regs, ip, "Expected {0} arguments but got {1}.".format(function.arity, len(args)))
+			return TailCall(callee, receiver, args)
+		return node
+
+	def callGlobal(self, slot, argCount):
+		ip = self.ip
+		arguments = self.arguments(self.pop(argCount))
+		globalValues = self.globalValues
+		name = self.globalNames[slot]
+		callClosure = self.callClosure
+		callValue = self.callValue
+		def node(regs):
+			args = arguments(regs)
+			# The function is looked up after the arguments, as with
+			# OP_CALL_GLOBAL.
+			callee = globalValues[slot]
+			if callee is UNDEFINED:
+				runtimeError(regs, ip, "Undefined variable '{0}'".format(name))
+			try:
+				if type(callee) is ObjClosure:
+					return callClosure(callee, callee, args)
+				return callValue(callee, args)
+			except LoxRuntimeError as e:
+				e.frames.append((regs[-1], ip))
+				raise
+		return node
+
+	def invoke(self, name, argCount):
+		ip = self.ip
+		entries = self.pop(argCount + 1)
+		receiverNode = self.node(entries[0])
+		arguments = self.arguments(entries[1:])
+		cache = self.vm.newInlineCache()
+		callClosure = self.callClosure
+		callValue = self.callValue
+		def node(regs):
+			receiver = receiverNode(regs)
+			args = arguments(regs)
+			if type(receiver) is not ObjInstance:
+				runtimeError(regs, ip, "Only instances have methods.")
+			shape = receiver.shape
+			if shape is not cache[0]:
+				offset = shape.fields.get(name)
+				if offset != None:
+					# A field holding a function is called like a function.
+					try:
+						return callValue(receiver.slots[offset], args)
+					except LoxRuntimeError as e:
+						e.frames.append((regs[-1], ip))
+						raise
+				index = receiver.klass.methodIndex(name)
+				if index < 0:
+					runtimeError(regs, ip, "Undefined property '{0}'.".format(name.AS_STRING()))
+				cache[0] = shape
+				cache[3] = index
+			try:
+				return callClosure(receiver.klass.vtable[cache[3]], receiver, args)
+			except LoxRuntimeError as e:
+				e.frames.append((regs[-1], ip))
+				raise
+		return node
+
+	def superInvoke(self, name, argCount):
+		ip = self.ip
+		entries = self.pop(argCount + 2)
+		receiverNode = self.node(entries[0])
+		arguments = self.arguments(entries[1:-1])
+		superclassNode = self.node(entries[-1])
+		cache = self.vm.newInlineCache()
+		callClosure = self.callClosure
+		def node(regs):
+			receiver = receiverNode(regs)
+			args = arguments(regs)
+			superclass = superclassNode(regs)
+			if superclass is not cache[0]:
+				index = superclass.methodIndex(name)
+				if index < 0:
+					runtimeError(regs, ip, "Undefined property '{0}'.".format(name.AS_STRING()))
+				cache[0] = superclass
+				cache[3] = index
+			try:
+				return callClosure(superclass.vtable[cache[3]], receiver, args)
+			except LoxRuntimeError as e:
+				e.frames.append((regs[-1], ip))
+				raise
+		return node
+
+	def closure(self, function):
+		# Captured locals are read and written in their slots.
+		self.flush(len(self.stack), True)
+		captureUpvalue = self.vm.captureUpvalue
+		captures = function.getCaptures()
+		def node(regs):
+			closure = ObjClosure(function)
+			upvalues = regs[-1].upvalues
+			i = 0
+			for isLocal, index in captures:
+				if isLocal:
+					closure.upvalues[i] = captureUpvalue(regs, index)
+				else:
+					closure.upvalues[i] = upvalues[index]
+				i += 1
+			return closure
+		return node
+
+	def returnStatement(self):
+		value = self.node(self.pop(1)[0])
+		if not self.capturesLocals:
+			def terminator(regs):
+				regs[0] = value(regs)
+				return -1
+			return terminator
+		vm = self.vm
+		closeUpvalues = vm.closeUpvalues
+		def terminator(regs):
+			# Slot zero may be captured, as 'this'.
+			result = value(regs)
+			if vm.openUpvalues != None:
+				closeUpvalues(regs, 0)
+			regs[0] = result
+			return -1
+		return terminator
+
+	def newClass(self, name):
+		return lambda regs: ObjClass(name)
+
+	def inherit(self):
+		ip = self.ip
+		subclassEntry = self.stack.pop()
+		self.flush(len(self.stack))
+		superclassNode = self.node(self.stack[-1])
+		subclassNode = self.node(subclassEntry)
+		def statement(regs):
+			superclass = superclassNode(regs)
+			if type(superclass) is not ObjClass:
+				runtimeError(regs, ip, "Superclass must be a class.")
+			subclass = subclassNode(regs)
+			subclass.inherit(superclass)
+		return statement
+
+	def method(self, name):
+		methodEntry = self.stack.pop()
+		self.flush(len(self.stack))
+		klassNode = self.node(self.stack[-1])
+		methodNode = self.node(methodEntry)
+		def statement(regs):
+			klassNode(regs).defineMethod(name, methodNode(regs))
+		return statement
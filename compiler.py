@@ -3,6 +3,7 @@ from token import *
 from chunk import *
 from value import *
 from object import *
+from optimizer import *
 import sys
 
 class Parser:
@@ -60,19 +61,35 @@ class Compiler:
 	"""Compiles source code"""
 
 	DEBUG_PRINT_CODE = 0
-
-	def __init__(self, compiler, type):
+	# Run peephole optimizer on the code of each function
+	OPTIMIZE = 0
+	# Replace common sequences of instructions with superinstructions
+	SUPERINSTRUCTIONS = 1
+	# Call functions from 'return f();' in the frame of the caller
+	TAIL_CALLS = 1
+	# Parse to the intermediate representation in ir.py before emitting
+	# code, using IRCompiler
+	USE_IR = 0
+
+	def __init__(self, compiler, type, globals=None):
 		self.enclosing = compiler
 		if compiler != None:
 			self.currentClass = compiler.currentClass
+			self.globals = compiler.globals
 		else:
 			self.currentClass = None
+			if globals == None:
+				globals = GlobalTable()
+			self.globals = globals
 		self.start = ""
 		self.line = 1
+		self.operandStart = 0
+		self.operandConstants = 0
 		self.parser = Parser()
 		self.current = CompilerState(type)
 		if type != FunctionType.TYPE_SCRIPT:
-			self.current.function = ObjFunction(ObjString(compiler.parser.previous.start))
+			self.current.function = ObjFunction(copyString(compiler.parser.previous.start))
+		self.current.function.chunk.globalNames = self.globals.names
 
 		local = Local()
 		local.name = Token()
@@ -170,14 +187,36 @@ class Compiler:
 		self.emitByte(OpCode.OP_RETURN)
 
 	def makeConstant(self, value):
-		constant = self.currentChunk().addConstant(value)
-		if (constant > 255):
+		# Each number and string is only stored once in a chunk.
+		key = None
+		if value.IS_NUMBER():
+			# repr() keeps 0 and -0 apart.
+			key = ("number", repr(value.AS_NUMBER()))
+		elif value.IS_OBJ() and value.AS_OBJ().OBJ_TYPE() == ObjType.OBJ_STRING:
+			key = ("string", value.AS_OBJ().AS_STRING())
+		constant = self.currentChunk().addConstant(value, key)
+		if (constant > 65535):
 			self.error("Too many constants in one chunk.")
 			return 0
 		return constant
 
+	def emitGlobal(self, instruction, slot):
+		self.emitByte(instruction)
+		self.emitByte((slot >> 8) & 0xff)
+		self.emitByte(slot & 0xff)
+
+	def emitWithConstant(self, instruction, constant):
+		"""Emit instruction with an index into constants as operand, or its
+		long variant if the index does not fit in one byte"""
+		if constant > 255:
+			self.emitByte(Chunk.LONG_OPCODES[instruction])
+			self.emitByte((constant >> 8) & 0xff)
+			self.emitByte(constant & 0xff)
+		else:
+			self.emitBytes(instruction, constant)
+
 	def emitConstant(self, value):
-		self.emitBytes(OpCode.OP_CONSTANT, self.makeConstant(value))
+		self.emitWithConstant(OpCode.OP_CONSTANT, self.makeConstant(value))
 
 	def patchJump(self, offset):
 		# -2 to adjust for the bytecode for the jump offset itself.
@@ -190,6 +229,15 @@ class Compiler:
 	def endCompiler(self):
 		self.emitReturn()
 		function = self.current.function
+		counts = None
+		if self.OPTIMIZE == 1 and not self.parser.hadError:
+			counts = Optimizer().optimize(self.currentChunk())
+		if self.TAIL_CALLS == 1 and not self.parser.hadError and function.getName() != None:
+			Optimizer().tailCalls(self.currentChunk())
+		if self.SUPERINSTRUCTIONS == 1 and not self.parser.hadError:
+			Optimizer().fuse(self.currentChunk())
+		if not self.parser.hadError:
+			function.maxStack = self.currentChunk().maxStackDepth(function.arity + 1)
 		if self.DEBUG_PRINT_CODE == 1:
 			if not self.parser.hadError:
 				if function.getName() != None:
@@ -197,6 +245,8 @@ class Compiler:
 				else:
 					name = "<script>"
 				self.currentChunk().disassembleChunk(name)
+				if counts != None:
+					print("--- {0} instructions before optimizing, {1} after ---".format(counts[0], counts[1]))
 		return function
 
 	def beginScope(self):
@@ -212,23 +262,110 @@ class Compiler:
 				self.emitByte(OpCode.OP_POP)
 			self.current.locals.pop()
 
+	def constantOperand(self, start, end):
+		"""Return the Value of the operand compiled to code[start:end] if it
+		is a single instruction pushing a constant, otherwise None"""
+		chunk = self.currentChunk()
+		if start >= end or chunk.instructionSize(start) != end - start:
+			return None
+		op = chunk.code[start]
+		if op == OpCode.OP_CONSTANT or op == OpCode.OP_CONSTANT_LONG:
+			return chunk.constants[chunk.constantIndex(start)]
+		if op == OpCode.OP_NIL:
+			return Value.NIL_VAL()
+		if op == OpCode.OP_TRUE:
+			return Value.BOOL_VAL(True)
+		if op == OpCode.OP_FALSE:
+			return Value.BOOL_VAL(False)
+		return None
+
+	def removeCode(self, start, constants):
+		"""Remove the code emitted from offset start onwards, and the
+		constants added since the chunk had the given number of them"""
+		chunk = self.currentChunk()
+		chunk.removeCode(start)
+		chunk.removeConstants(constants)
+
+	def emitFolded(self, start, constants, value):
+		"""Replace the code from offset start and the constants added for
+		it with a push of constant value"""
+		self.removeCode(start, constants)
+		if value.IS_NIL():
+			self.emitByte(OpCode.OP_NIL)
+		elif value.IS_BOOL():
+			if value.AS_BOOL():
+				self.emitByte(OpCode.OP_TRUE)
+			else:
+				self.emitByte(OpCode.OP_FALSE)
+		else:
+			self.emitConstant(value)
+
+	def isFalsey(self, value):
+		return value.IS_NIL() or (value.IS_BOOL() and not value.AS_BOOL())
+
+	def foldBinary(self, operatorType, a, b):
+		"""Return the Value of constants a and b combined by a binary
+		operator, or None if it must be left to the VM at runtime"""
+		if operatorType == TokenType.TOKEN_EQUAL_EQUAL:
+			return Value.BOOL_VAL(Value.valuesEqual(a, b))
+		if operatorType == TokenType.TOKEN_BANG_EQUAL:
+			return Value.BOOL_VAL(not Value.valuesEqual(a, b))
+		if operatorType == TokenType.TOKEN_PLUS and a.IS_OBJ() and b.IS_OBJ():
+			if a.AS_OBJ().IS_STRING() and b.AS_OBJ().IS_STRING():
+				return Value.OBJ_VAL(copyString(a.AS_OBJ().AS_STRING() + b.AS_OBJ().AS_STRING()))
+			return None
+		if not a.IS_NUMBER() or not b.IS_NUMBER():
+			# Type errors are reported by the VM.
+			return None
+		x = float(a.AS_NUMBER())
+		y = float(b.AS_NUMBER())
+		if operatorType == TokenType.TOKEN_GREATER:
+			return Value.BOOL_VAL(x > y)
+		if operatorType == TokenType.TOKEN_GREATER_EQUAL:
+			return Value.BOOL_VAL(not (x < y))
+		if operatorType == TokenType.TOKEN_LESS:
+			return Value.BOOL_VAL(x < y)
+		if operatorType == TokenType.TOKEN_LESS_EQUAL:
+			return Value.BOOL_VAL(not (x > y))
+		if operatorType == TokenType.TOKEN_PLUS:
+			return Value.NUMBER_VAL(x + y)
+		if operatorType == TokenType.TOKEN_MINUS:
+			return Value.NUMBER_VAL(x - y)
+		if operatorType == TokenType.TOKEN_STAR:
+			return Value.NUMBER_VAL(x * y)
+		if operatorType == TokenType.TOKEN_SLASH and y != 0:
+			return Value.NUMBER_VAL(x / y)
+		return None
+
 	def binary(self, canAssign):
 		operatorType = self.parser.previous.type
 		rule = self.getRule(operatorType)
+		leftStart = self.operandStart
+		leftConstants = self.operandConstants
+		rightStart = len(self.currentChunk().code)
 		self.parsePrecedence(rule.precedence + 1)
 
+		# Evaluate operators with constant operands at compile time.
+		a = self.constantOperand(leftStart, rightStart)
+		b = self.constantOperand(rightStart, len(self.currentChunk().code))
+		if a != None and b != None:
+			value = self.foldBinary(operatorType, a, b)
+			if value != None:
+				self.emitFolded(leftStart, leftConstants, value)
+				return
+
 		if operatorType == TokenType.TOKEN_BANG_EQUAL:
-			self.emitBytes(OpCode.OP_EQUAL, OpCode.OP_NOT)
+			self.emitByte(OpCode.OP_NOT_EQUAL)
 		elif operatorType == TokenType.TOKEN_EQUAL_EQUAL:
 			self.emitByte(OpCode.OP_EQUAL)
 		elif operatorType == TokenType.TOKEN_GREATER:
 			self.emitByte(OpCode.OP_GREATER)
 		elif operatorType == TokenType.TOKEN_GREATER_EQUAL:
-			self.emitBytes(OpCode.OP_LESS, OpCode.OP_NOT)
+			self.emitByte(OpCode.OP_GREATER_EQUAL)
 		elif operatorType == TokenType.TOKEN_LESS:
 			self.emitByte(OpCode.OP_LESS)
 		elif operatorType == TokenType.TOKEN_LESS_EQUAL:
-			self.emitBytes(OpCode.OP_GREATER, OpCode.OP_NOT)
+			self.emitByte(OpCode.OP_LESS_EQUAL)
 		elif operatorType == TokenType.TOKEN_PLUS:
 			self.emitByte(OpCode.OP_ADD)
 		elif operatorType == TokenType.TOKEN_MINUS:
@@ -250,13 +387,13 @@ class Compiler:
 		name = self.identifierConstant(self.parser.previous)
 		if canAssign and self.match(TokenType.TOKEN_EQUAL):
 			self.expression()
-			self.emitBytes(OpCode.OP_SET_PROPERTY, name)
+			self.emitWithConstant(OpCode.OP_SET_PROPERTY, name)
 		elif self.match(TokenType.TOKEN_LEFT_PAREN):
 			argCount = self.argumentList()
-			self.emitBytes(OpCode.OP_INVOKE, name)
+			self.emitWithConstant(OpCode.OP_INVOKE, name)
 			self.emitByte(argCount)
 		else:
-			self.emitBytes(OpCode.OP_GET_PROPERTY, name)
+			self.emitWithConstant(OpCode.OP_GET_PROPERTY, name)
 
 	def literal(self, canAssign):
 		operatorType = self.parser.previous.type
@@ -276,6 +413,11 @@ class Compiler:
 		self.emitConstant(Value.NUMBER_VAL(value))
 
 	def or_(self, canAssign):
+		left = self.constantOperand(self.operandStart, len(self.currentChunk().code))
+		if left != None:
+			self.foldLogical(not self.isFalsey(left), Precedence.PREC_OR)
+			return
+
 		elseJump = self.emitJump(OpCode.OP_JUMP_IF_FALSE)
 		endJump = self.emitJump(OpCode.OP_JUMP)
 		self.patchJump(elseJump)
@@ -286,7 +428,7 @@ class Compiler:
 	def string(self, canAssign):
 		# Take string inside quotes
 		s = self.parser.previous.start[1 : -1]
-		obj = ObjString(s)
+		obj = copyString(s)
 		self.emitConstant(Value.OBJ_VAL(obj))
 
 	def namedVariable(self, name, canAssign):
@@ -300,9 +442,13 @@ class Compiler:
 				getOp = OpCode.OP_GET_UPVALUE
 				setOp = OpCode.OP_SET_UPVALUE
 			else:
-				arg = self.identifierConstant(name)
-				getOp = OpCode.OP_GET_GLOBAL
-				setOp = OpCode.OP_SET_GLOBAL
+				arg = self.globalSlot(name)
+				if canAssign and self.match(TokenType.TOKEN_EQUAL):
+					self.expression()
+					self.emitGlobal(OpCode.OP_SET_GLOBAL, arg)
+				else:
+					self.emitGlobal(OpCode.OP_GET_GLOBAL, arg)
+				return
 
 		if canAssign and self.match(TokenType.TOKEN_EQUAL):
 			self.expression()
@@ -326,8 +472,14 @@ class Compiler:
 		self.consume(TokenType.TOKEN_IDENTIFIER, "Expect superclass method name.")
 		name = self.identifierConstant(self.parser.previous)
 		self.namedVariable(self.syntheticToken("this"), False)
-		self.namedVariable(self.syntheticToken("super"), False)
-		self.emitBytes(OpCode.OP_GET_SUPER, name)
+		if self.match(TokenType.TOKEN_LEFT_PAREN):
+			argCount = self.argumentList()
+			self.namedVariable(self.syntheticToken("super"), False)
+			self.emitWithConstant(OpCode.OP_SUPER_INVOKE, name)
+			self.emitByte(argCount)
+		else:
+			self.namedVariable(self.syntheticToken("super"), False)
+			self.emitWithConstant(OpCode.OP_GET_SUPER, name)
 
 	def this_(self, canAssign):
 		if self.currentClass == None:
@@ -339,8 +491,20 @@ class Compiler:
 		operatorType = self.parser.previous.type
 
 		# Compile the operand.
+		start = len(self.currentChunk().code)
+		constants = self.currentChunk().constants.len()
 		self.parsePrecedence(Precedence.PREC_UNARY)
 
+		# Evaluate operators with a constant operand at compile time.
+		value = self.constantOperand(start, len(self.currentChunk().code))
+		if value != None:
+			if operatorType == TokenType.TOKEN_BANG:
+				self.emitFolded(start, constants, Value.BOOL_VAL(self.isFalsey(value)))
+				return
+			if operatorType == TokenType.TOKEN_MINUS and value.IS_NUMBER():
+				self.emitFolded(start, constants, Value.NUMBER_VAL(-float(value.AS_NUMBER())))
+				return
+
 		# Emit the operator instruction.
 		if operatorType == TokenType.TOKEN_BANG:
 			self.emitByte(OpCode.OP_NOT)
@@ -402,20 +566,33 @@ class Compiler:
 			self.error("Expect expression.")
 			return
 		canAssign = precedence <= Precedence.PREC_ASSIGNMENT
+		start = len(self.currentChunk().code)
+		constants = self.currentChunk().constants.len()
 		rule.prefix(canAssign)
 
 		while precedence <= self.getRule(self.parser.current.type).precedence:
 			self.advance()
 			rule = self.getRule(self.parser.previous.type)
+			# Start of the code and constants of the left operand, for
+			# constant folding.
+			self.operandStart = start
+			self.operandConstants = constants
 			rule.infix(canAssign)
 
 		if canAssign and self.match(TokenType.TOKEN_EQUAL_EQUAL):
 			self.error("Invalid assignment target.")
 
 	def identifierConstant(self, name):
-		obj = Value.OBJ_VAL(ObjString(name.start))
+		obj = Value.OBJ_VAL(copyString(name.start))
 		return self.makeConstant(obj)
 
+	def globalSlot(self, name):
+		slot = self.globals.slot(name.start)
+		if slot > 65535:
+			self.error("Too many global variables.")
+			return 0
+		return slot
+
 	def identifiersEqual(self, a, b):
 		return a.start == b.start
 
@@ -491,7 +668,7 @@ class Compiler:
 		self.declareVariable()
 		if self.current.scopeDepth > 0:
 			return 0
-		return self.identifierConstant(self.parser.previous)
+		return self.globalSlot(self.parser.previous)
 
 	def markInitialized(self):
 		if self.current.scopeDepth == 0:
@@ -502,7 +679,7 @@ class Compiler:
 		if self.current.scopeDepth > 0:
 			self.markInitialized()
 			return 0
-		self.emitBytes(OpCode.OP_DEFINE_GLOBAL, globalVar)
+		self.emitGlobal(OpCode.OP_DEFINE_GLOBAL, globalVar)
 
 	def argumentList(self):
 		argCount = 0
@@ -517,7 +694,28 @@ class Compiler:
 		self.consume(TokenType.TOKEN_RIGHT_PAREN, "Expect ')' after arguments.")
 		return argCount
 
+	def foldLogical(self, shortCircuit, precedence):
+		"""Compile the right operand of 'and'/'or' with a constant left
+		operand. If the operator short circuits, the left operand is the
+		result and the code of the right operand is dropped, otherwise the
+		right operand is the result."""
+		start = self.operandStart
+		constants = self.operandConstants
+		if shortCircuit:
+			rightStart = len(self.currentChunk().code)
+			rightConstants = self.currentChunk().constants.len()
+			self.parsePrecedence(precedence)
+			self.removeCode(rightStart, rightConstants)
+		else:
+			self.removeCode(start, constants)
+			self.parsePrecedence(precedence)
+
 	def and_(self, canAssign):
+		left = self.constantOperand(self.operandStart, len(self.currentChunk().code))
+		if left != None:
+			self.foldLogical(self.isFalsey(left), Precedence.PREC_AND)
+			return
+
 		endJump = self.emitJump(OpCode.OP_JUMP_IF_FALSE)
 		self.emitByte(OpCode.OP_POP)
 		self.parsePrecedence(Precedence.PREC_AND)
@@ -555,7 +753,7 @@ class Compiler:
 		compiler.block()
 		function = compiler.endCompiler()
 		value = Value.OBJ_VAL(function)
-		self.emitBytes(OpCode.OP_CLOSURE, self.makeConstant(value))
+		self.emitWithConstant(OpCode.OP_CLOSURE, self.makeConstant(value))
 
 		i = 0
 		while i < len(function.upvalues):
@@ -574,16 +772,19 @@ class Compiler:
 		if self.parser.previous.start == "init":
 			type = FunctionType.TYPE_INITIALIZER
 		self.function(type)
-		self.emitBytes(OpCode.OP_METHOD, constant)
+		self.emitWithConstant(OpCode.OP_METHOD, constant)
 
 	def classDeclaration(self):
 		self.consume(TokenType.TOKEN_IDENTIFIER, "Expect class name.")
 		className = self.parser.previous
 		nameConstant = self.identifierConstant(self.parser.previous)
 		self.declareVariable()
+		globalVar = 0
+		if self.current.scopeDepth == 0:
+			globalVar = self.globalSlot(className)
 
-		self.emitBytes(OpCode.OP_CLASS, nameConstant)
-		self.defineVariable(nameConstant)
+		self.emitWithConstant(OpCode.OP_CLASS, nameConstant)
+		self.defineVariable(globalVar)
 		enclosingCurrentClass = self.currentClass
 		hasSuperclass = False
 		self.currentClass = self
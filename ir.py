@@ -0,0 +1,203 @@
+from enum import IntEnum
+
+class VariableKind(IntEnum):
+	"""Where a variable resolved by the compiler is stored"""
+	LOCAL = 0
+	UPVALUE = 1
+	GLOBAL = 2
+
+class Node:
+	"""A node of the intermediate representation built by IRCompiler
+
+	line is the source line of the instruction that the node compiles to.
+	Nodes with several instructions on different lines have more lines.
+	"""
+	def __init__(self, line):
+		self.line = line
+
+class Literal(Node):
+	"""A number, string, nil, true or false, value is a Value"""
+	def __init__(self, value, line):
+		super().__init__(line)
+		self.value = value
+
+class Variable(Node):
+	"""Read of a variable, index is the local slot, upvalue or global slot"""
+	def __init__(self, kind, index, line):
+		super().__init__(line)
+		self.kind = kind
+		self.index = index
+
+class Assign(Node):
+	def __init__(self, kind, index, value, line):
+		super().__init__(line)
+		self.kind = kind
+		self.index = index
+		self.value = value
+
+class GetProperty(Node):
+	def __init__(self, object, name, line):
+		super().__init__(line)
+		self.object = object
+		self.name = name
+
+class SetProperty(Node):
+	def __init__(self, object, name, value, line):
+		super().__init__(line)
+		self.object = object
+		self.name = name
+		self.value = value
+
+class Invoke(Node):
+	"""Call of a method by name, object.name(arguments)"""
+	def __init__(self, object, name, arguments, line):
+		super().__init__(line)
+		self.object = object
+		self.name = name
+		self.arguments = arguments
+
+class Super(Node):
+	"""super.name, with the variables holding this and the superclass"""
+	def __init__(self, name, this, superclass, line):
+		super().__init__(line)
+		self.name = name
+		self.this = this
+		self.superclass = superclass
+
+class SuperInvoke(Node):
+	"""Call of a superclass method, super.name(arguments)"""
+	def __init__(self, name, this, superclass, arguments, line):
+		super().__init__(line)
+		self.name = name
+		self.this = this
+		self.superclass = superclass
+		self.arguments = arguments
+
+class Call(Node):
+	def __init__(self, callee, arguments, line):
+		super().__init__(line)
+		self.callee = callee
+		self.arguments = arguments
+
+class Unary(Node):
+	"""Unary operator, operator is the TokenType"""
+	def __init__(self, operator, operand, line):
+		super().__init__(line)
+		self.operator = operator
+		self.operand = operand
+
+class Binary(Node):
+	def __init__(self, operator, left, right, line):
+		super().__init__(line)
+		self.operator = operator
+		self.left = left
+		self.right = right
+
+class Logical(Node):
+	"""'and' or 'or', line is the line of the operator"""
+	def __init__(self, operator, left, right, line):
+		super().__init__(line)
+		self.operator = operator
+		self.left = left
+		self.right = right
+
+class Function(Node):
+	"""A function and its body, line is the line of its closing brace
+
+	state is the CompilerState the function was parsed with, holding the
+	ObjFunction with its arity and resolved upvalues.
+	"""
+	def __init__(self, state, body, line):
+		super().__init__(line)
+		self.state = state
+		self.body = body
+
+class Expression(Node):
+	"""Expression statement, the value is popped at line"""
+	def __init__(self, expression, line):
+		super().__init__(line)
+		self.expression = expression
+
+class Print(Node):
+	def __init__(self, expression, line):
+		super().__init__(line)
+		self.expression = expression
+
+class Var(Node):
+	"""Variable declaration, slot is the global slot or None for a local"""
+	def __init__(self, slot, value, line):
+		super().__init__(line)
+		self.slot = slot
+		self.value = value
+
+class Return(Node):
+	"""return statement, value is None for a bare 'return;'"""
+	def __init__(self, value, line):
+		super().__init__(line)
+		self.value = value
+
+class Block(Node):
+	"""Statements of a scope, locals are the Locals popped at its end"""
+	def __init__(self, statements, locals, line):
+		super().__init__(line)
+		self.statements = statements
+		self.locals = locals
+
+class If(Node):
+	"""line is the line of the condition, elseLine the end of the then branch"""
+	def __init__(self, condition, thenBranch, elseBranch, line, elseLine):
+		super().__init__(line)
+		self.condition = condition
+		self.thenBranch = thenBranch
+		self.elseBranch = elseBranch
+		self.elseLine = elseLine
+
+class While(Node):
+	"""line is the line of the condition, loopLine the end of the body"""
+	def __init__(self, condition, body, line, loopLine):
+		super().__init__(line)
+		self.condition = condition
+		self.body = body
+		self.loopLine = loopLine
+
+class For(Node):
+	"""for statement, each clause may be None
+
+	line is the line of the condition, incrementLines are the lines of
+	the jump over the increment, its pop and the loop after it, and
+	loopLine is the end of the body. locals are the Locals of the
+	initializer popped at the end.
+	"""
+	def __init__(self, initializer, condition, increment, body, locals, line, incrementLines, loopLine):
+		super().__init__(line)
+		self.initializer = initializer
+		self.condition = condition
+		self.increment = increment
+		self.body = body
+		self.locals = locals
+		self.incrementLines = incrementLines
+		self.loopLine = loopLine
+
+class Method(Node):
+	def __init__(self, name, function, line):
+		super().__init__(line)
+		self.name = name
+		self.function = function
+
+class Class(Node):
+	"""Class declaration, slot is the global slot or None for a local
+
+	With a superclass, superclass is the Variable naming it and
+	inheritClass the Variable of the class itself for OP_INHERIT, and
+	locals holds the 'super' local popped at endLine.
+	"""
+	def __init__(self, name, slot, line):
+		super().__init__(line)
+		self.name = name
+		self.slot = slot
+		self.superclass = None
+		self.inheritClass = None
+		self.classVariable = None
+		self.methods = []
+		self.locals = []
+		self.endLine = line
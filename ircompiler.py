@@ -0,0 +1,705 @@
+from compiler import *
+from ir import *
+
+class IRCompiler(Compiler):
+	"""Compiles source code through an intermediate representation
+
+	The parse functions of Compiler are replaced with ones that return
+	nodes from ir.py instead of emitting code. Variables are resolved to
+	local slots, upvalues and global slots while parsing, exactly as the
+	direct compiler does, and each node records the lines its
+	instructions are emitted on. Constant operands are folded as the
+	nodes are built. Once the whole script has been parsed without
+	errors, generate() walks the nodes of each function and emits the
+	same bytecode as Compiler, using its emit functions.
+
+	This gives passes over a whole function, such as inlining or loop
+	optimizations, a tree to work on before any code is emitted.
+	"""
+
+	def __init__(self, compiler, type, globals=None):
+		super().__init__(compiler, type, globals)
+		# Left operand for the infix parse functions
+		self.left = None
+
+	def emitByte(self, byte):
+		self.currentChunk().writeChunk(byte, self.line)
+
+	# Parsing to IR
+
+	def parsePrecedence(self, precedence):
+		self.advance()
+		rule = self.getRule(self.parser.previous.type)
+		if (rule.prefix == None):
+			self.error("Expect expression.")
+			return None
+		canAssign = precedence <= Precedence.PREC_ASSIGNMENT
+		node = rule.prefix(canAssign)
+
+		while precedence <= self.getRule(self.parser.current.type).precedence:
+			self.advance()
+			rule = self.getRule(self.parser.previous.type)
+			self.left = node
+			node = rule.infix(canAssign)
+
+		if canAssign and self.match(TokenType.TOKEN_EQUAL_EQUAL):
+			self.error("Invalid assignment target.")
+		return node
+
+	def expression(self):
+		return self.parsePrecedence(Precedence.PREC_ASSIGNMENT)
+
+	def isLiteral(self, node):
+		return type(node) is Literal
+
+	def binary(self, canAssign):
+		operatorType = self.parser.previous.type
+		rule = self.getRule(operatorType)
+		left = self.left
+		right = self.parsePrecedence(rule.precedence + 1)
+		line = self.parser.previous.line
+
+		# Evaluate operators with constant operands at compile time.
+		if self.isLiteral(left) and self.isLiteral(right):
+			value = self.foldBinary(operatorType, left.value, right.value)
+			if value != None:
+				return Literal(value, line)
+		return Binary(operatorType, left, right, line)
+
+	def unary(self, canAssign):
+		operatorType = self.parser.previous.type
+		operand = self.parsePrecedence(Precedence.PREC_UNARY)
+		line = self.parser.previous.line
+
+		# Evaluate operators with a constant operand at compile time.
+		if self.isLiteral(operand):
+			value = operand.value
+			if operatorType == TokenType.TOKEN_BANG:
+				return Literal(Value.BOOL_VAL(self.isFalsey(value)), line)
+			if operatorType == TokenType.TOKEN_MINUS and value.IS_NUMBER():
+				return Literal(Value.NUMBER_VAL(-float(value.AS_NUMBER())), line)
+		return Unary(operatorType, operand, line)
+
+	def logical(self, precedence, shortCircuitOn):
+		operatorType = self.parser.previous.type
+		left = self.left
+		line = self.parser.previous.line
+		right = self.parsePrecedence(precedence)
+		if self.isLiteral(left):
+			# The operator short circuits if the falseyness of the left
+			# operand is shortCircuitOn, then the right operand is dropped.
+			if self.isFalsey(left.value) == shortCircuitOn:
+				return left
+			return right
+		return Logical(operatorType, left, right, line)
+
+	def and_(self, canAssign):
+		return self.logical(Precedence.PREC_AND, True)
+
+	def or_(self, canAssign):
+		return self.logical(Precedence.PREC_OR, False)
+
+	def arguments(self):
+		args = []
+		if not self.check(TokenType.TOKEN_RIGHT_PAREN):
+			while True:
+				args.append(self.expression())
+				if len(args) == 256:
+					self.error("Can't have more than 255 arguments.")
+				if not self.match(TokenType.TOKEN_COMMA):
+					break
+		self.consume(TokenType.TOKEN_RIGHT_PAREN, "Expect ')' after arguments.")
+		return args
+
+	def call(self, canAssign):
+		callee = self.left
+		args = self.arguments()
+		return Call(callee, args, self.parser.previous.line)
+
+	def dot(self, canAssign):
+		object = self.left
+		self.consume(TokenType.TOKEN_IDENTIFIER, "Expect property name after '.'.")
+		name = self.parser.previous.start
+		if canAssign and self.match(TokenType.TOKEN_EQUAL):
+			value = self.expression()
+			return SetProperty(object, name, value, self.parser.previous.line)
+		elif self.match(TokenType.TOKEN_LEFT_PAREN):
+			args = self.arguments()
+			return Invoke(object, name, args, self.parser.previous.line)
+		return GetProperty(object, name, self.parser.previous.line)
+
+	def literal(self, canAssign):
+		operatorType = self.parser.previous.type
+		if operatorType == TokenType.TOKEN_FALSE:
+			value = Value.BOOL_VAL(False)
+		elif operatorType == TokenType.TOKEN_TRUE:
+			value = Value.BOOL_VAL(True)
+		else:
+			value = Value.NIL_VAL()
+		return Literal(value, self.parser.previous.line)
+
+	def grouping(self, canAssign):
+		node = self.expression()
+		self.consume(TokenType.TOKEN_RIGHT_PAREN, "Expect ')' after expression.")
+		return node
+
+	def number(self, canAssign):
+		value = float(self.parser.previous.start)
+		return Literal(Value.NUMBER_VAL(value), self.parser.previous.line)
+
+	def string(self, canAssign):
+		# Take string inside quotes
+		s = self.parser.previous.start[1 : -1]
+		return Literal(Value.OBJ_VAL(copyString(s)), self.parser.previous.line)
+
+	def namedVariable(self, name, canAssign):
+		arg = self.resolveLocal(name)
+		if arg != -1:
+			kind = VariableKind.LOCAL
+		else:
+			arg = self.resolveUpvalue(name)
+			if arg != -1:
+				kind = VariableKind.UPVALUE
+			else:
+				arg = self.globalSlot(name)
+				kind = VariableKind.GLOBAL
+
+		if canAssign and self.match(TokenType.TOKEN_EQUAL):
+			value = self.expression()
+			return Assign(kind, arg, value, self.parser.previous.line)
+		return Variable(kind, arg, self.parser.previous.line)
+
+	def variable(self, canAssign):
+		return self.namedVariable(self.parser.previous, canAssign)
+
+	def super_(self, canAssign):
+		if self.currentClass == None:
+			self.error("Can't use 'super' outside of a class.")
+
+		self.consume(TokenType.TOKEN_DOT, "Expect '.' after 'super'.")
+		self.consume(TokenType.TOKEN_IDENTIFIER, "Expect superclass method name.")
+		name = self.parser.previous.start
+		this = self.namedVariable(self.syntheticToken("this"), False)
+		superclass = self.namedVariable(self.syntheticToken("super"), False)
+		if self.match(TokenType.TOKEN_LEFT_PAREN):
+			args = self.arguments()
+			return SuperInvoke(name, this, superclass, args, self.parser.previous.line)
+		return Super(name, this, superclass, self.parser.previous.line)
+
+	def this_(self, canAssign):
+		if self.currentClass == None:
+			self.error("Can't use 'this' outside of a class.")
+			return None
+		return self.variable(False)
+
+	def endScope(self):
+		"""Leave a scope, returning its Locals in the order they are popped"""
+		self.current.scopeDepth -= 1
+
+		locals = []
+		while len(self.current.locals) > 0 and self.current.locals[-1].depth > self.current.scopeDepth:
+			locals.append(self.current.locals.pop())
+		return locals
+
+	def defineVariable(self, globalVar):
+		if self.current.scopeDepth > 0:
+			self.markInitialized()
+
+	def declare(self, globalVar, value):
+		"""Return the Var node defining a variable parsed by parseVariable()"""
+		slot = None
+		if self.current.scopeDepth == 0:
+			slot = globalVar
+		self.defineVariable(globalVar)
+		return Var(slot, value, self.parser.previous.line)
+
+	def block(self):
+		statements = []
+		while (not self.check(TokenType.TOKEN_RIGHT_BRACE) and
+			not self.check(TokenType.TOKEN_EOF)):
+			statements.append(self.declaration())
+		self.consume(TokenType.TOKEN_RIGHT_BRACE, "Expect '}' after block.")
+		return statements
+
+	def function(self, type):
+		compiler = IRCompiler(self, type)
+		compiler.parser = self.parser
+		compiler.scanner = self.scanner
+		compiler.beginScope()
+
+		compiler.consume(TokenType.TOKEN_LEFT_PAREN, "Expect '(' after function name.")
+
+		if not compiler.check(TokenType.TOKEN_RIGHT_PAREN):
+			while True:
+				compiler.current.function.arity += 1
+				if compiler.current.function.arity > 255:
+					compiler.errorAtCurrent("Can't have more than 255 parameters.")
+				constant = compiler.parseVariable("Expect parameter name.")
+				compiler.defineVariable(constant)
+				if not compiler.match(TokenType.TOKEN_COMMA):
+					break
+
+		compiler.consume(TokenType.TOKEN_RIGHT_PAREN, "Expect ')' after parameters.")
+		compiler.consume(TokenType.TOKEN_LEFT_BRACE, "Expect '{' before function body.")
+		body = compiler.block()
+		return Function(compiler.current, body, self.parser.previous.line)
+
+	def method(self):
+		self.consume(TokenType.TOKEN_IDENTIFIER, "Expect method name.")
+		name = self.parser.previous.start
+		type = FunctionType.TYPE_METHOD
+		if self.parser.previous.start == "init":
+			type = FunctionType.TYPE_INITIALIZER
+		function = self.function(type)
+		return Method(name, function, self.parser.previous.line)
+
+	def classDeclaration(self):
+		self.consume(TokenType.TOKEN_IDENTIFIER, "Expect class name.")
+		className = self.parser.previous
+		self.declareVariable()
+		globalVar = 0
+		if self.current.scopeDepth == 0:
+			globalVar = self.globalSlot(className)
+			node = Class(className.start, globalVar, self.parser.previous.line)
+		else:
+			node = Class(className.start, None, self.parser.previous.line)
+
+		self.defineVariable(globalVar)
+		enclosingCurrentClass = self.currentClass
+		hasSuperclass = False
+		self.currentClass = self
+
+		if self.match(TokenType.TOKEN_LESS):
+			self.consume(TokenType.TOKEN_IDENTIFIER, "Expect superclass name.")
+			node.superclass = self.variable(False)
+
+			if self.identifiersEqual(className, self.parser.previous):
+				self.error("A class can't inherit from itself.")
+
+			self.beginScope()
+			self.addLocal(self.syntheticToken("super"))
+			self.defineVariable(0)
+
+			node.inheritClass = self.namedVariable(className, False)
+			hasSuperclass = True
+
+		node.classVariable = self.namedVariable(className, False)
+
+		self.consume(TokenType.TOKEN_LEFT_BRACE, "Expect '{' before class body.")
+		while (not self.check(TokenType.TOKEN_RIGHT_BRACE) and
+			not self.check(TokenType.TOKEN_RIGHT_BRACE)):
+			node.methods.append(self.method())
+		self.consume(TokenType.TOKEN_RIGHT_BRACE, "Expect '}' after class body.")
+		node.endLine = self.parser.previous.line
+
+		if hasSuperclass:
+			node.locals = self.endScope()
+
+		self.currentClass = enclosingCurrentClass
+		return node
+
+	def funDeclaration(self):
+		globalVar = self.parseVariable("Expect function name.")
+		self.markInitialized()
+		function = self.function(FunctionType.TYPE_FUNCTION)
+		return self.declare(globalVar, function)
+
+	def expressionStatement(self):
+		expression = self.expression()
+		self.consume(TokenType.TOKEN_SEMICOLON, "Expect ';' after expression.")
+		return Expression(expression, self.parser.previous.line)
+
+	def forStatement(self):
+		self.beginScope()
+		self.consume(TokenType.TOKEN_LEFT_PAREN, "Expect '(' after 'for'.")
+		initializer = None
+		if self.match(TokenType.TOKEN_SEMICOLON):
+			# No initializer.
+			pass
+		elif self.match(TokenType.TOKEN_VAR):
+			initializer = self.varDeclaration()
+		else:
+			initializer = self.expressionStatement()
+		condition = None
+		line = self.parser.previous.line
+		if not self.match(TokenType.TOKEN_SEMICOLON):
+			condition = self.expression()
+			self.consume(TokenType.TOKEN_SEMICOLON, "Expect ';' after loop condition.")
+			line = self.parser.previous.line
+
+		increment = None
+		incrementLines = None
+		if not self.match(TokenType.TOKEN_RIGHT_PAREN):
+			jumpLine = self.parser.previous.line
+			increment = self.expression()
+			popLine = self.parser.previous.line
+			self.consume(TokenType.TOKEN_RIGHT_PAREN, "Expect ')' after for clauses.")
+			incrementLines = (jumpLine, popLine, self.parser.previous.line)
+
+		body = self.statement()
+		loopLine = self.parser.previous.line
+		locals = self.endScope()
+		return For(initializer, condition, increment, body, locals, line, incrementLines, loopLine)
+
+	def ifStatement(self):
+		self.consume(TokenType.TOKEN_LEFT_PAREN, "Expect '(' after 'if'.")
+		condition = self.expression()
+		self.consume(TokenType.TOKEN_RIGHT_PAREN, "Expect ')' after condition.")
+		line = self.parser.previous.line
+		thenBranch = self.statement()
+		elseLine = self.parser.previous.line
+		elseBranch = None
+		if (self.match(TokenType.TOKEN_ELSE)):
+			elseBranch = self.statement()
+		return If(condition, thenBranch, elseBranch, line, elseLine)
+
+	def varDeclaration(self):
+		globalVar = self.parseVariable("Expect variable name.")
+
+		if self.match(TokenType.TOKEN_EQUAL):
+			value = self.expression()
+		else:
+			value = Literal(Value.NIL_VAL(), self.parser.previous.line)
+		self.consume(TokenType.TOKEN_SEMICOLON, "Expect ';' after variable declaration.")
+		return self.declare(globalVar, value)
+
+	def printStatement(self):
+		expression = self.expression()
+		self.consume(TokenType.TOKEN_SEMICOLON, "Expect ';' after value.")
+		return Print(expression, self.parser.previous.line)
+
+	def returnStatement(self):
+		if self.current.type == FunctionType.TYPE_SCRIPT:
+			self.error("Can't return from top-level code.")
+
+		if self.match(TokenType.TOKEN_SEMICOLON):
+			return Return(None, self.parser.previous.line)
+		if self.current.type == FunctionType.TYPE_INITIALIZER:
+			self.error("Can't return a value from an initializer.")
+
+		value = self.expression()
+		self.consume(TokenType.TOKEN_SEMICOLON, "Expect ';' after return value.")
+		return Return(value, self.parser.previous.line)
+
+	def whileStatement(self):
+		self.consume(TokenType.TOKEN_LEFT_PAREN, "Expect '(' after 'while'.")
+		condition = self.expression()
+		self.consume(TokenType.TOKEN_RIGHT_PAREN, "Expect ')' after condition.")
+		line = self.parser.previous.line
+		body = self.statement()
+		return While(condition, body, line, self.parser.previous.line)
+
+	def declaration(self):
+		if self.match(TokenType.TOKEN_CLASS):
+			node = self.classDeclaration()
+		elif self.match(TokenType.TOKEN_FUN):
+			node = self.funDeclaration()
+		elif self.match(TokenType.TOKEN_VAR):
+			node = self.varDeclaration()
+		else:
+			node = self.statement()
+
+		if self.parser.panicMode:
+			self.synchronize()
+		return node
+
+	def statement(self):
+		if self.match(TokenType.TOKEN_PRINT):
+			return self.printStatement()
+		elif self.match(TokenType.TOKEN_FOR):
+			return self.forStatement()
+		elif self.match(TokenType.TOKEN_IF):
+			return self.ifStatement()
+		elif self.match(TokenType.TOKEN_RETURN):
+			return self.returnStatement()
+		elif self.match(TokenType.TOKEN_WHILE):
+			return self.whileStatement()
+		elif self.match(TokenType.TOKEN_LEFT_BRACE):
+			self.beginScope()
+			statements = self.block()
+			return Block(statements, self.endScope(), self.parser.previous.line)
+		return self.expressionStatement()
+
+	def compile(self, source):
+		self.scanner = Scanner()
+		self.scanner.initScanner(source)
+		self.current.type = type
+
+		self.parser.hadError = False
+		self.parser.panicMode = False
+
+		self.advance()
+
+		statements = []
+		while not self.match(TokenType.TOKEN_EOF):
+			statements.append(self.declaration())
+
+		if self.parser.hadError:
+			return None
+		return self.generate(Function(self.current, statements, self.parser.previous.line))
+
+	# Code generation from IR
+
+	def generate(self, node):
+		"""Emit the code of a Function node, returning its ObjFunction"""
+		enclosing = self.current
+		self.current = node.state
+		for statement in node.body:
+			self.generateStatement(statement)
+		self.line = node.line
+		function = self.endCompiler()
+		self.current = enclosing
+		return function
+
+	def nameConstant(self, name):
+		return self.makeConstant(Value.OBJ_VAL(copyString(name)))
+
+	def emitVariable(self, kind, index, assign):
+		if kind == VariableKind.GLOBAL:
+			if assign:
+				self.emitGlobal(OpCode.OP_SET_GLOBAL, index)
+			else:
+				self.emitGlobal(OpCode.OP_GET_GLOBAL, index)
+		elif kind == VariableKind.UPVALUE:
+			if assign:
+				self.emitBytes(OpCode.OP_SET_UPVALUE, index)
+			else:
+				self.emitBytes(OpCode.OP_GET_UPVALUE, index)
+		elif assign:
+			self.emitBytes(OpCode.OP_SET_LOCAL, index)
+		else:
+			self.emitBytes(OpCode.OP_GET_LOCAL, index)
+
+	def emitPops(self, locals):
+		for local in locals:
+			if local.isCaptured:
+				self.emitByte(OpCode.OP_CLOSE_UPVALUE)
+			else:
+				self.emitByte(OpCode.OP_POP)
+
+	BINARY_OPS = {
+		TokenType.TOKEN_BANG_EQUAL: OpCode.OP_NOT_EQUAL,
+		TokenType.TOKEN_EQUAL_EQUAL: OpCode.OP_EQUAL,
+		TokenType.TOKEN_GREATER: OpCode.OP_GREATER,
+		TokenType.TOKEN_GREATER_EQUAL: OpCode.OP_GREATER_EQUAL,
+		TokenType.TOKEN_LESS: OpCode.OP_LESS,
+		TokenType.TOKEN_LESS_EQUAL: OpCode.OP_LESS_EQUAL,
+		TokenType.TOKEN_PLUS: OpCode.OP_ADD,
+		TokenType.TOKEN_MINUS: OpCode.OP_SUBTRACT,
+		TokenType.TOKEN_STAR: OpCode.OP_MULTIPLY,
+		TokenType.TOKEN_SLASH: OpCode.OP_DIVIDE,
+	}
+
+	def generateExpression(self, node):
+		kind = type(node)
+		if kind is Literal:
+			self.line = node.line
+			chunk = self.currentChunk()
+			self.emitFolded(len(chunk.code), chunk.constants.len(), node.value)
+		elif kind is Variable:
+			self.line = node.line
+			self.emitVariable(node.kind, node.index, False)
+		elif kind is Assign:
+			self.generateExpression(node.value)
+			self.line = node.line
+			self.emitVariable(node.kind, node.index, True)
+		elif kind is GetProperty:
+			self.generateExpression(node.object)
+			self.line = node.line
+			self.emitWithConstant(OpCode.OP_GET_PROPERTY, self.nameConstant(node.name))
+		elif kind is SetProperty:
+			# Names are added to the constants where the source has them,
+			# as the direct compiler does.
+			self.generateExpression(node.object)
+			name = self.nameConstant(node.name)
+			self.generateExpression(node.value)
+			self.line = node.line
+			self.emitWithConstant(OpCode.OP_SET_PROPERTY, name)
+		elif kind is Invoke:
+			self.generateExpression(node.object)
+			name = self.nameConstant(node.name)
+			for argument in node.arguments:
+				self.generateExpression(argument)
+			self.line = node.line
+			self.emitWithConstant(OpCode.OP_INVOKE, name)
+			self.emitByte(len(node.arguments))
+		elif kind is Super:
+			name = self.nameConstant(node.name)
+			self.generateExpression(node.this)
+			self.generateExpression(node.superclass)
+			self.line = node.line
+			self.emitWithConstant(OpCode.OP_GET_SUPER, name)
+		elif kind is SuperInvoke:
+			name = self.nameConstant(node.name)
+			self.generateExpression(node.this)
+			for argument in node.arguments:
+				self.generateExpression(argument)
+			self.generateExpression(node.superclass)
+			self.line = node.line
+			self.emitWithConstant(OpCode.OP_SUPER_INVOKE, name)
+			self.emitByte(len(node.arguments))
+		elif kind is Call:
+			self.generateExpression(node.callee)
+			for argument in node.arguments:
+				self.generateExpression(argument)
+			self.line = node.line
+			self.emitBytes(OpCode.OP_CALL, len(node.arguments))
+		elif kind is Unary:
+			self.generateExpression(node.operand)
+			self.line = node.line
+			if node.operator == TokenType.TOKEN_BANG:
+				self.emitByte(OpCode.OP_NOT)
+			else:
+				self.emitByte(OpCode.OP_NEGATE)
+		elif kind is Binary:
+			self.generateExpression(node.left)
+			self.generateExpression(node.right)
+			self.line = node.line
+			self.emitByte(self.BINARY_OPS[node.operator])
+		elif kind is Logical:
+			self.generateLogical(node)
+		elif kind is Function:
+			self.generateClosure(node)
+
+	def generateLogical(self, node):
+		self.generateExpression(node.left)
+		self.line = node.line
+		if node.operator == TokenType.TOKEN_AND:
+			endJump = self.emitJump(OpCode.OP_JUMP_IF_FALSE)
+			self.emitByte(OpCode.OP_POP)
+			self.generateExpression(node.right)
+			self.patchJump(endJump)
+		else:
+			elseJump = self.emitJump(OpCode.OP_JUMP_IF_FALSE)
+			endJump = self.emitJump(OpCode.OP_JUMP)
+			self.patchJump(elseJump)
+			self.emitByte(OpCode.OP_POP)
+			self.generateExpression(node.right)
+			self.patchJump(endJump)
+
+	def generateClosure(self, node):
+		function = self.generate(node)
+		self.line = node.line
+		self.emitWithConstant(OpCode.OP_CLOSURE, self.makeConstant(Value.OBJ_VAL(function)))
+		for upvalue in function.upvalues:
+			if upvalue.isLocal:
+				self.emitByte(1)
+			else:
+				self.emitByte(0)
+			self.emitByte(upvalue.index)
+
+	def generateStatement(self, node):
+		kind = type(node)
+		if kind is Expression:
+			self.generateExpression(node.expression)
+			self.line = node.line
+			self.emitByte(OpCode.OP_POP)
+		elif kind is Print:
+			self.generateExpression(node.expression)
+			self.line = node.line
+			self.emitByte(OpCode.OP_PRINT)
+		elif kind is Var:
+			self.generateExpression(node.value)
+			if node.slot != None:
+				self.line = node.line
+				self.emitGlobal(OpCode.OP_DEFINE_GLOBAL, node.slot)
+		elif kind is Return:
+			if node.value != None:
+				self.generateExpression(node.value)
+			self.line = node.line
+			self.emitByte(OpCode.OP_RETURN)
+		elif kind is Block:
+			for statement in node.statements:
+				self.generateStatement(statement)
+			self.line = node.line
+			self.emitPops(node.locals)
+		elif kind is If:
+			self.generateIf(node)
+		elif kind is While:
+			self.generateWhile(node)
+		elif kind is For:
+			self.generateFor(node)
+		elif kind is Class:
+			self.generateClass(node)
+
+	def generateIf(self, node):
+		self.generateExpression(node.condition)
+		self.line = node.line
+		thenJump = self.emitJump(OpCode.OP_JUMP_IF_FALSE)
+		self.emitByte(OpCode.OP_POP)
+		self.generateStatement(node.thenBranch)
+
+		self.line = node.elseLine
+		elseJump = self.emitJump(OpCode.OP_JUMP)
+
+		self.patchJump(thenJump)
+		self.emitByte(OpCode.OP_POP)
+		if node.elseBranch != None:
+			self.generateStatement(node.elseBranch)
+		self.patchJump(elseJump)
+
+	def generateWhile(self, node):
+		loopStart = len(self.currentChunk().code)
+		self.generateExpression(node.condition)
+		self.line = node.line
+		exitJump = self.emitJump(OpCode.OP_JUMP_IF_FALSE)
+		self.emitByte(OpCode.OP_POP)
+		self.generateStatement(node.body)
+		self.line = node.loopLine
+		self.emitLoop(loopStart)
+		self.patchJump(exitJump)
+		self.emitByte(OpCode.OP_POP)
+
+	def generateFor(self, node):
+		if node.initializer != None:
+			self.generateStatement(node.initializer)
+		loopStart = len(self.currentChunk().code)
+		exitJump = -1
+		if node.condition != None:
+			self.generateExpression(node.condition)
+			self.line = node.line
+			# Jump out of the loop if the condition is false.
+			exitJump = self.emitJump(OpCode.OP_JUMP_IF_FALSE)
+			self.emitByte(OpCode.OP_POP) # Condition.
+
+		if node.increment != None:
+			jumpLine, popLine, loopLine = node.incrementLines
+			self.line = jumpLine
+			bodyJump = self.emitJump(OpCode.OP_JUMP)
+			incrementStart = len(self.currentChunk().code)
+			self.generateExpression(node.increment)
+			self.line = popLine
+			self.emitByte(OpCode.OP_POP)
+			self.line = loopLine
+			self.emitLoop(loopStart)
+			loopStart = incrementStart
+			self.patchJump(bodyJump)
+
+		self.generateStatement(node.body)
+		self.line = node.loopLine
+		self.emitLoop(loopStart)
+		if exitJump != -1:
+			self.patchJump(exitJump)
+			self.emitByte(OpCode.OP_POP) # Condition.
+		self.emitPops(node.locals)
+
+	def generateClass(self, node):
+		self.line = node.line
+		self.emitWithConstant(OpCode.OP_CLASS, self.nameConstant(node.name))
+		if node.slot != None:
+			self.emitGlobal(OpCode.OP_DEFINE_GLOBAL, node.slot)
+
+		if node.superclass != None:
+			self.generateExpression(node.superclass)
+			self.generateExpression(node.inheritClass)
+			self.emitByte(OpCode.OP_INHERIT)
+
+		self.generateExpression(node.classVariable)
+		for method in node.methods:
+			name = self.nameConstant(method.name)
+			self.generateClosure(method.function)
+			self.line = method.line
+			self.emitWithConstant(OpCode.OP_METHOD, name)
+		self.line = node.endLine
+		self.emitByte(OpCode.OP_POP)
+		self.emitPops(node.locals)
@@ -1,4 +1,5 @@
 from vm import *
+from cache import *
 import sys
 import argparse
 
@@ -26,7 +27,15 @@ def readFile(path):
 
 def runFile(path):
 	source = readFile(path)
-	result = vm.interpret(source)
+	if args.no_cache or Compiler.DEBUG_PRINT_CODE == 1:
+		# Always compile, so compiled code can be printed.
+		result = vm.interpret(source)
+	else:
+		function = BytecodeCache().compile(path, source, vm.globals, args.rebuild_cache)
+		if function == None:
+			result = InterpretResult.INTERPRET_COMPILE_ERROR
+		else:
+			result = vm.interpretFunction(function)
 	if (result == InterpretResult.INTERPRET_COMPILE_ERROR):
 		return(65)
 	if (result == InterpretResult.INTERPRET_RUNTIME_ERROR):
@@ -36,14 +45,46 @@ parser = argparse.ArgumentParser(description='Run lox compiler and VM.')
 parser.add_argument('filename')
 parser.add_argument('--debug-print-code', help='Print instructions generated by compiler', action='store_true')
 parser.add_argument('--debug-trace-execution', help='Print stack as VM runs', action='store_true')
+parser.add_argument('--no-cache', help='Do not read or write compiled .loxc file', action='store_true')
+parser.add_argument('--rebuild-cache', help='Compile script and overwrite compiled .loxc file', action='store_true')
+parser.add_argument('--optimize', help='Run peephole optimizer on compiled instructions', action='store_true')
+parser.add_argument('--no-superinstructions', help='Do not combine common instruction sequences into one instruction', action='store_true')
+parser.add_argument('--no-tail-calls', help='Do not call functions in the frame of the caller for return f()', action='store_true')
+parser.add_argument('--ir', help='Compile through an intermediate representation before emitting instructions', action='store_true')
+parser.add_argument('--debug-count-instructions', help='Print how often each instruction ran', action='store_true')
+parser.add_argument('--tier', help='Translate functions called or looping more than TIER times to Python', type=int, default=0)
+parser.add_argument('--debug-tiering', help='Print which functions were translated and the time saved', action='store_true')
+parser.add_argument('--engine', help='Interpreter loop used by VM', choices=['dispatch', 'switch', 'register', 'closure'], default='dispatch')
 args = parser.parse_args()
 
 if args.debug_print_code == True:
 	Compiler.DEBUG_PRINT_CODE = 1
 
+if args.optimize == True:
+	Compiler.OPTIMIZE = 1
+
+if args.no_superinstructions == True:
+	Compiler.SUPERINSTRUCTIONS = 0
+
+if args.no_tail_calls == True:
+	Compiler.TAIL_CALLS = 0
+
+if args.ir == True:
+	Compiler.USE_IR = 1
+
+if args.debug_count_instructions == True:
+	VM.debugCountInstructions = 1
+
 if args.debug_trace_execution == True:
 	VM.debugTraceExecution = 1
 
+VM.engine = args.engine
+
+VM.tierThreshold = args.tier
+
+if args.debug_tiering == True:
+	VM.debugTiering = 1
+
 if args.filename == '-':
 	repl()
 else:
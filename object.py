@@ -1,3 +1,4 @@
+import weakref
 from enum import IntEnum
 from value import *
 from chunk import *
@@ -14,6 +15,8 @@ class ObjType(IntEnum):
 	OBJ_UPVALUE = 7
 
 class Obj:
+	__slots__ = ('__type',)
+
 	def __init__(self, type):
 		self.__type = type
 
@@ -31,7 +34,24 @@ class ObjFunction(Obj):
 		super().__init__(ObjType.OBJ_FUNCTION)
 		self.arity = 0
 		self.upvalues = []
+		# (isLocal, index) of each upvalue, from getCaptures()
+		self.captures = None
 		self.chunk = Chunk()
+		# Most stack slots used by a call, counting the function and its
+		# arguments, from Chunk.maxStackDepth()
+		self.maxStack = 0
+		# Instructions pre-decoded from chunk by VM.decodeFunction()
+		self.decoded = None
+		# RegisterCode compiled from chunk by VM.compileRegisters()
+		self.registerCode = None
+		# ClosureCode compiled from chunk by ClosureCompiler
+		self.closureCode = None
+		# Calls and loop iterations counted by the VM for TierCompiler
+		self.callCount = 0
+		self.loopCount = 0
+		# Python function from TierCompiler, or False if it cannot be
+		# translated
+		self.tiered = None
 		self.__name = name
 
 	def __eq__(self, other):
@@ -45,6 +65,12 @@ class ObjFunction(Obj):
 	def getName(self):
 		return self.__name
 
+	def getCaptures(self):
+		"""Return tuple of (isLocal, index) for each upvalue, for OP_CLOSURE"""
+		if self.captures == None:
+			self.captures = tuple((u.isLocal, u.index) for u in self.upvalues)
+		return self.captures
+
 	def IS_FUNCTION(self):
 		return self.OBJ_TYPE() == ObjType.OBJ_FUNCTION
 
@@ -72,18 +98,16 @@ class ObjNative(Obj):
 		return self.__function
 
 class ObjString(Obj):
+	"""A string, made by copyString() so that each is only made once
+
+	As every string is interned, two strings are equal only if they are
+	the same ObjString, so the default identity comparison and hash are
+	used by dicts and ==.
+	"""
 	def __init__(self, str):
 		super().__init__(ObjType.OBJ_STRING)
 		self.__chars = str
 
-	def __eq__(self, other):
-		if isinstance(other, ObjString):
-			return self.__chars == other.__chars
-		return False
-
-	def __hash__(self):
-		return hash(self.__chars)
-
 	def IS_STRING(self):
 		return self.OBJ_TYPE() == ObjType.OBJ_STRING
 
@@ -97,12 +121,57 @@ class ObjString(Obj):
 		if self.OBJ_TYPE() == ObjType.OBJ_STRING:
 			print(self.AS_CSTRING(), end='')
 
+class StringTable:
+	"""The ObjString of each string in use, the clox vm.strings table
+
+	Entries are weak references, so strings no longer used are freed.
+	Entries of freed strings are removed when the table has doubled in
+	size, as clox removes them when collecting garbage.
+	"""
+	MIN_SWEEP = 1024
+
+	def __init__(self):
+		self.entries = {}
+		self.sweepAt = self.MIN_SWEEP
+
+	def copyString(self, chars):
+		"""Return the ObjString for chars, making it if there is none"""
+		ref = self.entries.get(chars)
+		if ref != None:
+			string = ref()
+			if string != None:
+				return string
+		string = ObjString(chars)
+		self.entries[chars] = weakref.ref(string)
+		if len(self.entries) > self.sweepAt:
+			self.removeFreed()
+		return string
+
+	def removeFreed(self):
+		freed = [chars for chars, ref in self.entries.items() if ref() == None]
+		for chars in freed:
+			del self.entries[chars]
+		self.sweepAt = max(self.MIN_SWEEP, 2 * len(self.entries))
+
+strings = StringTable()
+copyString = strings.copyString
+
+# Name of the method called to initialize new instances
+initString = copyString("init")
+
 class ObjUpvalue(Obj):
-	def __init__(self, slot):
+	"""A variable captured by closures, shared by all of them
+
+	The variable is values[location]. While the upvalue is open, values
+	is the VM stack, or the slots of a call for ClosureCompiler, and
+	location the slot of the variable. Closing it moves the value to a
+	list of its own, so it is read and written the same way either way.
+	"""
+	def __init__(self, values, location):
 		super().__init__(ObjType.OBJ_UPVALUE)
-		self.__chars = str
-		self.location = slot
-		self.closed = Value.NIL_VAL()
+		self.values = values
+		self.location = location
+		# Next open upvalue, further down the stack
 		self.next = None
 
 	def printObject(self):
@@ -128,10 +197,78 @@ class ObjClosure(Obj):
 		self.__function.printObject()
 
 class ObjClass(Obj):
+	"""A class, with its methods in a vtable
+
+	The index in the vtable of each method name is in selectors, which a
+	class without a superclass creates and its subclasses share, so the
+	vtables of a hierarchy hold one entry for each method name defined
+	in any of its classes and no more. Unrelated classes do not make each
+	other's vtables longer, and the entries go away with the classes.
+
+	A subclass shares the vtable of its superclass until either of them
+	defines a method, so classes that add no methods need no copy.
+	"""
 	def __init__(self, name):
 		super().__init__(ObjType.OBJ_CLASS)
 		self.__name = name
-		self.methods = Table()
+		# Index in vtable of each method name, shared by the hierarchy
+		self.selectors = {}
+		# Method for each index in selectors, or None
+		self.vtable = []
+		# Whether vtable is shared with a superclass or subclass
+		self.sharesVtable = False
+		# Incremented when methods change, to invalidate inline caches
+		self.version = 0
+		# The "init" method, or None, kept up to date by defineMethod()
+		# and inherit() so calls of the class need no lookup
+		self.initializer = None
+		# Shape of new instances, with no fields
+		self.rootShape = Shape()
+
+	def methodIndex(self, name):
+		"""Return the index in vtable of the method called name, or -1 if
+		the class has no such method"""
+		index = self.selectors.get(name)
+		if index == None or index >= len(self.vtable) or self.vtable[index] == None:
+			return -1
+		return index
+
+	def findMethod(self, name):
+		"""Return the method called name, or None if there is none"""
+		index = self.selectors.get(name)
+		if index == None or index >= len(self.vtable):
+			return None
+		return self.vtable[index]
+
+	def defineMethod(self, name, method):
+		if self.sharesVtable:
+			self.vtable = list(self.vtable)
+			self.sharesVtable = False
+		index = self.selectors.get(name)
+		if index == None:
+			# Subclasses defined later see the new name too, and classes
+			# of the hierarchy with shorter vtables do not have it.
+			index = len(self.selectors)
+			self.selectors[name] = index
+		if index >= len(self.vtable):
+			self.vtable.extend([None] * (index + 1 - len(self.vtable)))
+		self.vtable[index] = method
+		if name is initString:
+			self.initializer = method
+		self.version += 1
+
+	def inherit(self, superclass):
+		"""Take the methods of superclass, for OP_INHERIT
+
+		OP_INHERIT runs before the OP_METHOD instructions of the
+		subclass, so the subclass has no methods of its own yet.
+		"""
+		self.selectors = superclass.selectors
+		self.vtable = superclass.vtable
+		self.sharesVtable = True
+		superclass.sharesVtable = True
+		self.initializer = superclass.initializer
+		self.version += 1
 
 	def IS_CLASS(self):
 		return self.OBJ_TYPE() == ObjType.OBJ_CLASS
@@ -140,11 +277,57 @@ class ObjClass(Obj):
 		if self.OBJ_TYPE() == ObjType.OBJ_CLASS:
 			self.__name.printObject()
 
+class Shape:
+	"""Layout of the fields of instances, shared by instances of a class
+	that had the same fields added in the same order
+
+	fields maps each field name to the index of its value in
+	ObjInstance.slots. Adding a field moves an instance to the shape
+	reached by a transition from its current shape.
+	"""
+	def __init__(self, fields=None):
+		if fields == None:
+			fields = {}
+		self.fields = fields
+		self.transitions = {}
+
+	def addField(self, name):
+		"""Return shape with name added after the existing fields"""
+		shape = self.transitions.get(name)
+		if shape == None:
+			fields = dict(self.fields)
+			fields[name] = len(fields)
+			shape = Shape(fields)
+			self.transitions[name] = shape
+		return shape
+
+OBJ_INSTANCE = ObjType.OBJ_INSTANCE
+
 class ObjInstance(Obj):
+	__slots__ = ('klass', 'shape', 'slots')
+
 	def __init__(self, klass):
-		super().__init__(ObjType.OBJ_INSTANCE)
+		# Calls Obj.__init__() directly, as an instance is made for every
+		# call of a class.
+		Obj.__init__(self, OBJ_INSTANCE)
 		self.klass = klass
-		self.fields = Table()
+		self.shape = klass.rootShape
+		self.slots = []
+
+	def getField(self, name):
+		"""Return value of field, or UNDEFINED if there is no such field"""
+		offset = self.shape.fields.get(name)
+		if offset == None:
+			return UNDEFINED
+		return self.slots[offset]
+
+	def setField(self, name, value):
+		offset = self.shape.fields.get(name)
+		if offset == None:
+			self.shape = self.shape.addField(name)
+			self.slots.append(value)
+		else:
+			self.slots[offset] = value
 
 	def IS_INSTANCE(self):
 		return self.OBJ_TYPE() == ObjType.OBJ_INSTANCE
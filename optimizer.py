@@ -0,0 +1,363 @@
+from chunk import *
+
+class Instruction:
+	"""A decoded instruction of a chunk, used by the Optimizer"""
+	def __init__(self, op, operands, line):
+		self.op = op
+		# Operand bytes, except for jumps which have a target instead
+		self.operands = operands
+		self.line = line
+		# Instruction that a jump goes to
+		self.target = None
+		self.offset = 0
+		self.deleted = False
+
+class Optimizer:
+	"""Peephole optimizer for the bytecode in a chunk
+
+	The code is decoded to a list of instructions with jumps pointing to
+	the instruction they go to, which is then rewritten until no more
+	changes can be made:
+
+	* A jump to another unconditional jump goes to its target instead,
+	  and an OP_JUMP_IF_FALSE to another OP_JUMP_IF_FALSE goes to its
+	  target, since the value tested is the same.
+	* A jump to the next instruction is removed.
+	* OP_JUMP_IF_FALSE after a push of a constant that is not falsey
+	  never jumps and is removed.
+	* A push without side effects followed by OP_POP is removed.
+	* Instructions that no path through the code reaches, such as the
+	  OP_NIL OP_RETURN after an explicit return, are removed.
+
+	Then the code is encoded again, with the jump offsets and the line
+	of each byte updated.
+
+	fuse() uses the same decoding to replace common sequences of
+	instructions with a single superinstruction, and tailCalls() marks
+	the calls whose result is returned straight away.
+	"""
+
+	JUMPS = (OpCode.OP_JUMP, OpCode.OP_JUMP_IF_FALSE, OpCode.OP_LOOP) + tuple(Chunk.COMPARE_JUMPS.values())
+	PURE_PUSHES = (OpCode.OP_CONSTANT, OpCode.OP_CONSTANT_LONG, OpCode.OP_NIL, OpCode.OP_TRUE,
+		OpCode.OP_FALSE, OpCode.OP_GET_LOCAL, OpCode.OP_GET_UPVALUE)
+
+	def optimize(self, chunk):
+		"""Optimize code of chunk in place
+
+		Returns the number of instructions before and after optimizing.
+		"""
+		instructions = self.decode(chunk)
+		if instructions == None:
+			return (0, 0)
+		before = len(instructions)
+
+		rewrites = (self.threadJumps, self.removeUselessJumps,
+			self.removePushPop, self.removeUnreachable)
+		changed = True
+		while changed:
+			changed = False
+			for rewrite in rewrites:
+				if rewrite(instructions):
+					changed = True
+					instructions = [ins for ins in instructions if not ins.deleted]
+
+		if self.encode(chunk, instructions):
+			return (before, len(instructions))
+		return (before, before)
+
+	def fuse(self, chunk):
+		"""Replace sequences of instructions in chunk with superinstructions
+
+		A sequence is only replaced if no jump goes into the middle of it.
+		Returns the number of superinstructions in the chunk.
+		"""
+		instructions = self.decode(chunk)
+		if instructions == None:
+			return 0
+		# Jumps to each instruction, by id of the instruction
+		jumps = {}
+		for ins in instructions:
+			if ins.target != None:
+				jumps.setdefault(id(ins.target), []).append(ins)
+		position = {}
+		for i, ins in enumerate(instructions):
+			position[id(ins)] = i
+
+		result = []
+		count = 0
+		i = 0
+		while i < len(instructions):
+			ins = instructions[i]
+			fused = None
+			if not ins.deleted:
+				fused = self.superinstruction(instructions, i, jumps, position)
+			if fused == None:
+				if not ins.deleted:
+					result.append(ins)
+				i += 1
+				continue
+			replaced, sequence = fused
+			for jump in jumps.pop(id(ins), []):
+				jump.target = sequence[0]
+				jumps.setdefault(id(sequence[0]), []).append(jump)
+			result.extend(sequence)
+			i += replaced
+			count += 1
+		if self.encode(chunk, result):
+			return count
+		return 0
+
+	def tailCalls(self, chunk):
+		"""Replace each OP_CALL followed by OP_RETURN with OP_TAIL_CALL
+
+		The OP_RETURN is kept, for callees that the VM does not call in
+		the frame of the caller. Returns the number of tail calls.
+		"""
+		code = chunk.code
+		count = 0
+		offset = 0
+		while offset < len(code):
+			next = offset + chunk.instructionSize(offset)
+			if code[offset] == OpCode.OP_CALL and next < len(code) and code[next] == OpCode.OP_RETURN:
+				code[offset] = OpCode.OP_TAIL_CALL
+				count += 1
+			offset = next
+		return count
+
+	def superinstruction(self, instructions, i, jumps, position):
+		"""Match a sequence for a superinstruction at instruction i
+
+		Returns a tuple of the number of instructions replaced and the
+		instructions to replace them with, or None if there is no match.
+		"""
+		ins = instructions[i]
+		following = []
+		j = i + 1
+		while (j < len(instructions) and j < i + 3 and len(jumps.get(id(instructions[j]), [])) == 0 and
+			not instructions[j].deleted):
+			following.append(instructions[j])
+			j += 1
+		ops = [other.op for other in following]
+
+		if ins.op == OpCode.OP_GET_LOCAL and len(ops) == 2:
+			slot = ins.operands[0]
+			second = following[0]
+			if ops == [OpCode.OP_GET_LOCAL, OpCode.OP_ADD]:
+				return (3, [Instruction(OpCode.OP_ADD_LOCAL_LOCAL,
+					[slot, second.operands[0]], following[1].line)])
+			if ops == [OpCode.OP_CONSTANT, OpCode.OP_ADD]:
+				return (3, [Instruction(OpCode.OP_ADD_LOCAL_CONSTANT,
+					[slot, second.operands[0]], following[1].line)])
+			if ops == [OpCode.OP_CONSTANT, OpCode.OP_SUBTRACT]:
+				return (3, [Instruction(OpCode.OP_SUBTRACT_LOCAL_CONSTANT,
+					[slot, second.operands[0]], following[1].line)])
+
+		if ins.op in Chunk.COMPARE_JUMPS and ops == [OpCode.OP_JUMP_IF_FALSE, OpCode.OP_POP]:
+			# The comparison and the OP_POP of its result on both paths
+			# become a jump that pops the operands, if the OP_POP that the
+			# jump goes to can only be reached by this jump.
+			end = following[0].target
+			index = position[id(end)]
+			before = instructions[index - 1]
+			if (end.op == OpCode.OP_POP and len(jumps[id(end)]) == 1 and
+				(self.isUnconditionalJump(before) or before.op == OpCode.OP_RETURN)):
+				fused = Instruction(Chunk.COMPARE_JUMPS[ins.op], [], ins.line)
+				fused.target = instructions[index + 1]
+				jumps.setdefault(id(fused.target), []).append(fused)
+				del jumps[id(end)]
+				end.deleted = True
+				return (3, [fused])
+
+		if ins.op == OpCode.OP_SET_LOCAL and len(ops) > 0 and ops[0] == OpCode.OP_POP:
+			return (2, [Instruction(OpCode.OP_SET_LOCAL_POP, ins.operands, ins.line)])
+
+		if ins.op == OpCode.OP_GET_GLOBAL:
+			# The function is only looked up after the arguments are
+			# pushed, so they must not have side effects or fail.
+			j = i + 1
+			while (j < len(instructions) and len(jumps.get(id(instructions[j]), [])) == 0 and
+				instructions[j].op in self.PURE_PUSHES):
+				j += 1
+			if j < len(instructions) and len(jumps.get(id(instructions[j]), [])) == 0:
+				call = instructions[j]
+				if call.op == OpCode.OP_CALL and call.operands[0] == j - i - 1:
+					fused = Instruction(OpCode.OP_CALL_GLOBAL,
+						list(ins.operands) + list(call.operands), call.line)
+					return (j - i + 1, instructions[i + 1 : j] + [fused])
+		return None
+
+	def decode(self, chunk):
+		instructions = []
+		byOffset = {}
+		lines = chunk.getLines()
+		offset = 0
+		while offset < len(chunk.code):
+			op = chunk.code[offset]
+			size = chunk.instructionSize(offset)
+			ins = Instruction(op, list(chunk.code[offset + 1 : offset + size]), lines[offset])
+			ins.offset = offset
+			byOffset[offset] = ins
+			instructions.append(ins)
+			offset += size
+
+		for ins in instructions:
+			if ins.op in self.JUMPS:
+				jump = (ins.operands[0] << 8) | ins.operands[1]
+				if ins.op == OpCode.OP_LOOP:
+					target = ins.offset + 3 - jump
+				else:
+					target = ins.offset + 3 + jump
+				ins.target = byOffset.get(target)
+				if ins.target == None:
+					# Not code from the compiler, leave it alone.
+					return None
+				ins.operands = []
+		return instructions
+
+	def encode(self, chunk, instructions):
+		"""Write instructions back to chunk, returns False if a jump is too far"""
+		offset = 0
+		for ins in instructions:
+			ins.offset = offset
+			if ins.op in self.JUMPS:
+				offset += 3
+			else:
+				offset += 1 + len(ins.operands)
+
+		code = []
+		lines = []
+		for ins in instructions:
+			op = ins.op
+			operands = ins.operands
+			if op in self.JUMPS:
+				after = ins.offset + 3
+				if ins.target.offset >= after:
+					jump = ins.target.offset - after
+					if op == OpCode.OP_LOOP:
+						op = OpCode.OP_JUMP
+				elif self.isUnconditionalJump(ins):
+					jump = after - ins.target.offset
+					op = OpCode.OP_LOOP
+				else:
+					# Only OP_LOOP can jump backwards.
+					return False
+				if jump > 65535:
+					return False
+				operands = [(jump >> 8) & 0xff, jump & 0xff]
+			code.append(op)
+			code.extend(operands)
+			lines.extend([ins.line] * (1 + len(operands)))
+
+		chunk.code[:] = code
+		chunk.setLines(lines)
+		return True
+
+	def isUnconditionalJump(self, ins):
+		return ins.op == OpCode.OP_JUMP or ins.op == OpCode.OP_LOOP
+
+	def jumpTargets(self, instructions):
+		return set(id(ins.target) for ins in instructions if ins.target != None)
+
+	def threadJumps(self, instructions):
+		index = {}
+		for i, ins in enumerate(instructions):
+			index[id(ins)] = i
+
+		changed = False
+		for i, ins in enumerate(instructions):
+			if ins.target == None:
+				continue
+			target = ins.target
+			seen = set()
+			while id(target) not in seen:
+				seen.add(id(target))
+				if self.isUnconditionalJump(target):
+					next = target.target
+				elif ins.op == OpCode.OP_JUMP_IF_FALSE and target.op == OpCode.OP_JUMP_IF_FALSE:
+					next = target.target
+				else:
+					break
+				# Conditional jumps can only jump forwards.
+				if not self.isUnconditionalJump(ins) and index[id(next)] <= i:
+					break
+				target = next
+			if target is not ins.target:
+				ins.target = target
+				changed = True
+		return changed
+
+	def removeUselessJumps(self, instructions):
+		changed = False
+		targets = self.jumpTargets(instructions)
+		for i in range(len(instructions) - 1):
+			ins = instructions[i]
+			next = instructions[i + 1]
+			if ins.deleted or next.deleted:
+				continue
+			if ins.target is next and ins.op in (OpCode.OP_JUMP, OpCode.OP_JUMP_IF_FALSE, OpCode.OP_LOOP):
+				# Jumping to the next instruction does nothing.
+				self.delete(instructions, i)
+				changed = True
+			elif (ins.op in (OpCode.OP_CONSTANT, OpCode.OP_CONSTANT_LONG, OpCode.OP_TRUE) and
+				next.op == OpCode.OP_JUMP_IF_FALSE and id(next) not in targets):
+				# Numbers, strings and true are never falsey.
+				self.delete(instructions, i + 1)
+				changed = True
+		return changed
+
+	def removePushPop(self, instructions):
+		changed = False
+		targets = self.jumpTargets(instructions)
+		i = 0
+		while i < len(instructions) - 1:
+			ins = instructions[i]
+			next = instructions[i + 1]
+			if (ins.op in self.PURE_PUSHES and
+				next.op == OpCode.OP_POP and id(next) not in targets):
+				self.delete(instructions, i)
+				self.delete(instructions, i + 1)
+				changed = True
+				i += 2
+			else:
+				i += 1
+		return changed
+
+	def removeUnreachable(self, instructions):
+		index = {}
+		for i, ins in enumerate(instructions):
+			index[id(ins)] = i
+
+		reachable = [False] * len(instructions)
+		pending = [0]
+		while len(pending) > 0:
+			i = pending.pop()
+			if i >= len(instructions) or reachable[i]:
+				continue
+			reachable[i] = True
+			ins = instructions[i]
+			if ins.target != None:
+				pending.append(index[id(ins.target)])
+			if not self.isUnconditionalJump(ins) and ins.op != OpCode.OP_RETURN:
+				pending.append(i + 1)
+
+		changed = False
+		for i, ins in enumerate(instructions):
+			if not reachable[i] and not ins.deleted:
+				ins.deleted = True
+				changed = True
+		return changed
+
+	def delete(self, instructions, i):
+		"""Delete instruction i, jumps to it go to the instruction after it"""
+		ins = instructions[i]
+		ins.deleted = True
+		j = i + 1
+		while j < len(instructions) and instructions[j].deleted:
+			j += 1
+		if j < len(instructions):
+			next = instructions[j]
+		else:
+			next = None
+		for other in instructions:
+			if other.target is ins:
+				other.target = next
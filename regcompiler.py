@@ -0,0 +1,453 @@
+from enum import IntEnum
+from chunk import *
+from object import *
+
+class RegOp(IntEnum):
+	"""Register instruction opcodes
+
+	Operands named dst, src, a and b are registers, numbered from the
+	first stack slot of the call frame. The _K variants take a constant
+	value instead of a register as their last operand.
+	"""
+	MOVE = 1               # dst src
+	LOADK = 2              # dst value
+	GET_GLOBAL = 3         # dst slot
+	DEFINE_GLOBAL = 4      # slot src
+	SET_GLOBAL = 5         # slot src
+	GET_UPVALUE = 6        # dst index
+	SET_UPVALUE = 7        # index src
+	GET_PROPERTY = 8       # dst src name cache
+	SET_PROPERTY = 9       # instance name src cache
+	GET_SUPER = 10         # dst receiver superclass name cache
+	EQUAL = 11             # dst a b
+	NOT_EQUAL = 12         # dst a b
+	GREATER = 13           # dst a b
+	GREATER_EQUAL = 14     # dst a b
+	LESS = 15              # dst a b
+	LESS_EQUAL = 16        # dst a b
+	ADD = 17               # dst a b
+	ADD_K = 18             # dst a value
+	SUBTRACT = 19          # dst a b
+	SUBTRACT_K = 20        # dst a value
+	MULTIPLY = 21          # dst a b
+	MULTIPLY_K = 22        # dst a value
+	DIVIDE = 23            # dst a b
+	DIVIDE_K = 24          # dst a value
+	NOT = 25               # dst src
+	NEGATE = 26            # dst src
+	PRINT = 27             # src
+	JUMP = 28              # target
+	JUMP_IF_FALSE = 29     # src target
+	JUMP_IF_NOT_EQUAL = 30          # a b target
+	JUMP_IF_NOT_EQUAL_K = 31        # a value target
+	JUMP_IF_EQUAL = 32              # a b target
+	JUMP_IF_EQUAL_K = 33            # a value target
+	JUMP_IF_NOT_GREATER = 34        # a b target
+	JUMP_IF_NOT_GREATER_K = 35      # a value target
+	JUMP_IF_NOT_GREATER_EQUAL = 36  # a b target
+	JUMP_IF_NOT_GREATER_EQUAL_K = 37  # a value target
+	JUMP_IF_NOT_LESS = 38           # a b target
+	JUMP_IF_NOT_LESS_K = 39         # a value target
+	JUMP_IF_NOT_LESS_EQUAL = 40     # a b target
+	JUMP_IF_NOT_LESS_EQUAL_K = 41   # a value target
+	CALL = 42              # callee argCount
+	CALL_GLOBAL = 43       # callee slot argCount
+	INVOKE = 44            # receiver name argCount cache
+	SUPER_INVOKE = 45      # receiver superclass name argCount cache
+	CLOSURE = 46           # dst function captures
+	CLOSE_UPVALUE = 47     # src
+	RETURN = 48            # src
+	RETURN_K = 49          # value
+	CLASS = 50             # dst name
+	INHERIT = 51           # superclass subclass
+	METHOD = 52            # class method name
+	TAIL_CALL = 53         # callee argCount
+
+class RegisterCode:
+	"""Register instructions compiled from the bytecode of a function
+
+	Each instruction is a tuple of the RegOp, the offset in chunk.code
+	after the bytecode instruction it was compiled from (for the line
+	number of runtime errors) and the operands. Jump targets are indexes
+	into instructions.
+	"""
+
+	def __init__(self, chunk):
+		self.chunk = chunk
+		self.instructions = []
+		# Number of registers, so stack slots, used by a call frame
+		self.frameSize = 0
+		# Instructions with handlers, set by VM.compileRegisters()
+		self.decoded = None
+
+	def disassembleCode(self, name):
+		"""Print human readable representation of register instructions"""
+		print("===", name, "(registers) ===")
+		pc = 0
+		while pc < len(self.instructions):
+			self.disassembleInstruction(pc)
+			pc += 1
+
+	def disassembleInstruction(self, pc):
+		ins = self.instructions[pc]
+		line = self.chunk.getLine(ins[1] - 1)
+		operands = " ".join(self.formatOperand(operand) for operand in ins[2:])
+		print("{0:04d} {1:4d} {2:<28} {3}".format(pc, line, ins[0].name, operands))
+
+	def formatOperand(self, operand):
+		if type(operand) is float:
+			return "{0:g}".format(operand)
+		if type(operand) is ObjString:
+			return "'{0}'".format(operand.AS_STRING())
+		if operand is None:
+			return "nil"
+		if type(operand) is ObjFunction:
+			if operand.getName() == None:
+				return "<script>"
+			return "<fn {0}>".format(operand.getName().AS_STRING())
+		if type(operand) is list:
+			# Inline cache
+			return "[cache]"
+		if type(operand) is tuple:
+			return str(list(operand))
+		return str(operand).lower()
+
+class RegisterCompiler:
+	"""Compiles the stack bytecode of a function to register instructions
+
+	The stack slots of a call frame are used as registers: the locals of
+	a function are in the slots the compiler gave them and each value on
+	the stack during an expression is a temporary in the slot it would
+	have on the stack. The stack is simulated while compiling, and an
+	entry is only stored in its own slot when needed. Until then,
+	constants and locals pushed on the stack are used directly as
+	operands of the instruction that takes them off, so for example
+	"i = i + 1;" is a single ADD_K instruction instead of five stack
+	instructions.
+
+	Every entry is in its own slot at jumps, jump targets and calls, so
+	the stack of a call frame is the same as with the stack interpreter
+	there, and calls work the same way.
+	"""
+
+	# Entries in the simulated stack
+	REGISTER = 0
+	CONSTANT = 1
+
+	BINARY = {
+		OpCode.OP_EQUAL: RegOp.EQUAL,
+		OpCode.OP_NOT_EQUAL: RegOp.NOT_EQUAL,
+		OpCode.OP_GREATER: RegOp.GREATER,
+		OpCode.OP_GREATER_EQUAL: RegOp.GREATER_EQUAL,
+		OpCode.OP_LESS: RegOp.LESS,
+		OpCode.OP_LESS_EQUAL: RegOp.LESS_EQUAL,
+		OpCode.OP_ADD: RegOp.ADD,
+		OpCode.OP_SUBTRACT: RegOp.SUBTRACT,
+		OpCode.OP_MULTIPLY: RegOp.MULTIPLY,
+		OpCode.OP_DIVIDE: RegOp.DIVIDE,
+	}
+	# Binary operations with a variant taking a constant right operand
+	BINARY_K = {
+		RegOp.ADD: RegOp.ADD_K,
+		RegOp.SUBTRACT: RegOp.SUBTRACT_K,
+		RegOp.MULTIPLY: RegOp.MULTIPLY_K,
+		RegOp.DIVIDE: RegOp.DIVIDE_K,
+	}
+	COMPARE_JUMPS = {
+		OpCode.OP_JUMP_IF_NOT_EQUAL: (RegOp.JUMP_IF_NOT_EQUAL, RegOp.JUMP_IF_NOT_EQUAL_K),
+		OpCode.OP_JUMP_IF_EQUAL: (RegOp.JUMP_IF_EQUAL, RegOp.JUMP_IF_EQUAL_K),
+		OpCode.OP_JUMP_IF_NOT_GREATER: (RegOp.JUMP_IF_NOT_GREATER, RegOp.JUMP_IF_NOT_GREATER_K),
+		OpCode.OP_JUMP_IF_NOT_GREATER_EQUAL: (RegOp.JUMP_IF_NOT_GREATER_EQUAL,
+			RegOp.JUMP_IF_NOT_GREATER_EQUAL_K),
+		OpCode.OP_JUMP_IF_NOT_LESS: (RegOp.JUMP_IF_NOT_LESS, RegOp.JUMP_IF_NOT_LESS_K),
+		OpCode.OP_JUMP_IF_NOT_LESS_EQUAL: (RegOp.JUMP_IF_NOT_LESS_EQUAL,
+			RegOp.JUMP_IF_NOT_LESS_EQUAL_K),
+	}
+
+	# Instructions with a jump target as their last operand
+	JUMPS = frozenset([RegOp.JUMP, RegOp.JUMP_IF_FALSE] +
+		[op for pair in COMPARE_JUMPS.values() for op in pair])
+
+	def compile(self, function, newInlineCache):
+		"""Return RegisterCode for function
+
+		newInlineCache() is called for the inline cache of each property
+		and method instruction.
+		"""
+		chunk = function.chunk
+		code = chunk.code
+		constants = chunk.constants.rawValues()
+		self.result = RegisterCode(chunk)
+		self.out = []
+		# Slot 0 holds the function or receiver, followed by the arguments.
+		self.stack = [(self.REGISTER, slot) for slot in range(function.arity + 1)]
+		self.frameSize = len(self.stack)
+		# Index in self.out of the last instruction that stored a result
+		# in the slot of the entry on top of the stack
+		self.lastResult = -1
+
+		targets = set()
+		offset = 0
+		while offset < len(code):
+			target = chunk.jumpTarget(offset)
+			if target != None:
+				targets.add(target)
+			offset += chunk.instructionSize(offset)
+
+		# Stack depth at each instruction that can run
+		depths = chunk.liveDepths(len(self.stack))
+		# Index in self.out of the instruction at each jump target
+		labels = {}
+		offset = 0
+		while offset < len(code):
+			op = code[offset]
+			size = chunk.instructionSize(offset)
+			self.ip = offset + size
+			if offset not in depths:
+				# Never runs, like code after a return.
+				offset += size
+				continue
+			if offset in targets:
+				self.flush()
+				if depths[offset] != len(self.stack):
+					self.stack = [(self.REGISTER, slot) for slot in range(depths[offset])]
+				labels[offset] = len(self.out)
+				self.lastResult = -1
+
+			if op in (OpCode.OP_CONSTANT, OpCode.OP_CONSTANT_LONG):
+				self.push((self.CONSTANT, constants[chunk.constantIndex(offset)]))
+			elif op == OpCode.OP_NIL:
+				self.push((self.CONSTANT, None))
+			elif op == OpCode.OP_TRUE:
+				self.push((self.CONSTANT, True))
+			elif op == OpCode.OP_FALSE:
+				self.push((self.CONSTANT, False))
+			elif op == OpCode.OP_POP:
+				self.stack.pop()
+			elif op == OpCode.OP_GET_LOCAL:
+				self.getLocal(code[offset + 1])
+			elif op == OpCode.OP_SET_LOCAL:
+				self.setLocal(code[offset + 1])
+			elif op == OpCode.OP_SET_LOCAL_POP:
+				self.setLocal(code[offset + 1])
+				self.stack.pop()
+			elif op == OpCode.OP_GET_GLOBAL:
+				self.pushResult(RegOp.GET_GLOBAL, (code[offset + 1] << 8) | code[offset + 2])
+			elif op == OpCode.OP_DEFINE_GLOBAL:
+				self.emit(RegOp.DEFINE_GLOBAL, (code[offset + 1] << 8) | code[offset + 2],
+					self.register(len(self.stack) - 1))
+				self.stack.pop()
+			elif op == OpCode.OP_SET_GLOBAL:
+				self.emit(RegOp.SET_GLOBAL, (code[offset + 1] << 8) | code[offset + 2],
+					self.register(len(self.stack) - 1))
+			elif op == OpCode.OP_GET_UPVALUE:
+				self.pushResult(RegOp.GET_UPVALUE, code[offset + 1])
+			elif op == OpCode.OP_SET_UPVALUE:
+				self.emit(RegOp.SET_UPVALUE, code[offset + 1], self.register(len(self.stack) - 1))
+			elif op in (OpCode.OP_GET_PROPERTY, OpCode.OP_GET_PROPERTY_LONG):
+				instance = self.register(len(self.stack) - 1)
+				self.stack.pop()
+				self.pushResult(RegOp.GET_PROPERTY, instance,
+					constants[chunk.constantIndex(offset)], newInlineCache())
+			elif op in (OpCode.OP_SET_PROPERTY, OpCode.OP_SET_PROPERTY_LONG):
+				top = len(self.stack) - 1
+				instance = self.register(top - 1)
+				value = self.register(top)
+				self.emit(RegOp.SET_PROPERTY, instance, constants[chunk.constantIndex(offset)],
+					value, newInlineCache())
+				# The value is left on the stack in place of the instance.
+				entry = self.stack.pop()
+				self.stack.pop()
+				if entry[0] == self.REGISTER and entry[1] == top:
+					self.emit(RegOp.MOVE, top - 1, top)
+					entry = (self.REGISTER, top - 1)
+				self.stack.append(entry)
+			elif op in (OpCode.OP_GET_SUPER, OpCode.OP_GET_SUPER_LONG):
+				top = len(self.stack) - 1
+				receiver = self.register(top - 1)
+				superclass = self.register(top)
+				del self.stack[-2:]
+				self.pushResult(RegOp.GET_SUPER, receiver, superclass,
+					constants[chunk.constantIndex(offset)], newInlineCache())
+			elif op in self.BINARY:
+				self.binary(self.BINARY[op])
+			elif op == OpCode.OP_ADD_LOCAL_LOCAL:
+				self.getLocal(code[offset + 1])
+				self.getLocal(code[offset + 2])
+				self.binary(RegOp.ADD)
+			elif op == OpCode.OP_ADD_LOCAL_CONSTANT:
+				self.getLocal(code[offset + 1])
+				self.push((self.CONSTANT, constants[code[offset + 2]]))
+				self.binary(RegOp.ADD)
+			elif op == OpCode.OP_SUBTRACT_LOCAL_CONSTANT:
+				self.getLocal(code[offset + 1])
+				self.push((self.CONSTANT, constants[code[offset + 2]]))
+				self.binary(RegOp.SUBTRACT)
+			elif op in (OpCode.OP_NOT, OpCode.OP_NEGATE):
+				src = self.register(len(self.stack) - 1)
+				self.stack.pop()
+				if op == OpCode.OP_NOT:
+					self.pushResult(RegOp.NOT, src)
+				else:
+					self.pushResult(RegOp.NEGATE, src)
+			elif op == OpCode.OP_PRINT:
+				self.emit(RegOp.PRINT, self.register(len(self.stack) - 1))
+				self.stack.pop()
+			elif op in (OpCode.OP_JUMP, OpCode.OP_LOOP):
+				self.flush()
+				self.emit(RegOp.JUMP, chunk.jumpTarget(offset))
+			elif op == OpCode.OP_JUMP_IF_FALSE:
+				self.flush()
+				self.emit(RegOp.JUMP_IF_FALSE, len(self.stack) - 1, chunk.jumpTarget(offset))
+			elif op in self.COMPARE_JUMPS:
+				registerOp, constantOp = self.COMPARE_JUMPS[op]
+				top = len(self.stack) - 1
+				a = self.register(top - 1)
+				entry = self.stack[top]
+				if entry[0] == self.CONSTANT:
+					registerOp = constantOp
+				b = entry[1]
+				del self.stack[-2:]
+				self.flush()
+				self.emit(registerOp, a, b, chunk.jumpTarget(offset))
+			elif op in (OpCode.OP_CALL, OpCode.OP_TAIL_CALL):
+				argCount = code[offset + 1]
+				if op == OpCode.OP_TAIL_CALL:
+					self.call(RegOp.TAIL_CALL, len(self.stack) - argCount - 1, argCount)
+				else:
+					self.call(RegOp.CALL, len(self.stack) - argCount - 1, argCount)
+			elif op == OpCode.OP_CALL_GLOBAL:
+				# The arguments are pushed, the function is put below them.
+				argCount = code[offset + 3]
+				self.call(RegOp.CALL_GLOBAL, len(self.stack) - argCount,
+					(code[offset + 1] << 8) | code[offset + 2], argCount)
+			elif op in (OpCode.OP_INVOKE, OpCode.OP_INVOKE_LONG):
+				argCount = code[offset + size - 1]
+				name = constants[chunk.constantIndex(offset)]
+				self.call(RegOp.INVOKE, len(self.stack) - argCount - 1,
+					name, argCount, newInlineCache())
+			elif op in (OpCode.OP_SUPER_INVOKE, OpCode.OP_SUPER_INVOKE_LONG):
+				argCount = code[offset + size - 1]
+				name = constants[chunk.constantIndex(offset)]
+				self.call(RegOp.SUPER_INVOKE, len(self.stack) - argCount - 2,
+					len(self.stack) - 1, name, argCount, newInlineCache())
+			elif op in (OpCode.OP_CLOSURE, OpCode.OP_CLOSURE_LONG):
+				closureFunction = constants[chunk.constantIndex(offset)]
+				self.flush()
+				self.pushResult(RegOp.CLOSURE, closureFunction, closureFunction.getCaptures())
+			elif op == OpCode.OP_CLOSE_UPVALUE:
+				self.flush()
+				self.emit(RegOp.CLOSE_UPVALUE, len(self.stack) - 1)
+				self.stack.pop()
+			elif op == OpCode.OP_RETURN:
+				entry = self.stack[-1]
+				if entry[0] == self.CONSTANT:
+					self.emit(RegOp.RETURN_K, entry[1])
+				else:
+					self.emit(RegOp.RETURN, entry[1])
+				self.stack.pop()
+			elif op in (OpCode.OP_CLASS, OpCode.OP_CLASS_LONG):
+				self.pushResult(RegOp.CLASS, constants[chunk.constantIndex(offset)])
+			elif op == OpCode.OP_INHERIT:
+				top = len(self.stack) - 1
+				self.emit(RegOp.INHERIT, self.register(top - 1), self.register(top))
+				self.stack.pop()
+			elif op in (OpCode.OP_METHOD, OpCode.OP_METHOD_LONG):
+				top = len(self.stack) - 1
+				self.emit(RegOp.METHOD, self.register(top - 1), self.register(top),
+					constants[chunk.constantIndex(offset)])
+				self.stack.pop()
+			else:
+				raise ValueError("Unknown opcode {0}".format(op))
+			offset += size
+
+		# Replace jump target offsets with instruction indexes.
+		for ins in self.out:
+			if ins[0] in self.JUMPS:
+				ins[-1] = labels[ins[-1]]
+		self.result.instructions = [tuple(ins) for ins in self.out]
+		self.result.frameSize = self.frameSize
+		return self.result
+
+	def emit(self, op, *operands):
+		self.out.append([op, self.ip] + list(operands))
+
+	def push(self, entry):
+		self.stack.append(entry)
+		if len(self.stack) > self.frameSize:
+			self.frameSize = len(self.stack)
+
+	def pushResult(self, op, *operands):
+		"""Emit op storing its result in a new entry on top of the stack"""
+		dst = len(self.stack)
+		self.emit(op, dst, *operands)
+		self.push((self.REGISTER, dst))
+		self.lastResult = len(self.out) - 1
+
+	def store(self, slot):
+		"""Emit instruction that stores entry at slot in its own register"""
+		entry = self.stack[slot]
+		if entry[0] == self.CONSTANT:
+			self.emit(RegOp.LOADK, slot, entry[1])
+		elif entry[1] != slot:
+			self.emit(RegOp.MOVE, slot, entry[1])
+		self.stack[slot] = (self.REGISTER, slot)
+
+	def register(self, slot):
+		"""Return register holding entry at slot, storing it if needed"""
+		entry = self.stack[slot]
+		if entry[0] == self.CONSTANT:
+			self.store(slot)
+			return slot
+		return entry[1]
+
+	def flush(self):
+		"""Store every entry on the stack in its own register"""
+		for slot in range(len(self.stack)):
+			entry = self.stack[slot]
+			if entry[0] != self.REGISTER or entry[1] != slot:
+				self.store(slot)
+
+	def getLocal(self, slot):
+		if self.stack[slot] != (self.REGISTER, slot):
+			self.store(slot)
+		self.push((self.REGISTER, slot))
+
+	def setLocal(self, slot):
+		# Entries that still read the old value of the local need a copy.
+		top = len(self.stack) - 1
+		for i in range(slot + 1, top):
+			if self.stack[i] == (self.REGISTER, slot):
+				self.store(i)
+		entry = self.stack[top]
+		if entry == (self.REGISTER, slot):
+			return
+		if entry == (self.REGISTER, top) and self.lastResult == len(self.out) - 1:
+			# Store the result of the last instruction in the local directly.
+			self.out[-1][2] = slot
+		elif entry[0] == self.CONSTANT:
+			self.emit(RegOp.LOADK, slot, entry[1])
+		else:
+			self.emit(RegOp.MOVE, slot, entry[1])
+		self.stack[slot] = (self.REGISTER, slot)
+		if entry == (self.REGISTER, top):
+			self.stack[top] = (self.REGISTER, slot)
+
+	def binary(self, op):
+		top = len(self.stack) - 1
+		a = self.register(top - 1)
+		entry = self.stack[top]
+		if entry[0] == self.CONSTANT and op in self.BINARY_K:
+			op = self.BINARY_K[op]
+			b = entry[1]
+		else:
+			b = self.register(top)
+		del self.stack[-2:]
+		self.pushResult(op, a, b)
+
+	def call(self, op, slot, *operands):
+		"""Emit a call, the result replaces the stack entries from slot"""
+		self.flush()
+		self.emit(op, slot, *operands)
+		del self.stack[slot:]
+		self.push((self.REGISTER, slot))
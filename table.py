@@ -1,3 +1,7 @@
+# Marker for a variable or field that is not defined, because None is
+# used for the Lox nil value in the VM
+UNDEFINED = object()
+
 class Table:
 	"""Implements a hash table using a python dict"""
 	def __init__(self):
@@ -10,10 +14,9 @@ class Table:
 		for k in fromTable.__entries.keys():
 			self.__entries[k] = fromTable.__entries[k]
 
-	def get(self, key):
-		if key in self.__entries:
-			return self.__entries[key]
-		return None
+	def get(self, key, default=None):
+		"""Return value for key, or default if key is not in table"""
+		return self.__entries.get(key, default)
 
 	def set(self, key, value):
 		if key in self.__entries:
@@ -28,3 +31,27 @@ class Table:
 			self.__entries.pop(key)
 			return True
 		return False
+
+class GlobalTable:
+	"""Global variables stored in a list indexed by slot number
+
+	The compiler gives every global variable name a slot number, so the
+	VM finds a global variable by its index instead of looking up its
+	name. A slot holds UNDEFINED until the variable is defined. The same
+	GlobalTable is used for all code run by a VM, so names keep their
+	slot numbers between calls to VM.interpret().
+	"""
+	def __init__(self):
+		self.slots = {}
+		self.names = []
+		self.values = []
+
+	def slot(self, name):
+		"""Return slot number for name, adding an undefined slot if it is new"""
+		index = self.slots.get(name)
+		if index == None:
+			index = len(self.names)
+			self.slots[name] = index
+			self.names.append(name)
+			self.values.append(UNDEFINED)
+		return index
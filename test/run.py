@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+
+# Runs each .lox script in this directory with every engine and checks
+# that it prints what the .out file next to it says.
+
+options = [
+	["--engine", "dispatch"],
+	["--engine", "switch"],
+	["--engine", "register"],
+	["--engine", "closure"],
+	["--engine", "dispatch", "--tier", "2"],
+	["--engine", "register", "--tier", "2"],
+	["--engine", "closure", "--tier", "2"],
+	["--ir"],
+	["--optimize"],
+	["--no-superinstructions"],
+]
+
+here = os.path.dirname(os.path.abspath(__file__))
+mainPath = os.path.join(here, "..", "main.py")
+failed = 0
+for name in sorted(os.listdir(here)):
+	if not name.endswith(".lox"):
+		continue
+	path = os.path.join(here, name)
+	with open(path[:-4] + ".out") as f:
+		expected = f.read()
+	for option in options:
+		result = subprocess.run([sys.executable, mainPath, "--no-cache"] + option + [path],
+			stdout = subprocess.PIPE, stderr = subprocess.STDOUT, universal_newlines = True)
+		if result.stdout != expected:
+			print("FAIL %s %s" % (name, " ".join(option)))
+			print(result.stdout)
+			failed += 1
+print("%d failed" % failed)
+sys.exit(1 if failed else 0)
@@ -0,0 +1,512 @@
+import math
+import time
+from chunk import *
+from compiler import *
+from object import *
+from table import *
+
+class TierCompiler:
+	"""Translates the bytecode of hot functions to Python source
+
+	VM.call() counts the calls of each function and the OP_LOOP handler
+	counts loop iterations. When either count reaches VM.tierThreshold,
+	promote() translates the bytecode of the function to a Python
+	function compiled with exec(), which VM.call() then runs instead of
+	pushing a CallFrame for the interpreter. A function in a loop is
+	moved to the translated code at the next OP_LOOP.
+
+	Each stack slot of the function becomes a Python variable s0, s1, ...
+	and each instruction a few statements on them. Operations check the
+	types of operands they do not know, and instead of a runtime error
+	or anything the translation does not handle, the function continues
+	in the interpreter: a CallFrame at the instruction is made from the
+	variables and run until it returns. The interpreter then gives the
+	same results and runtime errors as it would have without translated
+	code. A function that leaves its translated code too often goes
+	back to being interpreted.
+
+	Translated functions keep a CallFrame in VM.frames for stack traces
+	and the frame limit, with ip set before each call.
+	"""
+
+	# Times a translated function can continue in the interpreter before
+	# it is no longer used
+	MAX_DEOPTS = 100
+
+	# Instructions that are not translated, functions using them stay in
+	# the interpreter
+	UNSUPPORTED = (OpCode.OP_SET_UPVALUE, OpCode.OP_CLOSURE, OpCode.OP_CLOSURE_LONG,
+		OpCode.OP_CLOSE_UPVALUE, OpCode.OP_CLASS, OpCode.OP_CLASS_LONG, OpCode.OP_INHERIT,
+		OpCode.OP_METHOD, OpCode.OP_METHOD_LONG)
+
+	COMPARISONS = {
+		OpCode.OP_GREATER: "{0} > {1}",
+		OpCode.OP_GREATER_EQUAL: "not ({0} < {1})",
+		OpCode.OP_LESS: "{0} < {1}",
+		OpCode.OP_LESS_EQUAL: "not ({0} > {1})",
+	}
+	ARITHMETIC = {
+		OpCode.OP_SUBTRACT: "{0} - {1}",
+		OpCode.OP_MULTIPLY: "{0} * {1}",
+		OpCode.OP_DIVIDE: "{0} / {1}",
+	}
+	# Condition of each compare-and-jump instruction for not jumping,
+	# and whether the operands must be numbers
+	COMPARE_JUMPS = {
+		OpCode.OP_JUMP_IF_NOT_EQUAL: ("type({0}) is type({1}) and {0} == {1}", False),
+		OpCode.OP_JUMP_IF_EQUAL: ("type({0}) is not type({1}) or {0} != {1}", False),
+		OpCode.OP_JUMP_IF_NOT_GREATER: ("{0} > {1}", True),
+		OpCode.OP_JUMP_IF_NOT_GREATER_EQUAL: ("not ({0} < {1})", True),
+		OpCode.OP_JUMP_IF_NOT_LESS: ("{0} < {1}", True),
+		OpCode.OP_JUMP_IF_NOT_LESS_EQUAL: ("not ({0} > {1})", True),
+	}
+
+	# Known types of values in the stack slots
+	NUMBER = 1
+	BOOL = 2
+
+	def __init__(self, vm):
+		self.vm = vm
+		# Name, reason, count and [calls, instructions, deopts] of each
+		# function promoted, None if it could not be translated
+		self.promoted = []
+		# Instructions run by the interpreter, time spent in translated code
+		# and time taken to translate, measured for VM.debugTiering
+		self.interpretedInstructions = 0
+		self.translatedTime = 0.0
+		self.translateTime = 0.0
+		# Calls of VM.runTiered() in progress
+		self.nesting = 0
+
+	def promote(self, function, reason, count):
+		"""Translate function, setting function.tiered to the result
+
+		function.tiered is False if the function cannot be translated.
+		"""
+		if function.getName() != None:
+			name = function.getName().AS_STRING()
+		else:
+			name = "script"
+		start = time.perf_counter()
+		stats = [0, 0, 0]
+		self.constants = []
+		self.counting = self.vm.debugTiering != 0
+		source = self.translate(function)
+		if source == None:
+			function.tiered = False
+			self.promoted.append((name, reason, count, None))
+			return
+		namespace = dict(self.vm.tierHelpers)
+		namespace["ObjClosure"] = ObjClosure
+		namespace["ObjInstance"] = ObjInstance
+		namespace["ObjString"] = ObjString
+		namespace["copyString"] = copyString
+		namespace["ObjBoundMethod"] = ObjBoundMethod
+		namespace["counts"] = stats
+		for i, value in enumerate(self.constants):
+			namespace["k{0}".format(i)] = value
+
+		vm = self.vm
+		frames = vm.frames
+		stack = vm.stack
+		maxDeopts = self.MAX_DEOPTS
+		def tailCall(frame, offset, values):
+			# The interpreter makes the call in the frame of the function.
+			frame.ip = offset
+			frame.firstSlotInStack = len(stack)
+			stack.extend(values)
+			return vm.runNested(len(frames) - 1)
+		def resume(frame, offset, values):
+			stats[2] += 1
+			if stats[2] == maxDeopts:
+				function.tiered = False
+			return tailCall(frame, offset, values)
+		namespace["resume"] = resume
+		namespace["tailCall"] = tailCall
+
+		exec(compile(source, "<lox {0}>".format(name), "exec"), namespace)
+		function.tiered = namespace["translated"]
+		self.promoted.append((name, reason, count, stats))
+		self.translateTime += time.perf_counter() - start
+		if Compiler.DEBUG_PRINT_CODE == 1:
+			print("=== {0} (translated) ===".format(name))
+			print(source)
+
+	def printReport(self, total):
+		"""Print the promoted functions and an estimate of the time saved
+
+		The time the interpreter would have taken for the instructions of
+		translated code is estimated from the average time per instruction
+		outside translated code.
+		"""
+		print("=== tiering ===")
+		translatedInstructions = 0
+		for name, reason, count, stats in self.promoted:
+			if stats == None:
+				print("{0}: not translated after {1} {2}".format(name, count, reason))
+				continue
+			print("{0}: translated after {1} {2}, {3} calls, {4} deopts".format(name, count, reason,
+				stats[0], stats[2]))
+			translatedInstructions += stats[1]
+		interpretedTime = total - self.translatedTime - self.translateTime
+		print("interpreted: {0} instructions in {1:.3f}s".format(self.interpretedInstructions,
+			interpretedTime))
+		print("translated: {0} instructions in {1:.3f}s, {2:.3f}s to translate".format(
+			translatedInstructions, self.translatedTime, self.translateTime))
+		if self.interpretedInstructions > 0:
+			estimate = translatedInstructions * interpretedTime / self.interpretedInstructions
+			print("estimated time saved: {0:.3f}s".format(estimate - self.translatedTime - self.translateTime))
+
+	def constant(self, value):
+		"""Return Python expression for a constant"""
+		if value is None or value is True or value is False:
+			return repr(value)
+		if type(value) is float and math.isfinite(value):
+			return repr(value)
+		for i, other in enumerate(self.constants):
+			if other is value:
+				return "k{0}".format(i)
+		self.constants.append(value)
+		return "k{0}".format(len(self.constants) - 1)
+
+	def translate(self, function):
+		"""Return Python source for function, or None if not supported"""
+		chunk = function.chunk
+		code = chunk.code
+		constants = chunk.constants.rawValues()
+
+		starts = set([0])
+		selfTailCall = False
+		offset = 0
+		while offset < len(code):
+			if code[offset] in self.UNSUPPORTED:
+				return None
+			target = chunk.jumpTarget(offset)
+			if target != None:
+				starts.add(target)
+			if code[offset] == OpCode.OP_TAIL_CALL and code[offset + 1] == function.arity:
+				selfTailCall = True
+			offset += chunk.instructionSize(offset)
+		# A tail call of the function itself jumps back to the start.
+		self.blocks = len(starts) > 1 or selfTailCall
+
+		self.lines = []
+		self.depth = function.arity + 1
+		self.maxDepth = self.depth
+		self.types = [None] * self.depth
+		self.segment = None
+		# Stack depth at each instruction that can run
+		depths = chunk.liveDepths(self.depth)
+		# Whether the last instruction translated goes on to the next one
+		fallsThrough = False
+		offset = 0
+		while offset < len(code):
+			op = code[offset]
+			size = chunk.instructionSize(offset)
+			next = offset + size
+			if offset not in depths:
+				# Never runs, like code after a return.
+				offset = next
+				continue
+			if offset in starts:
+				self.depth = depths[offset]
+				self.types = [None] * self.depth
+				self.endSegment()
+				if self.blocks:
+					if fallsThrough:
+						self.emit("pc = {0}".format(offset))
+					self.lines.append("\t\tif pc == {0}:".format(offset))
+			if self.counting and self.segment == None:
+				self.segment = [len(self.lines), 0]
+				self.emit("")
+			if self.segment != None:
+				self.segment[1] += 1
+			self.offset = offset
+			self.startDepth = self.depth
+
+			if op in (OpCode.OP_CONSTANT, OpCode.OP_CONSTANT_LONG):
+				self.pushConstant(constants[chunk.constantIndex(offset)])
+			elif op == OpCode.OP_NIL:
+				self.pushConstant(None)
+			elif op == OpCode.OP_TRUE:
+				self.pushConstant(True)
+			elif op == OpCode.OP_FALSE:
+				self.pushConstant(False)
+			elif op == OpCode.OP_POP:
+				self.pop(1)
+			elif op == OpCode.OP_GET_LOCAL:
+				self.getLocal(code[offset + 1])
+			elif op == OpCode.OP_SET_LOCAL:
+				self.setLocal(code[offset + 1])
+			elif op == OpCode.OP_SET_LOCAL_POP:
+				self.setLocal(code[offset + 1])
+				self.pop(1)
+			elif op == OpCode.OP_GET_GLOBAL:
+				slot = (code[offset + 1] << 8) | code[offset + 2]
+				top = self.push(None)
+				self.emit("{0} = globalValues[{1}]".format(top, slot))
+				self.guard("{0} is UNDEFINED".format(top))
+			elif op == OpCode.OP_DEFINE_GLOBAL:
+				slot = (code[offset + 1] << 8) | code[offset + 2]
+				self.emit("globalValues[{0}] = {1}".format(slot, self.slot(self.depth - 1)))
+				self.pop(1)
+			elif op == OpCode.OP_SET_GLOBAL:
+				slot = (code[offset + 1] << 8) | code[offset + 2]
+				self.guard("globalValues[{0}] is UNDEFINED".format(slot))
+				self.emit("globalValues[{0}] = {1}".format(slot, self.slot(self.depth - 1)))
+			elif op == OpCode.OP_GET_UPVALUE:
+				top = self.push(None)
+				self.emit("{0} = closure.upvalues[{1}]".format(top, code[offset + 1]))
+				self.emit("{0} = {0}.values[{0}.location]".format(top))
+			elif op in (OpCode.OP_GET_PROPERTY, OpCode.OP_GET_PROPERTY_LONG):
+				name = self.constant(constants[chunk.constantIndex(offset)])
+				instance = self.slot(self.depth - 1)
+				self.guard("type({0}) is not ObjInstance".format(instance))
+				self.emit("value = getField({0}, {1})".format(instance, name))
+				self.guard("value is UNDEFINED")
+				self.emit("{0} = value".format(instance))
+				self.types[-1] = None
+			elif op in (OpCode.OP_SET_PROPERTY, OpCode.OP_SET_PROPERTY_LONG):
+				name = self.constant(constants[chunk.constantIndex(offset)])
+				instance = self.slot(self.depth - 2)
+				value = self.slot(self.depth - 1)
+				self.guard("type({0}) is not ObjInstance".format(instance))
+				self.emit("{0}.setField({1}, {2})".format(instance, name, value))
+				self.emit("{0} = {1}".format(instance, value))
+				self.types[-2] = self.types[-1]
+				self.pop(1)
+			elif op in (OpCode.OP_GET_SUPER, OpCode.OP_GET_SUPER_LONG):
+				name = self.constant(constants[chunk.constantIndex(offset)])
+				receiver = self.slot(self.depth - 2)
+				self.emit("method = {0}.findMethod({1})".format(self.slot(self.depth - 1), name))
+				self.guard("method is None")
+				self.emit("{0} = ObjBoundMethod({0}, method)".format(receiver))
+				self.pop(1)
+				self.types[-1] = None
+			elif op in (OpCode.OP_EQUAL, OpCode.OP_NOT_EQUAL):
+				a = self.slot(self.depth - 2)
+				b = self.slot(self.depth - 1)
+				if op == OpCode.OP_EQUAL:
+					self.emit("{0} = type({0}) is type({1}) and {0} == {1}".format(a, b))
+				else:
+					self.emit("{0} = type({0}) is not type({1}) or {0} != {1}".format(a, b))
+				self.pop(1)
+				self.types[-1] = self.BOOL
+			elif op in self.COMPARISONS:
+				self.numberOperator(self.COMPARISONS[op], self.BOOL)
+			elif op in self.ARITHMETIC:
+				self.numberOperator(self.ARITHMETIC[op], self.NUMBER)
+			elif op == OpCode.OP_ADD:
+				self.add()
+			elif op == OpCode.OP_ADD_LOCAL_LOCAL:
+				self.getLocal(code[offset + 1])
+				self.getLocal(code[offset + 2])
+				self.add()
+			elif op == OpCode.OP_ADD_LOCAL_CONSTANT:
+				self.getLocal(code[offset + 1])
+				self.pushConstant(constants[code[offset + 2]])
+				self.add()
+			elif op == OpCode.OP_SUBTRACT_LOCAL_CONSTANT:
+				self.getLocal(code[offset + 1])
+				self.pushConstant(constants[code[offset + 2]])
+				self.numberOperator(self.ARITHMETIC[OpCode.OP_SUBTRACT], self.NUMBER)
+			elif op == OpCode.OP_NOT:
+				top = self.slot(self.depth - 1)
+				self.emit("{0} = {0} is None or {0} is False".format(top))
+				self.types[-1] = self.BOOL
+			elif op == OpCode.OP_NEGATE:
+				top = self.slot(self.depth - 1)
+				if self.types[-1] != self.NUMBER:
+					self.guard("type({0}) is not float".format(top))
+				self.emit("{0} = -{0}".format(top))
+				self.types[-1] = self.NUMBER
+			elif op == OpCode.OP_PRINT:
+				self.emit("printValue({0})".format(self.slot(self.depth - 1)))
+				self.pop(1)
+			elif op in (OpCode.OP_JUMP, OpCode.OP_LOOP):
+				self.jump(chunk.jumpTarget(offset))
+			elif op == OpCode.OP_JUMP_IF_FALSE:
+				target = chunk.jumpTarget(offset)
+				top = self.slot(self.depth - 1)
+				self.emit("if {0} is None or {0} is False:".format(top))
+				self.jump(target, 1)
+			elif op in self.COMPARE_JUMPS:
+				condition, numbers = self.COMPARE_JUMPS[op]
+				a = self.slot(self.depth - 2)
+				b = self.slot(self.depth - 1)
+				if numbers:
+					self.checkNumbers()
+				self.pop(2)
+				target = chunk.jumpTarget(offset)
+				self.emit("if not ({0}):".format(condition.format(a, b)))
+				self.jump(target, 1)
+			elif op == OpCode.OP_CALL:
+				argCount = code[offset + 1]
+				self.call(self.depth - argCount - 1, "call", argCount + 1, next)
+			elif op == OpCode.OP_TAIL_CALL:
+				argCount = code[offset + 1]
+				first = self.depth - argCount - 1
+				callee = self.slot(first)
+				if argCount == function.arity:
+					# Calling the function itself starts it again with the
+					# arguments.
+					parameters = [self.slot(i) for i in range(argCount + 1)]
+					values = [self.slot(i) for i in range(first, self.depth)]
+					self.emit("if {0} is closure:".format(callee))
+					self.emit("{0} = {1}".format(", ".join(parameters), ", ".join(values)), 1)
+					self.jump(0, 1)
+				# The interpreter calls other Lox functions in the frame of
+				# this one, and other callees are called as for OP_CALL.
+				self.emit("if type({0}) is ObjClosure or type({0}) is ObjBoundMethod:".format(callee))
+				self.emit(self.resume("tailCall"), 1)
+				self.call(first, "call", argCount + 1, next)
+			elif op == OpCode.OP_CALL_GLOBAL:
+				slot = (code[offset + 1] << 8) | code[offset + 2]
+				argCount = code[offset + 3]
+				self.emit("callee = globalValues[{0}]".format(slot))
+				self.guard("callee is UNDEFINED")
+				self.call(self.depth - argCount, "call", argCount, next, "callee")
+			elif op in (OpCode.OP_INVOKE, OpCode.OP_INVOKE_LONG):
+				argCount = code[next - 1]
+				name = self.constant(constants[chunk.constantIndex(offset)])
+				first = self.depth - argCount - 1
+				self.call(first, "invoke", argCount + 1, next, "{0}, {1}".format(self.slot(first), name),
+					1)
+			elif op in (OpCode.OP_SUPER_INVOKE, OpCode.OP_SUPER_INVOKE_LONG):
+				argCount = code[next - 1]
+				name = self.constant(constants[chunk.constantIndex(offset)])
+				receiver = self.depth - argCount - 2
+				arguments = [self.slot(i) for i in range(receiver, self.depth - 1)]
+				self.emit("frame.ip = {0}".format(next))
+				self.emit("{0} = superInvoke({1}, {2}, {3})".format(self.slot(receiver),
+					self.slot(self.depth - 1), name, ", ".join(arguments)))
+				self.pop(argCount + 1)
+				self.types[-1] = None
+			elif op == OpCode.OP_RETURN:
+				self.emit("frames.pop()")
+				self.emit("return {0}".format(self.slot(self.depth - 1)))
+				self.pop(1)
+				self.endSegment()
+			else:
+				return None
+			fallsThrough = op not in (OpCode.OP_RETURN, OpCode.OP_JUMP, OpCode.OP_LOOP)
+			offset = next
+		self.endSegment()
+
+		parameters = ", ".join(["s0"] + ["s{0}=None".format(i) for i in range(1, self.maxDepth)])
+		source = ["def translated(closure, pc, {0}):".format(parameters)]
+		if self.counting:
+			source.append("\tcounts[0] += 1")
+		source.append("\tframe = newFrame(closure)")
+		source.append("\tframes.append(frame)")
+		if self.blocks:
+			source.append("\twhile True:")
+		source.extend(self.lines)
+		return "\n".join(source) + "\n"
+
+	def emit(self, line, indent=0):
+		if self.blocks:
+			indent += 3
+		else:
+			indent += 1
+		self.lines.append("\t" * indent + line)
+
+	def endSegment(self):
+		"""Patch the count of instructions run since the last jump target"""
+		if self.segment != None:
+			index, count = self.segment
+			self.lines[index] = self.lines[index] + "counts[1] += {0}".format(count)
+			self.segment = None
+
+	def slot(self, index):
+		return "s{0}".format(index)
+
+	def push(self, kind):
+		name = self.slot(self.depth)
+		self.depth += 1
+		self.types.append(kind)
+		if self.depth > self.maxDepth:
+			self.maxDepth = self.depth
+		return name
+
+	def pop(self, count):
+		self.depth -= count
+		del self.types[len(self.types) - count:]
+
+	def guard(self, condition):
+		"""Continue in the interpreter at the current instruction if condition is true"""
+		self.emit("if {0}:".format(condition))
+		self.emit(self.resume(), 1)
+
+	def resume(self, helper="resume"):
+		"""Return statement continuing in the interpreter at the current instruction"""
+		values = [self.slot(i) for i in range(self.startDepth)]
+		if len(values) == 1:
+			return "return {0}(frame, {1}, ({2},))".format(helper, self.offset, values[0])
+		return "return {0}(frame, {1}, ({2}))".format(helper, self.offset, ", ".join(values))
+
+	def jump(self, target, indent=0):
+		self.endSegment()
+		self.emit("pc = {0}".format(target), indent)
+		self.emit("continue", indent)
+
+	def pushConstant(self, value):
+		kind = None
+		if type(value) is float:
+			kind = self.NUMBER
+		elif type(value) is bool:
+			kind = self.BOOL
+		top = self.push(kind)
+		self.emit("{0} = {1}".format(top, self.constant(value)))
+
+	def getLocal(self, index):
+		kind = self.types[index]
+		top = self.push(kind)
+		self.emit("{0} = {1}".format(top, self.slot(index)))
+
+	def setLocal(self, index):
+		self.emit("{0} = {1}".format(self.slot(index), self.slot(self.depth - 1)))
+		self.types[index] = self.types[-1]
+
+	def checkNumbers(self):
+		"""Guard that the top two values are numbers, unless already known"""
+		checks = []
+		for i in (self.depth - 2, self.depth - 1):
+			if self.types[i] != self.NUMBER:
+				checks.append("type({0}) is not float".format(self.slot(i)))
+		if len(checks) > 0:
+			self.guard(" or ".join(checks))
+
+	def numberOperator(self, expression, kind):
+		a = self.slot(self.depth - 2)
+		b = self.slot(self.depth - 1)
+		self.checkNumbers()
+		self.emit("{0} = {1}".format(a, expression.format(a, b)))
+		self.pop(1)
+		self.types[-1] = kind
+
+	def add(self):
+		a = self.slot(self.depth - 2)
+		b = self.slot(self.depth - 1)
+		if self.types[-2] == self.NUMBER and self.types[-1] == self.NUMBER:
+			self.emit("{0} = {0} + {1}".format(a, b))
+			self.pop(1)
+			return
+		self.emit("if type({0}) is float and type({1}) is float:".format(a, b))
+		self.emit("{0} = {0} + {1}".format(a, b), 1)
+		self.emit("elif type({0}) is ObjString and type({1}) is ObjString:".format(a, b))
+		self.emit("{0} = copyString({0}.AS_STRING() + {1}.AS_STRING())".format(a, b), 1)
+		self.emit("else:")
+		self.emit(self.resume(), 1)
+		self.pop(1)
+		self.types[-1] = None
+
+	def call(self, result, helper, count, next, first=None, skip=0):
+		"""Emit call of helper with the count values from the top of the stack"""
+		arguments = [self.slot(i) for i in range(self.depth - count + skip, self.depth)]
+		if first != None:
+			arguments.insert(0, first)
+		self.emit("frame.ip = {0}".format(next))
+		self.emit("{0} = {1}({2})".format(self.slot(result), helper, ", ".join(arguments)))
+		self.pop(self.depth - result)
+		self.push(None)
@@ -58,6 +58,16 @@ class Value:
 	def AS_OBJ(self):
 		return self.__obj
 
+	def unbox(self):
+		"""Return value as a plain python float, bool, None or Obj used by VM"""
+		if self.__type == ValueType.VAL_BOOL:
+			return self.__boolean
+		if self.__type == ValueType.VAL_NUMBER:
+			return float(self.__number)
+		if self.__type == ValueType.VAL_OBJ:
+			return self.__obj
+		return None
+
 	def valuesEqual(a, b):
 		if a.__type != b.__type:
 			return False
@@ -68,9 +78,8 @@ class Value:
 		if a.__type == ValueType.VAL_NUMBER:
 			return a.__number == b.__number
 		if a.__type == ValueType.VAL_OBJ:
-			aString = a.AS_OBJ().AS_STRING()
-			bString = b.AS_OBJ().AS_STRING()
-			return aString == bString
+			# Strings are interned, so equal strings are the same object.
+			return a.AS_OBJ() is b.AS_OBJ()
 		return False
 
 	def isObjType(self, objectType):
@@ -4,6 +4,7 @@ class ValueArray:
 
 	def __init__(self):
 		self.__values = []
+		self.__rawValues = None
 
 	def __getitem__(self, item):
 		"""Get constant from array by index"""
@@ -12,11 +13,24 @@ class ValueArray:
 	def writeValueArray(self, value):
 		"""Add a constant to array"""
 		self.__values.append(value)
+		self.__rawValues = None
+
+	def truncate(self, length):
+		"""Remove the constants from index length onwards"""
+		del self.__values[length:]
+		self.__rawValues = None
 
 	def clear(self):
 		"""Clear all constants"""
 		self.__values.clear()
+		self.__rawValues = None
 
 	def len(self):
 		"""Return number of contants in array"""
 		return len(self.__values)
+
+	def rawValues(self):
+		"""Return list of constants unboxed to plain python values for VM"""
+		if self.__rawValues == None:
+			self.__rawValues = [value.unbox() for value in self.__values]
+		return self.__rawValues
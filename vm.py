@@ -1,34 +1,33 @@
 from enum import IntEnum
 from chunk import *
 from compiler import *
+from ircompiler import *
 from value import *
 from table import *
 from object import *
+from regcompiler import *
+from closurecompiler import *
+from tier import *
 import time
 
 class CallFrame:
 	"""A CallFrame represents a single ongoing function call"""
-	def __init__(self):
-		self.closure = ObjClosure(ObjFunction(None))
+	__slots__ = ("closure", "ip", "pc", "stack", "firstSlotInStack")
+
+	def __init__(self, closure, stack, firstSlotInStack):
+		self.closure = closure
 		self.ip = 0
-		self.stack = []
+		# index of next register instruction, used by the register engine
+		self.pc = 0
+		self.stack = stack
 		# index of first slot in self.stack for this call frame
-		self.firstSlotInStack = 0
+		self.firstSlotInStack = firstSlotInStack
 
 	def getSlot(self, index):
-		i = self.firstSlotInStack + index
-		if i >= 0:
-			return self.stack[i]
-		else:
-			print("Stack index {0} out of bounds".format(i), file=sys.stderr)
-			return None
+		return self.stack[self.firstSlotInStack + index]
 
 	def setSlot(self, index, value):
-		i = self.firstSlotInStack + index
-		if i >= 0:
-			self.stack[i] = value
-		else:
-			print("Stack index {0} out of bounds".format(i), file=sys.stderr)
+		self.stack[self.firstSlotInStack + index] = value
 
 class InterpretResult(IntEnum):
 	"""Possible results of interpreting chunk of bytecode"""
@@ -36,34 +35,78 @@ class InterpretResult(IntEnum):
 	INTERPRET_COMPILE_ERROR = 2
 	INTERPRET_RUNTIME_ERROR = 3
 
+class VMExit(Exception):
+	"""Raised by a dispatch handler to leave the run loop with a result"""
+	def __init__(self, result):
+		self.result = result
+
 class VM:
-	"""A virtual machine for executing chunks of bytecode"""
+	"""A virtual machine for executing chunks of bytecode
+
+	Values on the VM stack are not boxed in Value objects: Lox numbers,
+	booleans and nil are python float, bool and None and heap objects
+	are the Obj subclasses themselves.
+	"""
 
 	debugTraceExecution = 0
+	# Count how many times each opcode runs, printed when a script ends
+	debugCountInstructions = 0
+
+	# Interpreter loop used to run bytecode: "dispatch" looks up a handler
+	# function by opcode, "switch" is the original if/elif chain in run()
+	# and "register" runs the code from RegisterCompiler in runRegister().
+	# "closure" runs the Python closures from ClosureCompiler instead of
+	# interpreting bytecode.
+	engine = "dispatch"
+
+	# Calls or loop iterations after which a function is translated to
+	# Python by TierCompiler, 0 to never translate
+	tierThreshold = 0
+
+	# Most values on the stack for all calls, 64 frames of up to 256
+	# slots as in clox
+	STACK_MAX = 64 * 256
+	# Print which functions were translated and the time saved
+	debugTiering = 0
 
 	def __init__(self):
 		self.initVm()
 
 	def clockNative(self, argCount, args):
 		"""Return elapsed processor time in seconds"""
-		return Value.NUMBER_VAL(time.process_time())
+		return time.process_time()
 
 	def initVm(self):
 		"""Setup empty virtual machine"""
-		self.resetStack()
-		self.globals = Table()
-		self.initString = "init"
+		# A list grown with append() and pop(). A list of STACK_MAX slots
+		# with a top index was no faster in CPython 3.11 and needs the
+		# index kept in every engine. The stack cannot go past STACK_MAX
+		# either way, as call() checks ObjFunction.maxStack.
+		self.stack = []
+		self.frames = []
+		# Frames of calls that returned, reused by call()
+		self.framePool = []
+		# Upvalues of variables still on the stack, from captureUpvalue()
+		self.openUpvalues = None
+		self.globals = GlobalTable()
+		self.instructionCounts = {}
 		self.defineNative("clock", self.clockNative)
+		self.initDispatch()
+		self.tierCompiler = TierCompiler(self)
+		self.initRegister()
+		self.closureCompiler = ClosureCompiler(self)
 
 	def resetStack(self):
-		self.stack = []
-		self.frames = []
+		# Emptied in place, as the dispatch handlers hold on to these lists.
+		del self.stack[:]
+		del self.frames[:]
+		self.openUpvalues = None
 
 	def runtimeError(self, message):
 		print(message, file=sys.stderr)
 		frame = self.frames[-1]
 		instruction = frame.ip - 1
-		line = frame.closure.AS_CLOSURE().chunk.lines[instruction]
+		line = frame.closure.AS_CLOSURE().chunk.getLine(instruction)
 		print("[line {0}] in script".format(line), file=sys.stderr)
 
 		i = len(self.frames) - 1
@@ -71,7 +114,7 @@ class VM:
 			frame = self.frames[i]
 			closure = frame.closure
 			instruction = frame.ip
-			print("[line {0}] in ".format(closure.AS_CLOSURE().chunk.lines[instruction]), file=sys.stderr, end='')
+			print("[line {0}] in ".format(closure.AS_CLOSURE().chunk.getLine(instruction)), file=sys.stderr, end='')
 			if closure.AS_CLOSURE().getName() == None:
 				print("script", file=sys.stderr)
 			else:
@@ -80,11 +123,7 @@ class VM:
 		self.resetStack()
 
 	def defineNative(self, name, function):
-		self.push(ObjString(name))
-		self.push(Value.OBJ_VAL(ObjNative(function)))
-		self.globals.set(self.peek(1), self.peek(0))
-		self.pop()
-		self.pop()
+		self.globals.values[self.globals.slot(name)] = ObjNative(function)
 
 	def freeVm(self):
 		"""Free memory used by virtual machine"""
@@ -92,57 +131,101 @@ class VM:
 
 	def interpret(self, source):
 		"""Interpret lox source code"""
-		c = Compiler(None, FunctionType.TYPE_SCRIPT)
+		if Compiler.USE_IR == 1:
+			c = IRCompiler(None, FunctionType.TYPE_SCRIPT, self.globals)
+		else:
+			c = Compiler(None, FunctionType.TYPE_SCRIPT, self.globals)
 		function = c.compile(source)
 		if function == None:
 			return InterpretResult.INTERPRET_COMPILE_ERROR
+		return self.interpretFunction(function)
 
-		self.push(Value.OBJ_VAL(function))
-		frame = CallFrame()
+	def interpretFunction(self, function):
+		"""Run the function compiled from the top-level code of a script"""
+		self.push(function)
 		closure = ObjClosure(function)
 		self.pop()
-		self.push(Value.OBJ_VAL(closure))
-		frame.closure = closure
-		frame.ip = 0
-		frame.stack = self.stack
-		frame.firstSlotInStack = 0
-		self.frames.append(frame)
-
-		return self.run()
+		self.push(closure)
+		self.frames.append(CallFrame(closure, self.stack, 0))
+
+		start = time.perf_counter()
+		if self.engine == "switch":
+			try:
+				result = self.run()
+			except VMExit as e:
+				# Runtime error in code run by runNested() from translated code.
+				result = e.result
+		elif self.engine == "register":
+			result = self.runRegister()
+		elif self.engine == "closure":
+			result = self.runClosures()
+		else:
+			result = self.runDispatch()
+		if self.debugCountInstructions != 0:
+			self.printInstructionCounts()
+		if self.debugTiering != 0:
+			self.tierCompiler.printReport(time.perf_counter() - start)
+		return result
+
+	def printInstructionCounts(self):
+		"""Print how many times each opcode ran, most frequent first"""
+		print("=== instruction counts ===")
+		total = sum(self.instructionCounts.values())
+		counts = sorted(self.instructionCounts.items(), key=lambda item: -item[1])
+		for op, count in counts:
+			if type(op) is RegOp:
+				name = op.name
+			else:
+				name = OpCode(op).name
+			print("{0:<26} {1:10d} {2:6.2f}%".format(name, count, 100.0 * count / total))
+		print("{0:<26} {1:10d}".format("total", total))
 
 	def checkNumberBinaryOperands(self):
-		return self.peek(0).IS_NUMBER() and self.peek(1).IS_NUMBER()
+		return type(self.peek(0)) is float and type(self.peek(1)) is float
 
 	def checkStringBinaryOperands(self):
-		if self.peek(0).IS_OBJ() and self.peek(1).IS_OBJ():
-			return self.peek(0).AS_OBJ().IS_STRING() and self.peek(1).AS_OBJ().IS_STRING()
+		return type(self.peek(0)) is ObjString and type(self.peek(1)) is ObjString
+
+	def traceExecution(self):
+		"""Print the stack and the next instruction to execute"""
+		frame = self.frames[-1]
+		print('        ', end='')
+		i = 0
+		while i < len(self.stack):
+			print('[ ', end='')
+			self.printValue(self.stack[i])
+			print(' ]', end='')
+			i += 1
+		print('')
+		if self.engine == "register":
+			frame.closure.AS_CLOSURE().registerCode.disassembleInstruction(frame.pc)
+		else:
+			frame.closure.AS_CLOSURE().chunk.disassembleInstruction(frame.ip)
 
 	def run(self):
 		frame = self.frames[-1]
 		while True:
 			if self.debugTraceExecution != 0:
-					print('        ', end='')
-					i = 0
-					while i < len(self.stack):
-						print('[ ', end='')
-						frame.closure.AS_CLOSURE().chunk.printValue(self.stack[i])
-						print(' ]', end='')
-						i += 1
-					print('')
-					frame.closure.AS_CLOSURE().chunk.disassembleInstruction(frame.ip)
+				self.traceExecution()
 			instruction = self.readByte()
+			if self.debugCountInstructions != 0:
+				self.instructionCounts[instruction] = self.instructionCounts.get(instruction, 0) + 1
 			if instruction == OpCode.OP_CONSTANT:
 				constant = self.readConstant()
 				self.push(constant)
 
+			elif instruction == OpCode.OP_CONSTANT_LONG:
+				constant = self.readConstantLong()
+				self.push(constant)
+
 			elif instruction == OpCode.OP_NIL:
-				self.push(Value.NIL_VAL())
+				self.push(None)
 
 			elif instruction == OpCode.OP_TRUE:
-				self.push(Value.BOOL_VAL(True))
+				self.push(True)
 
 			elif instruction == OpCode.OP_FALSE:
-				self.push(Value.BOOL_VAL(False))
+				self.push(False)
 
 			elif instruction == OpCode.OP_POP:
 				self.pop()
@@ -155,69 +238,70 @@ class VM:
 				slot = self.readByte()
 				frame.setSlot(slot, self.peek(0))
 
+			elif instruction == OpCode.OP_SET_LOCAL_POP:
+				slot = self.readByte()
+				frame.setSlot(slot, self.pop())
+
 			elif instruction == OpCode.OP_GET_GLOBAL:
-				constant = self.readConstant()
-				name = constant.AS_OBJ()
-				value = self.globals.get(name)
-				if value == None:
-					self.runtimeError("Undefined variable '{0}'".format(name.AS_STRING()))
+				slot = self.readShort()
+				value = self.globals.values[slot]
+				if value is UNDEFINED:
+					self.runtimeError("Undefined variable '{0}'".format(self.globals.names[slot]))
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
 				self.push(value)
 
 			elif instruction == OpCode.OP_DEFINE_GLOBAL:
-				constant = self.readConstant()
-				name = constant.AS_OBJ()
-				self.globals.set(name, self.peek(0))
+				slot = self.readShort()
+				self.globals.values[slot] = self.peek(0)
 				self.pop()
 
 			elif instruction == OpCode.OP_SET_GLOBAL:
-				constant = self.readConstant()
-				name = constant.AS_OBJ()
-				if self.globals.set(name, self.peek(0)):
-					self.globals.delete(name)
-					self.runtimeError("Undefined variable '{0}'".format(name.AS_STRING()))
+				slot = self.readShort()
+				if self.globals.values[slot] is UNDEFINED:
+					self.runtimeError("Undefined variable '{0}'".format(self.globals.names[slot]))
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
+				self.globals.values[slot] = self.peek(0)
 
 			elif instruction == OpCode.OP_GET_UPVALUE:
 				slot = self.readByte()
-				frame = self.frames[-1]
-				self.push(frame.closure.upvalues[slot].location)
+				upvalue = frame.closure.upvalues[slot]
+				self.push(upvalue.values[upvalue.location])
 
 			elif instruction == OpCode.OP_SET_UPVALUE:
 				slot = self.readByte()
-				frame = self.frames[-1]
-				frame.closure.upvalues[slot].location = self.peek(0)
+				upvalue = frame.closure.upvalues[slot]
+				upvalue.values[upvalue.location] = self.peek(0)
 
-			elif instruction == OpCode.OP_GET_PROPERTY:
-				if self.peek(0).AS_OBJ().OBJ_TYPE() != ObjType.OBJ_INSTANCE:
+			elif instruction in (OpCode.OP_GET_PROPERTY, OpCode.OP_GET_PROPERTY_LONG):
+				if type(self.peek(0)) is not ObjInstance:
 					self.runtimeError("Only instances have properties.")
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
 
-				instance = self.peek(0).AS_OBJ()
-				name = self.readString()
-				value = instance.fields.get(name)
-				if value != None:
+				instance = self.peek(0)
+				name = self.readString(instruction == OpCode.OP_GET_PROPERTY_LONG)
+				value = instance.getField(name)
+				if value is not UNDEFINED:
 					self.pop()
 					self.push(value)
 				elif not self.bindMethod(instance.klass, name):
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
 
-			elif instruction == OpCode.OP_SET_PROPERTY:
-				if self.peek(1).AS_OBJ().OBJ_TYPE() != ObjType.OBJ_INSTANCE:
+			elif instruction in (OpCode.OP_SET_PROPERTY, OpCode.OP_SET_PROPERTY_LONG):
+				if type(self.peek(1)) is not ObjInstance:
 					self.runtimeError("Only instances have fields.")
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
 
-				instance = self.peek(1).AS_OBJ()
-				key = self.readString()
+				instance = self.peek(1)
+				key = self.readString(instruction == OpCode.OP_SET_PROPERTY_LONG)
 				value = self.peek(0)
-				instance.fields.set(key, value)
+				instance.setField(key, value)
 				self.pop()
 				self.pop()
 				self.push(value)
 
-			elif instruction == OpCode.OP_GET_SUPER:
-				name = self.readString()
-				superclass = self.pop().AS_OBJ()
+			elif instruction in (OpCode.OP_GET_SUPER, OpCode.OP_GET_SUPER_LONG):
+				name = self.readString(instruction == OpCode.OP_GET_SUPER_LONG)
+				superclass = self.pop()
 
 				if not self.bindMethod(superclass, name):
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
@@ -225,73 +309,123 @@ class VM:
 			elif instruction == OpCode.OP_EQUAL:
 				b = self.pop()
 				a = self.pop()
-				eq = Value.valuesEqual(a, b)
-				self.push(Value.BOOL_VAL(eq))
+				self.push(self.valuesEqual(a, b))
 
-			elif instruction == OpCode.OP_GREATER:
+			elif instruction == OpCode.OP_NOT_EQUAL:
+				b = self.pop()
+				a = self.pop()
+				self.push(not self.valuesEqual(a, b))
+
+			elif instruction == OpCode.OP_GREATER_EQUAL:
 				if not self.checkNumberBinaryOperands():
 					self.runtimeError("Operands must be numbers.")
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
-				b = self.pop().AS_NUMBER()
-				a = self.pop().AS_NUMBER()
-				self.push(Value.BOOL_VAL(a > b))
+				b = self.pop()
+				a = self.pop()
+				self.push(not (a < b))
 
-			elif instruction == OpCode.OP_LESS:
+			elif instruction == OpCode.OP_LESS_EQUAL:
 				if not self.checkNumberBinaryOperands():
 					self.runtimeError("Operands must be numbers.")
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
-				b = self.pop().AS_NUMBER()
-				a = self.pop().AS_NUMBER()
-				self.push(Value.BOOL_VAL(a < b))
+				b = self.pop()
+				a = self.pop()
+				self.push(not (a > b))
 
-			elif instruction == OpCode.OP_ADD:
-				if self.checkStringBinaryOperands():
-					self.concatenate()
-				elif self.checkNumberBinaryOperands():
-					b = self.pop().AS_NUMBER()
-					a = self.pop().AS_NUMBER()
-					self.push(Value.NUMBER_VAL(a + b))
+			elif instruction in Chunk.COMPARE_JUMPS.values():
+				offset = self.readShort()
+				if instruction in (OpCode.OP_JUMP_IF_NOT_EQUAL, OpCode.OP_JUMP_IF_EQUAL):
+					b = self.pop()
+					a = self.pop()
+					result = self.valuesEqual(a, b) == (instruction == OpCode.OP_JUMP_IF_NOT_EQUAL)
 				else:
+					if not self.checkNumberBinaryOperands():
+						self.runtimeError("Operands must be numbers.")
+						return InterpretResult.INTERPRET_RUNTIME_ERROR
+					b = self.pop()
+					a = self.pop()
+					if instruction == OpCode.OP_JUMP_IF_NOT_GREATER:
+						result = a > b
+					elif instruction == OpCode.OP_JUMP_IF_NOT_GREATER_EQUAL:
+						result = not (a < b)
+					elif instruction == OpCode.OP_JUMP_IF_NOT_LESS:
+						result = a < b
+					else:
+						result = not (a > b)
+				if not result:
+					frame.ip += offset
+
+			elif instruction == OpCode.OP_GREATER:
+				if not self.checkNumberBinaryOperands():
 					self.runtimeError("Operands must be numbers.")
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
+				b = self.pop()
+				a = self.pop()
+				self.push(a > b)
 
-			elif instruction == OpCode.OP_SUBTRACT:
+			elif instruction == OpCode.OP_LESS:
 				if not self.checkNumberBinaryOperands():
 					self.runtimeError("Operands must be numbers.")
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
-				b = self.pop().AS_NUMBER()
-				a = self.pop().AS_NUMBER()
-				self.push(Value.NUMBER_VAL(a - b))
+				b = self.pop()
+				a = self.pop()
+				self.push(a < b)
+
+			elif instruction == OpCode.OP_ADD:
+				if not self.add():
+					return InterpretResult.INTERPRET_RUNTIME_ERROR
+
+			elif instruction == OpCode.OP_ADD_LOCAL_LOCAL:
+				self.push(frame.getSlot(self.readByte()))
+				self.push(frame.getSlot(self.readByte()))
+				if not self.add():
+					return InterpretResult.INTERPRET_RUNTIME_ERROR
+
+			elif instruction == OpCode.OP_ADD_LOCAL_CONSTANT:
+				self.push(frame.getSlot(self.readByte()))
+				self.push(self.readConstant())
+				if not self.add():
+					return InterpretResult.INTERPRET_RUNTIME_ERROR
+
+			elif instruction == OpCode.OP_SUBTRACT:
+				if not self.subtract():
+					return InterpretResult.INTERPRET_RUNTIME_ERROR
+
+			elif instruction == OpCode.OP_SUBTRACT_LOCAL_CONSTANT:
+				self.push(frame.getSlot(self.readByte()))
+				self.push(self.readConstant())
+				if not self.subtract():
+					return InterpretResult.INTERPRET_RUNTIME_ERROR
 
 			elif instruction == OpCode.OP_MULTIPLY:
 				if not self.checkNumberBinaryOperands():
 					self.runtimeError("Operands must be numbers.")
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
-				b = self.pop().AS_NUMBER()
-				a = self.pop().AS_NUMBER()
-				self.push(Value.NUMBER_VAL(a * b))
+				b = self.pop()
+				a = self.pop()
+				self.push(a * b)
 
 			elif instruction == OpCode.OP_DIVIDE:
 				if not self.checkNumberBinaryOperands():
 					self.runtimeError("Operands must be numbers.")
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
-				b = self.pop().AS_NUMBER()
-				a = self.pop().AS_NUMBER()
-				self.push(Value.NUMBER_VAL(a / b))
+				b = self.pop()
+				a = self.pop()
+				self.push(a / b)
 
 			elif instruction == OpCode.OP_NOT:
 				n = self.pop()
-				self.push(Value.BOOL_VAL(self.isFalsey(n)))
+				self.push(self.isFalsey(n))
 
 			elif instruction == OpCode.OP_NEGATE:
-				if not self.peek(0).IS_NUMBER():
+				if type(self.peek(0)) is not float:
 					self.runtimeError("Operand must be a number.")
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
-				n = self.pop().AS_NUMBER()
-				self.push(Value.NUMBER_VAL(-n))
+				n = self.pop()
+				self.push(-n)
 
 			elif instruction == OpCode.OP_PRINT:
-				frame.closure.AS_CLOSURE().chunk.printValue(self.pop())
+				self.printValue(self.pop())
 				print()
 
 			elif instruction == OpCode.OP_JUMP_IF_FALSE:
@@ -313,76 +447,1579 @@ class VM:
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
 				frame = self.frames[-1]
 
-			elif instruction == OpCode.OP_INVOKE:
-				method = self.readString()
+			elif instruction == OpCode.OP_TAIL_CALL:
+				argCount = self.readByte()
+				if not self.tailCall(self.peek(argCount), argCount):
+					return InterpretResult.INTERPRET_RUNTIME_ERROR
+				frame = self.frames[-1]
+
+			elif instruction == OpCode.OP_CALL_GLOBAL:
+				slot = self.readShort()
+				argCount = self.readByte()
+				callee = self.globals.values[slot]
+				if callee is UNDEFINED:
+					self.runtimeError("Undefined variable '{0}'".format(self.globals.names[slot]))
+					return InterpretResult.INTERPRET_RUNTIME_ERROR
+				# The arguments are already pushed, the function goes below them.
+				self.stack.insert(len(self.stack) - argCount, callee)
+				if not self.callValue(callee, argCount):
+					return InterpretResult.INTERPRET_RUNTIME_ERROR
+				frame = self.frames[-1]
+
+			elif instruction in (OpCode.OP_INVOKE, OpCode.OP_INVOKE_LONG):
+				method = self.readString(instruction == OpCode.OP_INVOKE_LONG)
 				argCount = self.readByte()
 				if not self.invoke(method, argCount):
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
 				frame = self.frames[-1]
 
-			elif instruction == OpCode.OP_SUPER_INVOKE:
-				method = self.readString()
+			elif instruction in (OpCode.OP_SUPER_INVOKE, OpCode.OP_SUPER_INVOKE_LONG):
+				method = self.readString(instruction == OpCode.OP_SUPER_INVOKE_LONG)
 				argCount = self.readByte()
-				superclass = self.pop().AS_OBJ()
+				superclass = self.pop()
 				if not self.invokeFromClass(superclass, method, argCount):
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
 				frame = self.frames[-1]
 
-			elif instruction == OpCode.OP_CLOSURE:
-				constant = self.readConstant()
-				function = constant.AS_OBJ()
-				closure = ObjClosure(function)
-				self.push(Value.OBJ_VAL(closure))
+			elif instruction in (OpCode.OP_CLOSURE, OpCode.OP_CLOSURE_LONG):
+				if instruction == OpCode.OP_CLOSURE_LONG:
+					constant = self.readConstantLong()
+				else:
+					constant = self.readConstant()
+				closure = ObjClosure(constant)
+				self.push(closure)
+				# The operands are the same as constant.getCaptures().
+				captures = constant.getCaptures()
+				frame.ip += 2 * len(captures)
 				i = 0
-				while i < len(closure.upvalues):
-					isLocal = self.readByte()
-					index = self.readByte()
-					if isLocal == 1:
-						closure.upvalues[i] = self.captureUpvalue(self.frames[-1].getSlot(index))
+				for isLocal, index in captures:
+					if isLocal:
+						closure.upvalues[i] = self.captureUpvalue(self.stack,
+							frame.firstSlotInStack + index)
 					else:
-						closure.upvalues[i] = self.frames[-1].closure.upvalues[index]
+						closure.upvalues[i] = frame.closure.upvalues[index]
 					i += 1
 
 			elif instruction == OpCode.OP_CLOSE_UPVALUE:
-				self.closeUpvalues(0)
+				self.closeUpvalues(self.stack, len(self.stack) - 1)
 				self.pop()
 
 			elif instruction == OpCode.OP_RETURN:
 				result = self.pop()
-				self.closeUpvalues(0)
-				firstSlotInStack = self.frames[-1].firstSlotInStack
-				self.frames.pop()
+				firstSlotInStack = frame.firstSlotInStack
+				if self.openUpvalues != None:
+					self.closeUpvalues(self.stack, firstSlotInStack)
+				self.framePool.append(self.frames.pop())
 				if len(self.frames) == 0:
 					self.pop()
 					return InterpretResult.INTERPRET_OK
 
 				# pop the arguments passed to the function, so it
 				# returns to the state before the function was called.
-				while len(self.stack) > firstSlotInStack:
-					self.pop()
+				del self.stack[firstSlotInStack:]
 
 				self.push(result)
 				frame = self.frames[-1]
 
-			elif instruction == OpCode.OP_CLASS:
-				name = self.readString()
-				self.push(Value.OBJ_VAL(ObjClass(name)))
+			elif instruction in (OpCode.OP_CLASS, OpCode.OP_CLASS_LONG):
+				name = self.readString(instruction == OpCode.OP_CLASS_LONG)
+				self.push(ObjClass(name))
 
 			elif instruction == OpCode.OP_INHERIT:
-				superclass = self.peek(1).AS_OBJ()
+				superclass = self.peek(1)
 
-				if superclass.OBJ_TYPE() != ObjType.OBJ_CLASS:
+				if type(superclass) is not ObjClass:
 					self.runtimeError("Superclass must be a class.")
 					return InterpretResult.INTERPRET_RUNTIME_ERROR
 
-				subclass = self.peek(0).AS_OBJ()
-				subclass.methods.addAll(superclass.methods)
+				subclass = self.peek(0)
+				subclass.inherit(superclass)
 				self.pop() # Subclass.
 
-			elif instruction == OpCode.OP_METHOD:
-				name = self.readString()
+			elif instruction in (OpCode.OP_METHOD, OpCode.OP_METHOD_LONG):
+				name = self.readString(instruction == OpCode.OP_METHOD_LONG)
 				self.defineMethod(name)
 
+	def runDispatch(self):
+		"""Run pre-decoded instructions with the handlers from initDispatch()"""
+		return self.dispatchLoop()
+
+	def decodeFunction(self, function):
+		"""Pre-decode the bytecode of a function for runDispatch()
+
+		The result has an entry at the offset of each instruction in
+		chunk.code, so ip values are still byte offsets that work with
+		chunk.lines and disassembleInstruction(). An entry is a tuple of
+		the handler, the offset of the next instruction and the operands,
+		with constants already resolved and jumps as absolute offsets.
+		"""
+		chunk = function.chunk
+		code = chunk.code
+		constants = chunk.constants.rawValues()
+		handlers = self.handlers
+		decoded = [None] * len(code)
+		offset = 0
+		while offset < len(code):
+			instruction = code[offset]
+			handler = handlers[Chunk.SHORT_OPCODES.get(instruction, instruction)]
+			if instruction == OpCode.OP_LOOP and self.tierThreshold > 0:
+				handler = self.tierLoopHandler
+			if self.debugCountInstructions != 0:
+				handler = self.countingHandler(instruction, handler)
+			# Long variants are decoded like the short instruction.
+			instruction = Chunk.SHORT_OPCODES.get(instruction, instruction)
+			if instruction in (OpCode.OP_CONSTANT, OpCode.OP_CLASS, OpCode.OP_METHOD):
+				next = offset + chunk.instructionSize(offset)
+				decoded[offset] = (handler, next, constants[chunk.constantIndex(offset)])
+				offset = next
+			elif instruction in (OpCode.OP_GET_PROPERTY, OpCode.OP_SET_PROPERTY,
+				OpCode.OP_GET_SUPER):
+				next = offset + chunk.instructionSize(offset)
+				decoded[offset] = (handler, next, constants[chunk.constantIndex(offset)], self.newInlineCache())
+				offset = next
+			elif instruction in (OpCode.OP_GET_LOCAL, OpCode.OP_SET_LOCAL,
+				OpCode.OP_GET_UPVALUE, OpCode.OP_SET_UPVALUE, OpCode.OP_CALL,
+				OpCode.OP_SET_LOCAL_POP, OpCode.OP_TAIL_CALL):
+				decoded[offset] = (handler, offset + 2, code[offset + 1])
+				offset += 2
+			elif instruction == OpCode.OP_ADD_LOCAL_LOCAL:
+				decoded[offset] = (handler, offset + 3, code[offset + 1], code[offset + 2])
+				offset += 3
+			elif instruction in (OpCode.OP_ADD_LOCAL_CONSTANT, OpCode.OP_SUBTRACT_LOCAL_CONSTANT):
+				decoded[offset] = (handler, offset + 3, code[offset + 1], constants[code[offset + 2]])
+				offset += 3
+			elif instruction == OpCode.OP_CALL_GLOBAL:
+				decoded[offset] = (handler, offset + 4, (code[offset + 1] << 8) | code[offset + 2],
+					code[offset + 3])
+				offset += 4
+			elif instruction in (OpCode.OP_GET_GLOBAL, OpCode.OP_DEFINE_GLOBAL,
+				OpCode.OP_SET_GLOBAL):
+				decoded[offset] = (handler, offset + 3, (code[offset + 1] << 8) | code[offset + 2])
+				offset += 3
+			elif instruction in (OpCode.OP_JUMP, OpCode.OP_JUMP_IF_FALSE) or instruction in Chunk.COMPARE_JUMPS.values():
+				jump = (code[offset + 1] << 8) | code[offset + 2]
+				decoded[offset] = (handler, offset + 3, offset + 3 + jump)
+				offset += 3
+			elif instruction == OpCode.OP_LOOP:
+				jump = (code[offset + 1] << 8) | code[offset + 2]
+				decoded[offset] = (handler, offset + 3, offset + 3 - jump)
+				offset += 3
+			elif instruction == OpCode.OP_INVOKE:
+				next = offset + chunk.instructionSize(offset)
+				name = constants[chunk.constantIndex(offset)]
+				decoded[offset] = (handler, next, name, code[next - 1], self.newInlineCache())
+				offset = next
+			elif instruction == OpCode.OP_SUPER_INVOKE:
+				next = offset + chunk.instructionSize(offset)
+				name = constants[chunk.constantIndex(offset)]
+				decoded[offset] = (handler, next, name, code[next - 1], self.newInlineCache())
+				offset = next
+			elif instruction == OpCode.OP_CLOSURE:
+				closureFunction = constants[chunk.constantIndex(offset)]
+				next = offset + chunk.instructionSize(offset)
+				decoded[offset] = (handler, next, closureFunction, closureFunction.getCaptures())
+				offset = next
+			else:
+				decoded[offset] = (handler, offset + 1)
+				offset += 1
+		function.decoded = decoded
+		return decoded
+
+	def countingHandler(self, instruction, handler):
+		"""Return handler for instruction that also counts how often it runs"""
+		counts = self.instructionCounts
+		def countInstruction(ins):
+			counts[instruction] = counts.get(instruction, 0) + 1
+			return handler(ins)
+		return countInstruction
+
+	def newInlineCache(self):
+		"""Return an empty inline cache for a property or method instruction
+
+		The cache is a list of [key, offset, version, value]. key is the
+		shape of the receiver the name was last looked up for, or the
+		superclass for super instructions. offset is the index of the field
+		in the instance slots, or -1 if the name is a method. For a method,
+		version is the version of the class when it was looked up and value
+		is the method. For OP_SET_PROPERTY, value is the shape the instance
+		moves to when the field is added, or None if it already exists.
+		OP_INVOKE and OP_SUPER_INVOKE only use key, the last shape without
+		a field of that name or the superclass, and value, the index of the
+		method in the vtable of the class, as methods do not change.
+		"""
+		return [None, -1, -1, None]
+
+	def initDispatch(self):
+		"""Create the handler functions and loop used by runDispatch()
+
+		The state of the running frame is kept in local variables of this
+		method that are shared by the handlers and the loop, instead of
+		being read through self.frames[-1] for every instruction. Each
+		handler is called with its pre-decoded instruction tuple and
+		returns the offset of the next instruction to execute.
+		"""
+		frames = self.frames
+		framePool = self.framePool
+		stack = self.stack
+		push = stack.append
+		pop = stack.pop
+		globalValues = self.globals.values
+		globalNames = self.globals.names
+		frame = None
+		code = None
+		upvalues = None
+		base = 0
+		# Frames left when runNested() returns, 0 for the whole script
+		exitDepth = 0
+
+		def loadFrame():
+			nonlocal frame, code, upvalues, base
+			frame = frames[-1]
+			function = frame.closure.AS_CLOSURE()
+			code = function.decoded
+			if code == None:
+				code = self.decodeFunction(function)
+			upvalues = frame.closure.upvalues
+			base = frame.firstSlotInStack
+			return frame.ip
+
+		def runtimeError(ins, message):
+			frame.ip = ins[1]
+			self.runtimeError(message)
+			raise VMExit(InterpretResult.INTERPRET_RUNTIME_ERROR)
+
+		def fillMethodCache(ins, cache, key, klass):
+			name = ins[2]
+			method = klass.findMethod(name)
+			if method == None:
+				runtimeError(ins, "Undefined property '{0}'.".format(name.AS_STRING()))
+			cache[0] = key
+			cache[1] = -1
+			cache[2] = klass.version
+			cache[3] = method
+			return method
+
+		def opConstant(ins):
+			push(ins[2])
+			return ins[1]
+
+		def opNil(ins):
+			push(None)
+			return ins[1]
+
+		def opTrue(ins):
+			push(True)
+			return ins[1]
+
+		def opFalse(ins):
+			push(False)
+			return ins[1]
+
+		def opPop(ins):
+			pop()
+			return ins[1]
+
+		def opGetLocal(ins):
+			push(stack[base + ins[2]])
+			return ins[1]
+
+		def opSetLocal(ins):
+			stack[base + ins[2]] = stack[-1]
+			return ins[1]
+
+		def opGetGlobal(ins):
+			value = globalValues[ins[2]]
+			if value is UNDEFINED:
+				runtimeError(ins, "Undefined variable '{0}'".format(globalNames[ins[2]]))
+			push(value)
+			return ins[1]
+
+		def opDefineGlobal(ins):
+			globalValues[ins[2]] = pop()
+			return ins[1]
+
+		def opSetLocalPop(ins):
+			stack[base + ins[2]] = pop()
+			return ins[1]
+
+		def opSetGlobal(ins):
+			slot = ins[2]
+			if globalValues[slot] is UNDEFINED:
+				runtimeError(ins, "Undefined variable '{0}'".format(globalNames[slot]))
+			globalValues[slot] = stack[-1]
+			return ins[1]
+
+		def opGetUpvalue(ins):
+			upvalue = upvalues[ins[2]]
+			push(upvalue.values[upvalue.location])
+			return ins[1]
+
+		def opSetUpvalue(ins):
+			upvalue = upvalues[ins[2]]
+			upvalue.values[upvalue.location] = stack[-1]
+			return ins[1]
+
+		def opGetProperty(ins):
+			instance = stack[-1]
+			if type(instance) is not ObjInstance:
+				runtimeError(ins, "Only instances have properties.")
+			cache = ins[3]
+			shape = instance.shape
+			if shape is cache[0]:
+				offset = cache[1]
+				if offset >= 0:
+					stack[-1] = instance.slots[offset]
+					return ins[1]
+				if cache[2] == instance.klass.version:
+					stack[-1] = ObjBoundMethod(instance, cache[3])
+					return ins[1]
+			offset = shape.fields.get(ins[2])
+			if offset != None:
+				cache[0] = shape
+				cache[1] = offset
+				stack[-1] = instance.slots[offset]
+			else:
+				method = fillMethodCache(ins, cache, shape, instance.klass)
+				stack[-1] = ObjBoundMethod(instance, method)
+			return ins[1]
+
+		def opSetProperty(ins):
+			instance = stack[-2]
+			if type(instance) is not ObjInstance:
+				runtimeError(ins, "Only instances have fields.")
+			value = pop()
+			stack[-1] = value
+			cache = ins[3]
+			shape = instance.shape
+			if shape is not cache[0]:
+				offset = shape.fields.get(ins[2])
+				cache[0] = shape
+				if offset != None:
+					cache[1] = offset
+					cache[3] = None
+				else:
+					cache[1] = len(instance.slots)
+					cache[3] = shape.addField(ins[2])
+			if cache[3] == None:
+				instance.slots[cache[1]] = value
+			else:
+				instance.slots.append(value)
+				instance.shape = cache[3]
+			return ins[1]
+
+		def opGetSuper(ins):
+			superclass = pop()
+			cache = ins[3]
+			if cache[0] is superclass and cache[2] == superclass.version:
+				method = cache[3]
+			else:
+				method = fillMethodCache(ins, cache, superclass, superclass)
+			stack[-1] = ObjBoundMethod(stack[-1], method)
+			return ins[1]
+
+		def opEqual(ins):
+			b = pop()
+			a = stack[-1]
+			stack[-1] = type(a) is type(b) and a == b
+			return ins[1]
+
+		def opNotEqual(ins):
+			b = pop()
+			a = stack[-1]
+			stack[-1] = type(a) is not type(b) or a != b
+			return ins[1]
+
+		def opGreaterEqual(ins):
+			b = stack[-1]
+			a = stack[-2]
+			if type(a) is not float or type(b) is not float:
+				runtimeError(ins, "Operands must be numbers.")
+			pop()
+			stack[-1] = not (a < b)
+			return ins[1]
+
+		def opLessEqual(ins):
+			b = stack[-1]
+			a = stack[-2]
+			if type(a) is not float or type(b) is not float:
+				runtimeError(ins, "Operands must be numbers.")
+			pop()
+			stack[-1] = not (a > b)
+			return ins[1]
+
+		def opJumpIfNotEqual(ins):
+			b = pop()
+			a = pop()
+			if type(a) is type(b) and a == b:
+				return ins[1]
+			return ins[2]
+
+		def opJumpIfEqual(ins):
+			b = pop()
+			a = pop()
+			if type(a) is type(b) and a == b:
+				return ins[2]
+			return ins[1]
+
+		def opJumpIfNotGreater(ins):
+			b = stack[-1]
+			a = stack[-2]
+			if type(a) is not float or type(b) is not float:
+				runtimeError(ins, "Operands must be numbers.")
+			del stack[-2:]
+			if a > b:
+				return ins[1]
+			return ins[2]
+
+		def opJumpIfNotGreaterEqual(ins):
+			b = stack[-1]
+			a = stack[-2]
+			if type(a) is not float or type(b) is not float:
+				runtimeError(ins, "Operands must be numbers.")
+			del stack[-2:]
+			if a < b:
+				return ins[2]
+			return ins[1]
+
+		def opJumpIfNotLess(ins):
+			b = stack[-1]
+			a = stack[-2]
+			if type(a) is not float or type(b) is not float:
+				runtimeError(ins, "Operands must be numbers.")
+			del stack[-2:]
+			if a < b:
+				return ins[1]
+			return ins[2]
+
+		def opJumpIfNotLessEqual(ins):
+			b = stack[-1]
+			a = stack[-2]
+			if type(a) is not float or type(b) is not float:
+				runtimeError(ins, "Operands must be numbers.")
+			del stack[-2:]
+			if a > b:
+				return ins[2]
+			return ins[1]
+
+		def opGreater(ins):
+			b = stack[-1]
+			a = stack[-2]
+			if type(a) is not float or type(b) is not float:
+				runtimeError(ins, "Operands must be numbers.")
+			pop()
+			stack[-1] = a > b
+			return ins[1]
+
+		def opLess(ins):
+			b = stack[-1]
+			a = stack[-2]
+			if type(a) is not float or type(b) is not float:
+				runtimeError(ins, "Operands must be numbers.")
+			pop()
+			stack[-1] = a < b
+			return ins[1]
+
+		def opAdd(ins):
+			b = stack[-1]
+			a = stack[-2]
+			if type(a) is float and type(b) is float:
+				pop()
+				stack[-1] = a + b
+			elif type(a) is ObjString and type(b) is ObjString:
+				pop()
+				stack[-1] = copyString(a.AS_STRING() + b.AS_STRING())
+			else:
+				runtimeError(ins, "Operands must be numbers.")
+			return ins[1]
+
+		def opAddLocalLocal(ins):
+			a = stack[base + ins[2]]
+			b = stack[base + ins[3]]
+			if type(a) is float and type(b) is float:
+				push(a + b)
+			elif type(a) is ObjString and type(b) is ObjString:
+				push(copyString(a.AS_STRING() + b.AS_STRING()))
+			else:
+				runtimeError(ins, "Operands must be numbers.")
+			return ins[1]
+
+		def opAddLocalConstant(ins):
+			a = stack[base + ins[2]]
+			b = ins[3]
+			if type(a) is float and type(b) is float:
+				push(a + b)
+			elif type(a) is ObjString and type(b) is ObjString:
+				push(copyString(a.AS_STRING() + b.AS_STRING()))
+			else:
+				runtimeError(ins, "Operands must be numbers.")
+			return ins[1]
+
+		def opSubtractLocalConstant(ins):
+			a = stack[base + ins[2]]
+			b = ins[3]
+			if type(a) is not float or type(b) is not float:
+				runtimeError(ins, "Operands must be numbers.")
+			push(a - b)
+			return ins[1]
+
+		def opSubtract(ins):
+			b = stack[-1]
+			a = stack[-2]
+			if type(a) is not float or type(b) is not float:
+				runtimeError(ins, "Operands must be numbers.")
+			pop()
+			stack[-1] = a - b
+			return ins[1]
+
+		def opMultiply(ins):
+			b = stack[-1]
+			a = stack[-2]
+			if type(a) is not float or type(b) is not float:
+				runtimeError(ins, "Operands must be numbers.")
+			pop()
+			stack[-1] = a * b
+			return ins[1]
+
+		def opDivide(ins):
+			b = stack[-1]
+			a = stack[-2]
+			if type(a) is not float or type(b) is not float:
+				runtimeError(ins, "Operands must be numbers.")
+			pop()
+			stack[-1] = a / b
+			return ins[1]
+
+		def opNot(ins):
+			value = stack[-1]
+			stack[-1] = value is None or value is False
+			return ins[1]
+
+		def opNegate(ins):
+			value = stack[-1]
+			if type(value) is not float:
+				runtimeError(ins, "Operand must be a number.")
+			stack[-1] = -value
+			return ins[1]
+
+		def opPrint(ins):
+			self.printValue(pop())
+			print()
+			return ins[1]
+
+		def opJump(ins):
+			return ins[2]
+
+		def opJumpIfFalse(ins):
+			value = stack[-1]
+			if value is None or value is False:
+				return ins[2]
+			return ins[1]
+
+		def opCall(ins):
+			argCount = ins[2]
+			callee = stack[-1 - argCount]
+			if type(callee) is ObjClass and callee.initializer == None and argCount == 0:
+				# Nothing runs, so the instance replaces the class without
+				# a new frame.
+				stack[-1] = ObjInstance(callee)
+				return ins[1]
+			frame.ip = ins[1]
+			if not self.callValue(callee, argCount):
+				raise VMExit(InterpretResult.INTERPRET_RUNTIME_ERROR)
+			return loadFrame()
+
+		def opTailCall(ins):
+			argCount = ins[2]
+			frame.ip = ins[1]
+			if not self.tailCall(stack[-1 - argCount], argCount):
+				raise VMExit(InterpretResult.INTERPRET_RUNTIME_ERROR)
+			return loadFrame()
+
+		def opCallGlobal(ins):
+			argCount = ins[3]
+			callee = globalValues[ins[2]]
+			if callee is UNDEFINED:
+				runtimeError(ins, "Undefined variable '{0}'".format(globalNames[ins[2]]))
+			if type(callee) is ObjClass and callee.initializer == None and argCount == 0:
+				push(ObjInstance(callee))
+				return ins[1]
+			# The arguments are already pushed, the function goes below them.
+			stack.insert(len(stack) - argCount, callee)
+			frame.ip = ins[1]
+			if not self.callValue(callee, argCount):
+				raise VMExit(InterpretResult.INTERPRET_RUNTIME_ERROR)
+			return loadFrame()
+
+		def opInvoke(ins):
+			argCount = ins[3]
+			receiver = stack[-1 - argCount]
+			frame.ip = ins[1]
+			if type(receiver) is not ObjInstance:
+				runtimeError(ins, "Only instances have methods.")
+			cache = ins[4]
+			shape = receiver.shape
+			if shape is not cache[0]:
+				offset = shape.fields.get(ins[2])
+				if offset != None:
+					# A field holding a function is called like a function.
+					value = receiver.slots[offset]
+					stack[-1 - argCount] = value
+					if not self.callValue(value, argCount):
+						raise VMExit(InterpretResult.INTERPRET_RUNTIME_ERROR)
+					return loadFrame()
+				index = receiver.klass.methodIndex(ins[2])
+				if index < 0:
+					runtimeError(ins, "Undefined property '{0}'.".format(ins[2].AS_STRING()))
+				cache[0] = shape
+				cache[3] = index
+			if not self.call(receiver.klass.vtable[cache[3]], argCount):
+				raise VMExit(InterpretResult.INTERPRET_RUNTIME_ERROR)
+			return loadFrame()
+
+		def opSuperInvoke(ins):
+			superclass = pop()
+			frame.ip = ins[1]
+			cache = ins[4]
+			if superclass is not cache[0]:
+				index = superclass.methodIndex(ins[2])
+				if index < 0:
+					runtimeError(ins, "Undefined property '{0}'.".format(ins[2].AS_STRING()))
+				cache[0] = superclass
+				cache[3] = index
+			if not self.call(superclass.vtable[cache[3]], ins[3]):
+				raise VMExit(InterpretResult.INTERPRET_RUNTIME_ERROR)
+			return loadFrame()
+
+		def opClosure(ins):
+			closure = ObjClosure(ins[2])
+			push(closure)
+			i = 0
+			for isLocal, index in ins[3]:
+				if isLocal:
+					closure.upvalues[i] = self.captureUpvalue(stack, base + index)
+				else:
+					closure.upvalues[i] = upvalues[index]
+				i += 1
+			return ins[1]
+
+		def opCloseUpvalue(ins):
+			self.closeUpvalues(stack, len(stack) - 1)
+			pop()
+			return ins[1]
+
+		def opReturn(ins):
+			result = pop()
+			if self.openUpvalues != None:
+				self.closeUpvalues(stack, base)
+			framePool.append(frames.pop())
+			# Drop the arguments and locals of the returning function.
+			del stack[base:]
+			return returnValue(result)
+
+		def returnValue(result):
+			if len(frames) == exitDepth:
+				if exitDepth > 0:
+					# Returning to the translated code that called runNested().
+					push(result)
+				raise VMExit(InterpretResult.INTERPRET_OK)
+			push(result)
+			return loadFrame()
+
+		def opLoopTiered(ins):
+			# OP_LOOP when VM.tierThreshold is set, counting loop iterations.
+			function = frame.closure.AS_CLOSURE()
+			if function.tiered == None:
+				function.loopCount += 1
+				if function.loopCount >= self.tierThreshold:
+					self.tierCompiler.promote(function, "loop iterations", function.loopCount)
+			if not function.tiered:
+				return ins[2]
+			# Continue this call in the translated code from the loop target.
+			closure = frame.closure
+			frames.pop()
+			return returnValue(self.runTiered(function, closure, base, ins[2]))
+
+		def opClass(ins):
+			push(ObjClass(ins[2]))
+			return ins[1]
+
+		def opInherit(ins):
+			superclass = stack[-2]
+			if type(superclass) is not ObjClass:
+				runtimeError(ins, "Superclass must be a class.")
+			subclass = pop()
+			subclass.inherit(superclass)
+			return ins[1]
+
+		def opMethod(ins):
+			self.defineMethod(ins[2])
+			return ins[1]
+
+		def dispatchLoop():
+			ip = loadFrame()
+			try:
+				if self.debugTraceExecution != 0:
+					while True:
+						frame.ip = ip
+						self.traceExecution()
+						ins = code[ip]
+						ip = ins[0](ins)
+				elif self.debugTiering != 0:
+					count = 0
+					try:
+						while True:
+							ins = code[ip]
+							ip = ins[0](ins)
+							count += 1
+					finally:
+						self.tierCompiler.interpretedInstructions += count
+				else:
+					while True:
+						ins = code[ip]
+						ip = ins[0](ins)
+			except VMExit as e:
+				return e.result
+
+		self.handlers = {
+			OpCode.OP_CONSTANT: opConstant,
+			OpCode.OP_NIL: opNil,
+			OpCode.OP_TRUE: opTrue,
+			OpCode.OP_FALSE: opFalse,
+			OpCode.OP_POP: opPop,
+			OpCode.OP_GET_LOCAL: opGetLocal,
+			OpCode.OP_SET_LOCAL: opSetLocal,
+			OpCode.OP_GET_GLOBAL: opGetGlobal,
+			OpCode.OP_DEFINE_GLOBAL: opDefineGlobal,
+			OpCode.OP_SET_GLOBAL: opSetGlobal,
+			OpCode.OP_GET_UPVALUE: opGetUpvalue,
+			OpCode.OP_SET_UPVALUE: opSetUpvalue,
+			OpCode.OP_GET_PROPERTY: opGetProperty,
+			OpCode.OP_SET_PROPERTY: opSetProperty,
+			OpCode.OP_GET_SUPER: opGetSuper,
+			OpCode.OP_EQUAL: opEqual,
+			OpCode.OP_GREATER: opGreater,
+			OpCode.OP_LESS: opLess,
+			OpCode.OP_ADD: opAdd,
+			OpCode.OP_SUBTRACT: opSubtract,
+			OpCode.OP_MULTIPLY: opMultiply,
+			OpCode.OP_DIVIDE: opDivide,
+			OpCode.OP_NOT: opNot,
+			OpCode.OP_NEGATE: opNegate,
+			OpCode.OP_PRINT: opPrint,
+			OpCode.OP_JUMP: opJump,
+			OpCode.OP_JUMP_IF_FALSE: opJumpIfFalse,
+			OpCode.OP_LOOP: opJump,
+			OpCode.OP_CALL: opCall,
+			OpCode.OP_TAIL_CALL: opTailCall,
+			OpCode.OP_INVOKE: opInvoke,
+			OpCode.OP_SUPER_INVOKE: opSuperInvoke,
+			OpCode.OP_CLOSURE: opClosure,
+			OpCode.OP_CLOSE_UPVALUE: opCloseUpvalue,
+			OpCode.OP_RETURN: opReturn,
+			OpCode.OP_CLASS: opClass,
+			OpCode.OP_INHERIT: opInherit,
+			OpCode.OP_METHOD: opMethod,
+			OpCode.OP_ADD_LOCAL_LOCAL: opAddLocalLocal,
+			OpCode.OP_ADD_LOCAL_CONSTANT: opAddLocalConstant,
+			OpCode.OP_SUBTRACT_LOCAL_CONSTANT: opSubtractLocalConstant,
+			OpCode.OP_SET_LOCAL_POP: opSetLocalPop,
+			OpCode.OP_CALL_GLOBAL: opCallGlobal,
+			OpCode.OP_NOT_EQUAL: opNotEqual,
+			OpCode.OP_GREATER_EQUAL: opGreaterEqual,
+			OpCode.OP_LESS_EQUAL: opLessEqual,
+			OpCode.OP_JUMP_IF_NOT_EQUAL: opJumpIfNotEqual,
+			OpCode.OP_JUMP_IF_EQUAL: opJumpIfEqual,
+			OpCode.OP_JUMP_IF_NOT_GREATER: opJumpIfNotGreater,
+			OpCode.OP_JUMP_IF_NOT_GREATER_EQUAL: opJumpIfNotGreaterEqual,
+			OpCode.OP_JUMP_IF_NOT_LESS: opJumpIfNotLess,
+			OpCode.OP_JUMP_IF_NOT_LESS_EQUAL: opJumpIfNotLessEqual,
+		}
+		self.dispatchLoop = dispatchLoop
+
+		def runNested(depth):
+			"""Run the frames above depth until they return, for translated code
+
+			Returns the value returned by the frame at depth. A runtime error
+			is raised as VMExit, to leave the translated code as well.
+			"""
+			nonlocal exitDepth
+			outer = exitDepth
+			exitDepth = depth
+			tier = self.tierCompiler
+			if self.debugTiering != 0:
+				# Translated code called from here is timed on its own.
+				nesting = tier.nesting
+				tier.nesting = 0
+				start = time.perf_counter()
+			try:
+				result = dispatchLoop()
+			finally:
+				exitDepth = outer
+				if self.debugTiering != 0:
+					tier.translatedTime -= time.perf_counter() - start
+					tier.nesting = nesting
+			if result != InterpretResult.INTERPRET_OK:
+				raise VMExit(result)
+			return pop()
+
+		def finishCall(ok, depth):
+			if not ok:
+				raise VMExit(InterpretResult.INTERPRET_RUNTIME_ERROR)
+			if len(frames) > depth:
+				# The function called is interpreted.
+				return runNested(depth)
+			return pop()
+
+		def newTierFrame(closure):
+			# The frame of a translated function, only needed for stack
+			# traces and if it continues in the interpreter.
+			return CallFrame(closure, stack, 0)
+
+		def tierCall(callee, *args):
+			if type(callee) is ObjClosure:
+				function = callee.AS_CLOSURE()
+				if function.tiered and len(args) == function.arity and len(frames) < 64:
+					return function.tiered(callee, 0, callee, *args)
+			elif type(callee) is ObjClass and callee.initializer == None and len(args) == 0:
+				return ObjInstance(callee)
+			depth = len(frames)
+			push(callee)
+			stack.extend(args)
+			return finishCall(self.callValue(callee, len(args)), depth)
+
+		def tierInvoke(receiver, name, *args):
+			if type(receiver) is ObjInstance and name not in receiver.shape.fields:
+				method = receiver.klass.findMethod(name)
+				if method != None:
+					function = method.AS_CLOSURE()
+					if function.tiered and len(args) == function.arity and len(frames) < 64:
+						return function.tiered(method, 0, receiver, *args)
+			depth = len(frames)
+			push(receiver)
+			stack.extend(args)
+			return finishCall(self.invoke(name, len(args)), depth)
+
+		def tierSuperInvoke(superclass, name, receiver, *args):
+			method = superclass.findMethod(name)
+			if method != None:
+				function = method.AS_CLOSURE()
+				if function.tiered and len(args) == function.arity and len(frames) < 64:
+					return function.tiered(method, 0, receiver, *args)
+			depth = len(frames)
+			push(receiver)
+			stack.extend(args)
+			return finishCall(self.invokeFromClass(superclass, name, len(args)), depth)
+
+		def tierGetField(instance, name):
+			# Field or bound method, UNDEFINED for a runtime error.
+			offset = instance.shape.fields.get(name)
+			if offset != None:
+				return instance.slots[offset]
+			method = instance.klass.findMethod(name)
+			if method != None:
+				return ObjBoundMethod(instance, method)
+			return UNDEFINED
+
+		def tierPrint(value):
+			self.printValue(value)
+			print()
+
+		self.runNested = runNested
+		self.tierLoopHandler = opLoopTiered
+		# Names used by the code from TierCompiler
+		self.tierHelpers = {
+			"frames": frames,
+			"globalValues": globalValues,
+			"UNDEFINED": UNDEFINED,
+			"newFrame": newTierFrame,
+			"call": tierCall,
+			"invoke": tierInvoke,
+			"superInvoke": tierSuperInvoke,
+			"getField": tierGetField,
+			"printValue": tierPrint,
+		}
+
+	def runTiered(self, function, closure, first, pc):
+		"""Run the translated code of function from offset pc
+
+		The values from first in the stack are the slots of the call, they
+		are removed from the stack. Returns the value returned by the call.
+		"""
+		stack = self.stack
+		values = stack[first:]
+		del stack[first:]
+		tier = self.tierCompiler
+		if self.debugTiering == 0 or tier.nesting > 0:
+			return function.tiered(closure, pc, *values)
+		tier.nesting += 1
+		start = time.perf_counter()
+		try:
+			return function.tiered(closure, pc, *values)
+		finally:
+			tier.translatedTime += time.perf_counter() - start
+			tier.nesting -= 1
+
+	def runClosures(self):
+		"""Run the script in the frame from interpretFunction() with ClosureCompiler"""
+		closure = self.frames[-1].closure
+		self.resetStack()
+		try:
+			self.closureCompiler.run(closure)
+		except LoxRuntimeError as e:
+			# Rebuild the call frames for the stack trace.
+			for closure, ip in reversed(e.frames):
+				frame = CallFrame(closure, self.stack, 0)
+				frame.ip = ip
+				self.frames.append(frame)
+			self.runtimeError(e.message)
+			return InterpretResult.INTERPRET_RUNTIME_ERROR
+		return InterpretResult.INTERPRET_OK
+
+	def runRegister(self):
+		"""Run register code with the handlers from initRegister()"""
+		return self.registerLoop()
+
+	def compileRegisters(self, function):
+		"""Compile the bytecode of a function to register code for runRegister()
+
+		The instructions from RegisterCompiler are decoded to tuples of the
+		handler, the index of the next instruction, the offset in
+		chunk.code used for the line of a runtime error and the operands.
+		"""
+		registers = RegisterCompiler().compile(function, self.newInlineCache)
+		if Compiler.DEBUG_PRINT_CODE == 1:
+			if function.getName() != None:
+				name = function.getName().AS_STRING()
+			else:
+				name = "<script>"
+			registers.disassembleCode(name)
+		handlers = self.registerHandlers
+		decoded = []
+		pc = 0
+		for ins in registers.instructions:
+			handler = handlers[ins[0]]
+			if self.debugCountInstructions != 0:
+				handler = self.countingHandler(ins[0], handler)
+			pc += 1
+			decoded.append((handler, pc) + ins[1:])
+		registers.decoded = decoded
+		function.registerCode = registers
+		return registers
+
+	def initRegister(self):
+		"""Create the handler functions and loop used by runRegister()
+
+		Like initDispatch(), but for register instructions. Register r of
+		the running frame is stack[base + r], and the stack is extended to
+		hold all registers of a frame when it starts running. A call to a
+		closure starts the new frame at the register holding the function,
+		with the arguments in the registers after it, and the result is
+		returned in that register. The stack is only cut back to the last
+		argument for other callees, so callValue() works as for the stack
+		instructions.
+		"""
+		frames = self.frames
+		framePool = self.framePool
+		stack = self.stack
+		STACK_MAX = self.STACK_MAX
+		globalValues = self.globals.values
+		globalNames = self.globals.names
+		frame = None
+		code = None
+		upvalues = None
+		base = 0
+
+		def loadFrame():
+			nonlocal frame, code, upvalues, base
+			frame = frames[-1]
+			function = frame.closure.AS_CLOSURE()
+			registers = function.registerCode
+			if registers == None:
+				registers = self.compileRegisters(function)
+			code = registers.decoded
+			upvalues = frame.closure.upvalues
+			base = frame.firstSlotInStack
+			size = base + registers.frameSize
+			if len(stack) < size:
+				stack.extend([None] * (size - len(stack)))
+			return frame.pc
+
+		def runtimeError(ins, message):
+			frame.ip = ins[2]
+			self.runtimeError(message)
+			raise VMExit(InterpretResult.INTERPRET_RUNTIME_ERROR)
+
+		def fillMethodCache(ins, cache, key, klass, name):
+			method = klass.findMethod(name)
+			if method == None:
+				runtimeError(ins, "Undefined property '{0}'.".format(name.AS_STRING()))
+			cache[0] = key
+			cache[1] = -1
+			cache[2] = klass.version
+			cache[3] = method
+			return method
+
+		def checkNumbers(ins, a, b):
+			if type(a) is not float or type(b) is not float:
+				runtimeError(ins, "Operands must be numbers.")
+
+		def opMove(ins):
+			stack[base + ins[3]] = stack[base + ins[4]]
+			return ins[1]
+
+		def opLoadK(ins):
+			stack[base + ins[3]] = ins[4]
+			return ins[1]
+
+		def opGetGlobal(ins):
+			value = globalValues[ins[4]]
+			if value is UNDEFINED:
+				runtimeError(ins, "Undefined variable '{0}'".format(globalNames[ins[4]]))
+			stack[base + ins[3]] = value
+			return ins[1]
+
+		def opDefineGlobal(ins):
+			globalValues[ins[3]] = stack[base + ins[4]]
+			return ins[1]
+
+		def opSetGlobal(ins):
+			slot = ins[3]
+			if globalValues[slot] is UNDEFINED:
+				runtimeError(ins, "Undefined variable '{0}'".format(globalNames[slot]))
+			globalValues[slot] = stack[base + ins[4]]
+			return ins[1]
+
+		def opGetUpvalue(ins):
+			upvalue = upvalues[ins[4]]
+			stack[base + ins[3]] = upvalue.values[upvalue.location]
+			return ins[1]
+
+		def opSetUpvalue(ins):
+			upvalue = upvalues[ins[3]]
+			upvalue.values[upvalue.location] = stack[base + ins[4]]
+			return ins[1]
+
+		def opGetProperty(ins):
+			instance = stack[base + ins[4]]
+			if type(instance) is not ObjInstance:
+				runtimeError(ins, "Only instances have properties.")
+			cache = ins[6]
+			shape = instance.shape
+			if shape is cache[0]:
+				offset = cache[1]
+				if offset >= 0:
+					stack[base + ins[3]] = instance.slots[offset]
+					return ins[1]
+				if cache[2] == instance.klass.version:
+					stack[base + ins[3]] = ObjBoundMethod(instance, cache[3])
+					return ins[1]
+			offset = shape.fields.get(ins[5])
+			if offset != None:
+				cache[0] = shape
+				cache[1] = offset
+				stack[base + ins[3]] = instance.slots[offset]
+			else:
+				method = fillMethodCache(ins, cache, shape, instance.klass, ins[5])
+				stack[base + ins[3]] = ObjBoundMethod(instance, method)
+			return ins[1]
+
+		def opSetProperty(ins):
+			instance = stack[base + ins[3]]
+			if type(instance) is not ObjInstance:
+				runtimeError(ins, "Only instances have fields.")
+			value = stack[base + ins[5]]
+			cache = ins[6]
+			shape = instance.shape
+			if shape is not cache[0]:
+				offset = shape.fields.get(ins[4])
+				cache[0] = shape
+				if offset != None:
+					cache[1] = offset
+					cache[3] = None
+				else:
+					cache[1] = len(instance.slots)
+					cache[3] = shape.addField(ins[4])
+			if cache[3] == None:
+				instance.slots[cache[1]] = value
+			else:
+				instance.slots.append(value)
+				instance.shape = cache[3]
+			return ins[1]
+
+		def opGetSuper(ins):
+			superclass = stack[base + ins[5]]
+			cache = ins[7]
+			if cache[0] is superclass and cache[2] == superclass.version:
+				method = cache[3]
+			else:
+				method = fillMethodCache(ins, cache, superclass, superclass, ins[6])
+			stack[base + ins[3]] = ObjBoundMethod(stack[base + ins[4]], method)
+			return ins[1]
+
+		def opEqual(ins):
+			a = stack[base + ins[4]]
+			b = stack[base + ins[5]]
+			stack[base + ins[3]] = type(a) is type(b) and a == b
+			return ins[1]
+
+		def opNotEqual(ins):
+			a = stack[base + ins[4]]
+			b = stack[base + ins[5]]
+			stack[base + ins[3]] = type(a) is not type(b) or a != b
+			return ins[1]
+
+		def opGreater(ins):
+			a = stack[base + ins[4]]
+			b = stack[base + ins[5]]
+			checkNumbers(ins, a, b)
+			stack[base + ins[3]] = a > b
+			return ins[1]
+
+		def opGreaterEqual(ins):
+			a = stack[base + ins[4]]
+			b = stack[base + ins[5]]
+			checkNumbers(ins, a, b)
+			stack[base + ins[3]] = not (a < b)
+			return ins[1]
+
+		def opLess(ins):
+			a = stack[base + ins[4]]
+			b = stack[base + ins[5]]
+			checkNumbers(ins, a, b)
+			stack[base + ins[3]] = a < b
+			return ins[1]
+
+		def opLessEqual(ins):
+			a = stack[base + ins[4]]
+			b = stack[base + ins[5]]
+			checkNumbers(ins, a, b)
+			stack[base + ins[3]] = not (a > b)
+			return ins[1]
+
+		def add(ins, a, b):
+			if type(a) is float and type(b) is float:
+				stack[base + ins[3]] = a + b
+			elif type(a) is ObjString and type(b) is ObjString:
+				stack[base + ins[3]] = copyString(a.AS_STRING() + b.AS_STRING())
+			else:
+				runtimeError(ins, "Operands must be numbers.")
+			return ins[1]
+
+		def opAdd(ins):
+			return add(ins, stack[base + ins[4]], stack[base + ins[5]])
+
+		def opAddK(ins):
+			a = stack[base + ins[4]]
+			b = ins[5]
+			if type(a) is float and type(b) is float:
+				stack[base + ins[3]] = a + b
+				return ins[1]
+			return add(ins, a, b)
+
+		def opSubtract(ins):
+			a = stack[base + ins[4]]
+			b = stack[base + ins[5]]
+			checkNumbers(ins, a, b)
+			stack[base + ins[3]] = a - b
+			return ins[1]
+
+		def opSubtractK(ins):
+			a = stack[base + ins[4]]
+			b = ins[5]
+			checkNumbers(ins, a, b)
+			stack[base + ins[3]] = a - b
+			return ins[1]
+
+		def opMultiply(ins):
+			a = stack[base + ins[4]]
+			b = stack[base + ins[5]]
+			checkNumbers(ins, a, b)
+			stack[base + ins[3]] = a * b
+			return ins[1]
+
+		def opMultiplyK(ins):
+			a = stack[base + ins[4]]
+			b = ins[5]
+			checkNumbers(ins, a, b)
+			stack[base + ins[3]] = a * b
+			return ins[1]
+
+		def opDivide(ins):
+			a = stack[base + ins[4]]
+			b = stack[base + ins[5]]
+			checkNumbers(ins, a, b)
+			stack[base + ins[3]] = a / b
+			return ins[1]
+
+		def opDivideK(ins):
+			a = stack[base + ins[4]]
+			b = ins[5]
+			checkNumbers(ins, a, b)
+			stack[base + ins[3]] = a / b
+			return ins[1]
+
+		def opNot(ins):
+			value = stack[base + ins[4]]
+			stack[base + ins[3]] = value is None or value is False
+			return ins[1]
+
+		def opNegate(ins):
+			value = stack[base + ins[4]]
+			if type(value) is not float:
+				runtimeError(ins, "Operand must be a number.")
+			stack[base + ins[3]] = -value
+			return ins[1]
+
+		def opPrint(ins):
+			self.printValue(stack[base + ins[3]])
+			print()
+			return ins[1]
+
+		def opJump(ins):
+			return ins[3]
+
+		def opJumpIfFalse(ins):
+			value = stack[base + ins[3]]
+			if value is None or value is False:
+				return ins[4]
+			return ins[1]
+
+		def opJumpIfNotEqual(ins):
+			a = stack[base + ins[3]]
+			b = stack[base + ins[4]]
+			if type(a) is type(b) and a == b:
+				return ins[1]
+			return ins[5]
+
+		def opJumpIfNotEqualK(ins):
+			a = stack[base + ins[3]]
+			b = ins[4]
+			if type(a) is type(b) and a == b:
+				return ins[1]
+			return ins[5]
+
+		def opJumpIfEqual(ins):
+			a = stack[base + ins[3]]
+			b = stack[base + ins[4]]
+			if type(a) is type(b) and a == b:
+				return ins[5]
+			return ins[1]
+
+		def opJumpIfEqualK(ins):
+			a = stack[base + ins[3]]
+			b = ins[4]
+			if type(a) is type(b) and a == b:
+				return ins[5]
+			return ins[1]
+
+		def opJumpIfNotGreater(ins):
+			a = stack[base + ins[3]]
+			b = stack[base + ins[4]]
+			checkNumbers(ins, a, b)
+			if a > b:
+				return ins[1]
+			return ins[5]
+
+		def opJumpIfNotGreaterK(ins):
+			a = stack[base + ins[3]]
+			b = ins[4]
+			checkNumbers(ins, a, b)
+			if a > b:
+				return ins[1]
+			return ins[5]
+
+		def opJumpIfNotGreaterEqual(ins):
+			a = stack[base + ins[3]]
+			b = stack[base + ins[4]]
+			checkNumbers(ins, a, b)
+			if a < b:
+				return ins[5]
+			return ins[1]
+
+		def opJumpIfNotGreaterEqualK(ins):
+			a = stack[base + ins[3]]
+			b = ins[4]
+			checkNumbers(ins, a, b)
+			if a < b:
+				return ins[5]
+			return ins[1]
+
+		def opJumpIfNotLess(ins):
+			a = stack[base + ins[3]]
+			b = stack[base + ins[4]]
+			checkNumbers(ins, a, b)
+			if a < b:
+				return ins[1]
+			return ins[5]
+
+		def opJumpIfNotLessK(ins):
+			a = stack[base + ins[3]]
+			b = ins[4]
+			checkNumbers(ins, a, b)
+			if a < b:
+				return ins[1]
+			return ins[5]
+
+		def opJumpIfNotLessEqual(ins):
+			a = stack[base + ins[3]]
+			b = stack[base + ins[4]]
+			checkNumbers(ins, a, b)
+			if a > b:
+				return ins[5]
+			return ins[1]
+
+		def opJumpIfNotLessEqualK(ins):
+			a = stack[base + ins[3]]
+			b = ins[4]
+			checkNumbers(ins, a, b)
+			if a > b:
+				return ins[5]
+			return ins[1]
+
+		def callClosure(closure, first, argCount):
+			# Registers of the called function start at its slot zero, so
+			# the arguments are already in place.
+			function = closure.AS_CLOSURE()
+			if (argCount != function.arity or len(frames) == 64 or
+				first + function.maxStack > STACK_MAX):
+				del stack[first + argCount + 1:]
+				self.call(closure, argCount)
+				raise VMExit(InterpretResult.INTERPRET_RUNTIME_ERROR)
+			if len(framePool) > 0:
+				calleeFrame = framePool.pop()
+				calleeFrame.closure = closure
+				calleeFrame.ip = 0
+				calleeFrame.pc = 0
+				calleeFrame.firstSlotInStack = first
+			else:
+				calleeFrame = CallFrame(closure, stack, first)
+			frames.append(calleeFrame)
+			return loadFrame()
+
+		def callValue(callee, first, argCount):
+			# Other callees are handled by callValue(), which expects the
+			# arguments on top of the stack.
+			del stack[first + argCount + 1:]
+			if not self.callValue(callee, argCount):
+				raise VMExit(InterpretResult.INTERPRET_RUNTIME_ERROR)
+			return loadFrame()
+
+		def opCall(ins):
+			first = base + ins[3]
+			callee = stack[first]
+			if type(callee) is ObjClosure:
+				frame.ip = ins[2]
+				frame.pc = ins[1]
+				return callClosure(callee, first, ins[4])
+			if type(callee) is ObjClass and callee.initializer == None and ins[4] == 0:
+				# Nothing runs, so the instance replaces the class without
+				# a new frame.
+				stack[first] = ObjInstance(callee)
+				return ins[1]
+			frame.ip = ins[2]
+			frame.pc = ins[1]
+			return callValue(callee, first, ins[4])
+
+		def opTailCall(ins):
+			first = base + ins[3]
+			argCount = ins[4]
+			callee = stack[first]
+			frame.ip = ins[2]
+			frame.pc = ins[1]
+			if type(callee) is ObjBoundMethod:
+				stack[first] = callee.receiver
+				callee = callee.method
+			if type(callee) is not ObjClosure:
+				return callValue(callee, first, argCount)
+			function = callee.AS_CLOSURE()
+			if argCount != function.arity or base + function.maxStack > STACK_MAX:
+				return callClosure(callee, first, argCount)
+			# The function and arguments replace the registers of the frame.
+			self.closeUpvalues(stack, base)
+			stack[base:] = stack[first:first + argCount + 1]
+			frame.closure = callee
+			frame.pc = 0
+			return loadFrame()
+
+		def opCallGlobal(ins):
+			argCount = ins[5]
+			callee = globalValues[ins[4]]
+			if callee is UNDEFINED:
+				runtimeError(ins, "Undefined variable '{0}'".format(globalNames[ins[4]]))
+			first = base + ins[3]
+			if type(callee) is ObjClass and callee.initializer == None and argCount == 0:
+				stack[first] = ObjInstance(callee)
+				return ins[1]
+			del stack[first + argCount:]
+			# The function goes below the arguments.
+			stack.insert(first, callee)
+			frame.ip = ins[2]
+			frame.pc = ins[1]
+			if type(callee) is ObjClosure:
+				return callClosure(callee, first, argCount)
+			return callValue(callee, first, argCount)
+
+		def opInvoke(ins):
+			argCount = ins[5]
+			first = base + ins[3]
+			receiver = stack[first]
+			frame.ip = ins[2]
+			frame.pc = ins[1]
+			if type(receiver) is not ObjInstance:
+				runtimeError(ins, "Only instances have methods.")
+			cache = ins[6]
+			shape = receiver.shape
+			if shape is not cache[0]:
+				offset = shape.fields.get(ins[4])
+				if offset != None:
+					# A field holding a function is called like a function.
+					value = receiver.slots[offset]
+					stack[first] = value
+					if type(value) is ObjClosure:
+						return callClosure(value, first, argCount)
+					return callValue(value, first, argCount)
+				index = receiver.klass.methodIndex(ins[4])
+				if index < 0:
+					runtimeError(ins, "Undefined property '{0}'.".format(ins[4].AS_STRING()))
+				cache[0] = shape
+				cache[3] = index
+			return callClosure(receiver.klass.vtable[cache[3]], first, argCount)
+
+		def opSuperInvoke(ins):
+			superclass = stack[base + ins[4]]
+			frame.ip = ins[2]
+			frame.pc = ins[1]
+			cache = ins[7]
+			if superclass is not cache[0]:
+				index = superclass.methodIndex(ins[5])
+				if index < 0:
+					runtimeError(ins, "Undefined property '{0}'.".format(ins[5].AS_STRING()))
+				cache[0] = superclass
+				cache[3] = index
+			return callClosure(superclass.vtable[cache[3]], base + ins[3], ins[6])
+
+		def opClosure(ins):
+			closure = ObjClosure(ins[4])
+			stack[base + ins[3]] = closure
+			i = 0
+			for isLocal, index in ins[5]:
+				if isLocal:
+					closure.upvalues[i] = self.captureUpvalue(stack, base + index)
+				else:
+					closure.upvalues[i] = upvalues[index]
+				i += 1
+			return ins[1]
+
+		def opCloseUpvalue(ins):
+			self.closeUpvalues(stack, base + ins[3])
+			return ins[1]
+
+		def returnValue(result):
+			if self.openUpvalues != None:
+				self.closeUpvalues(stack, base)
+			framePool.append(frames.pop())
+			if len(frames) == 0:
+				del stack[:]
+				raise VMExit(InterpretResult.INTERPRET_OK)
+			# The result goes in the register the function was called from.
+			stack[base] = result
+			return loadFrame()
+
+		def opReturn(ins):
+			return returnValue(stack[base + ins[3]])
+
+		def opReturnK(ins):
+			return returnValue(ins[3])
+
+		def opClass(ins):
+			stack[base + ins[3]] = ObjClass(ins[4])
+			return ins[1]
+
+		def opInherit(ins):
+			superclass = stack[base + ins[3]]
+			if type(superclass) is not ObjClass:
+				runtimeError(ins, "Superclass must be a class.")
+			subclass = stack[base + ins[4]]
+			subclass.inherit(superclass)
+			return ins[1]
+
+		def opMethod(ins):
+			stack[base + ins[3]].defineMethod(ins[5], stack[base + ins[4]])
+			return ins[1]
+
+		def registerLoop():
+			pc = loadFrame()
+			try:
+				if self.debugTraceExecution != 0:
+					while True:
+						frame.pc = pc
+						self.traceExecution()
+						ins = code[pc]
+						pc = ins[0](ins)
+				else:
+					while True:
+						ins = code[pc]
+						pc = ins[0](ins)
+			except VMExit as e:
+				return e.result
+
+		self.registerHandlers = {
+			RegOp.MOVE: opMove,
+			RegOp.LOADK: opLoadK,
+			RegOp.GET_GLOBAL: opGetGlobal,
+			RegOp.DEFINE_GLOBAL: opDefineGlobal,
+			RegOp.SET_GLOBAL: opSetGlobal,
+			RegOp.GET_UPVALUE: opGetUpvalue,
+			RegOp.SET_UPVALUE: opSetUpvalue,
+			RegOp.GET_PROPERTY: opGetProperty,
+			RegOp.SET_PROPERTY: opSetProperty,
+			RegOp.GET_SUPER: opGetSuper,
+			RegOp.EQUAL: opEqual,
+			RegOp.NOT_EQUAL: opNotEqual,
+			RegOp.GREATER: opGreater,
+			RegOp.GREATER_EQUAL: opGreaterEqual,
+			RegOp.LESS: opLess,
+			RegOp.LESS_EQUAL: opLessEqual,
+			RegOp.ADD: opAdd,
+			RegOp.ADD_K: opAddK,
+			RegOp.SUBTRACT: opSubtract,
+			RegOp.SUBTRACT_K: opSubtractK,
+			RegOp.MULTIPLY: opMultiply,
+			RegOp.MULTIPLY_K: opMultiplyK,
+			RegOp.DIVIDE: opDivide,
+			RegOp.DIVIDE_K: opDivideK,
+			RegOp.NOT: opNot,
+			RegOp.NEGATE: opNegate,
+			RegOp.PRINT: opPrint,
+			RegOp.JUMP: opJump,
+			RegOp.JUMP_IF_FALSE: opJumpIfFalse,
+			RegOp.JUMP_IF_NOT_EQUAL: opJumpIfNotEqual,
+			RegOp.JUMP_IF_NOT_EQUAL_K: opJumpIfNotEqualK,
+			RegOp.JUMP_IF_EQUAL: opJumpIfEqual,
+			RegOp.JUMP_IF_EQUAL_K: opJumpIfEqualK,
+			RegOp.JUMP_IF_NOT_GREATER: opJumpIfNotGreater,
+			RegOp.JUMP_IF_NOT_GREATER_K: opJumpIfNotGreaterK,
+			RegOp.JUMP_IF_NOT_GREATER_EQUAL: opJumpIfNotGreaterEqual,
+			RegOp.JUMP_IF_NOT_GREATER_EQUAL_K: opJumpIfNotGreaterEqualK,
+			RegOp.JUMP_IF_NOT_LESS: opJumpIfNotLess,
+			RegOp.JUMP_IF_NOT_LESS_K: opJumpIfNotLessK,
+			RegOp.JUMP_IF_NOT_LESS_EQUAL: opJumpIfNotLessEqual,
+			RegOp.JUMP_IF_NOT_LESS_EQUAL_K: opJumpIfNotLessEqualK,
+			RegOp.CALL: opCall,
+			RegOp.TAIL_CALL: opTailCall,
+			RegOp.CALL_GLOBAL: opCallGlobal,
+			RegOp.INVOKE: opInvoke,
+			RegOp.SUPER_INVOKE: opSuperInvoke,
+			RegOp.CLOSURE: opClosure,
+			RegOp.CLOSE_UPVALUE: opCloseUpvalue,
+			RegOp.RETURN: opReturn,
+			RegOp.RETURN_K: opReturnK,
+			RegOp.CLASS: opClass,
+			RegOp.INHERIT: opInherit,
+			RegOp.METHOD: opMethod,
+		}
+		self.registerLoop = registerLoop
+
 	def readByte(self):
 		frame = self.frames[-1]
 		b = frame.closure.AS_CLOSURE().chunk.code[frame.ip]
@@ -399,10 +2036,17 @@ class VM:
 	def readConstant(self):
 		n = self.readByte()
 		frame = self.frames[-1]
-		return frame.closure.AS_CLOSURE().chunk.constants[n]
+		return frame.closure.AS_CLOSURE().chunk.constants.rawValues()[n]
+
+	def readConstantLong(self):
+		n = self.readShort()
+		frame = self.frames[-1]
+		return frame.closure.AS_CLOSURE().chunk.constants.rawValues()[n]
 
-	def readString(self):
-		return self.readConstant().AS_OBJ()
+	def readString(self, long=False):
+		if long:
+			return self.readConstantLong()
+		return self.readConstant()
 
 	def push(self, value):
 		self.stack.append(value)
@@ -412,47 +2056,89 @@ class VM:
 
 	def peek(self, distance):
 		"""Peek value that is distance elements from top of stack without modifying stack"""
-		return self.stack[len(self.stack) - 1 - distance]
+		return self.stack[-1 - distance]
 
 	def call(self, closure, argCount):
-		if argCount != closure.AS_CLOSURE().arity:
-			self.runtimeError("Expected {0} arguments but got {1}.".format(closure.AS_CLOSURE().arity, argCount))
+		function = closure.AS_CLOSURE()
+		if argCount != function.arity:
+			self.runtimeError("Expected {0} arguments but got {1}.".format(function.arity, argCount))
 			return False
-		if len(self.frames) == 64:
+		# Set index of first slot in stack for this call.
+		first = len(self.stack) - (argCount + 1)
+		if len(self.frames) == 64 or first + function.maxStack > self.STACK_MAX:
 			self.runtimeError("Stack overflow.")
 			return False
-		frame = CallFrame()
-		frame.closure = closure
-		frame.ip = 0
-		frame.stack = self.stack
-		# Set index of first slot in stack for this call.
-		frame.firstSlotInStack = len(self.stack) - (argCount + 1)
+		if self.tierThreshold > 0:
+			if function.tiered == None:
+				function.callCount += 1
+				if function.callCount >= self.tierThreshold:
+					self.tierCompiler.promote(function, "calls", function.callCount)
+			if function.tiered:
+				self.stack.append(self.runTiered(function, closure, first, 0))
+				return True
+		if len(self.framePool) > 0:
+			frame = self.framePool.pop()
+			frame.closure = closure
+			frame.ip = 0
+			frame.pc = 0
+			frame.firstSlotInStack = first
+		else:
+			frame = CallFrame(closure, self.stack, first)
 		self.frames.append(frame)
 		return True
 
+	def tailCall(self, callee, argCount):
+		"""Call callee for OP_TAIL_CALL, in the frame of the running function
+
+		A closure or bound method replaces the closure of the frame, with
+		the callee and arguments moved down to the first slots of the frame,
+		so a chain of tail calls does not use up frames. Translated code
+		is not run from here, as it would need a Python call. Other callees
+		are called as by callValue() and the OP_RETURN after OP_TAIL_CALL
+		returns their result.
+		"""
+		if type(callee) is ObjBoundMethod:
+			self.stack[-argCount - 1] = callee.receiver
+			callee = callee.method
+		if type(callee) is not ObjClosure:
+			return self.callValue(callee, argCount)
+		function = callee.AS_CLOSURE()
+		if argCount != function.arity:
+			self.runtimeError("Expected {0} arguments but got {1}.".format(function.arity, argCount))
+			return False
+		frame = self.frames[-1]
+		first = frame.firstSlotInStack
+		if first + function.maxStack > self.STACK_MAX:
+			self.runtimeError("Stack overflow.")
+			return False
+		self.closeUpvalues(self.stack, first)
+		self.stack[first:] = self.stack[len(self.stack) - argCount - 1:]
+		frame.closure = callee
+		frame.ip = 0
+		return True
+
 	def callValue(self, callee, argCount):
-		if callee.IS_OBJ():
-			if callee.AS_OBJ().OBJ_TYPE() == ObjType.OBJ_BOUND_METHOD:
-				bound = callee.AS_OBJ()
-				frame = self.frames[-1]
-				frame.setSlot(1, Value.OBJ_VAL(bound.receiver))
+		if isinstance(callee, Obj):
+			if callee.OBJ_TYPE() == ObjType.OBJ_BOUND_METHOD:
+				bound = callee
+				# The receiver replaces the callee in slot zero of the new frame.
+				self.stack[-argCount - 1] = bound.receiver
 				return self.call(bound.method, argCount)
-			elif callee.AS_OBJ().OBJ_TYPE() == ObjType.OBJ_CLASS:
-				klass = callee.AS_OBJ()
-				frame = self.frames[-1]
-				frame.setSlot(1, Value.OBJ_VAL(ObjInstance(klass)))
-				initializer = klass.methods.get(ObjString(self.initString))
+			elif callee.OBJ_TYPE() == ObjType.OBJ_CLASS:
+				klass = callee
+				self.stack[-argCount - 1] = ObjInstance(klass)
+				initializer = klass.initializer
 				if initializer != None:
 					return self.call(initializer, argCount)
 				elif argCount != 0:
 					self.runtimeError("Expected 0 arguments but got {0}.".format(argCount))
 					return False
 				return True
-			elif callee.AS_OBJ().OBJ_TYPE() == ObjType.OBJ_CLOSURE:
-				return self.call(callee.AS_OBJ(), argCount)
-			elif callee.AS_OBJ().OBJ_TYPE() == ObjType.OBJ_NATIVE:
-				native = callee.AS_OBJ().AS_NATIVE()
-				result = native(argCount, self.stack[-argCount:])
+			elif callee.OBJ_TYPE() == ObjType.OBJ_CLOSURE:
+				return self.call(callee, argCount)
+			elif callee.OBJ_TYPE() == ObjType.OBJ_NATIVE:
+				native = callee.AS_NATIVE()
+				result = native(argCount, self.stack[len(self.stack) - argCount:])
 				i = argCount + 1
 				while i > 0:
 					self.stack.pop()
@@ -463,7 +2149,7 @@ class VM:
 		return False
 
 	def invokeFromClass(self, klass, name, argCount):
-		method = klass.methods.get(name)
+		method = klass.findMethod(name)
 		if method == None:
 			self.runtimeError("Undefined property '{0}'.".format(name.AS_STRING()))
 			return False
@@ -471,50 +2157,112 @@ class VM:
 
 	def invoke(self, name, argCount):
 		receiver = self.peek(argCount)
-		if not receiver.AS_OBJ().IS_INSTANCE():
+		if type(receiver) is not ObjInstance:
 			self.runtimeError("Only instances have methods.")
 			return False
 
-		instance = receiver.AS_OBJ()
-		value = instance.fields.get(name)
-		if value != None:
-			frame.setSlot(1, value)
+		instance = receiver
+		value = instance.getField(name)
+		if value is not UNDEFINED:
+			self.stack[-argCount - 1] = value
 			return self.callValue(value, argCount)
 
 		return self.invokeFromClass(instance.klass, name, argCount)
 
 	def bindMethod(self, klass, name):
-		method = klass.methods.get(name)
+		method = klass.findMethod(name)
 		if method == None:
 			self.runtimeError("Undefined property '{0}'.".format(name.AS_STRING()))
 			return False
-		bound = ObjBoundMethod(self.peek(0).AS_OBJ(), method)
+		bound = ObjBoundMethod(self.peek(0), method)
 		self.pop()
-		self.push(Value.OBJ_VAL(bound))
+		self.push(bound)
 		return True
 
-	def captureUpvalue(self, local):
-		return ObjUpvalue(local)
-
-	def closeUpvalues(self, last):
-		#TODO understand and implement 25.4.3 and 25.4.4 logic
-		pass
+	def captureUpvalue(self, values, local):
+		"""Return the open upvalue for values[local], creating it if needed
+
+		Open upvalues are linked from self.openUpvalues by ObjUpvalue.next,
+		from the highest stack slot down, so closures capturing the same
+		variable share one upvalue. values is self.stack, or the slots of
+		the running call for ClosureCompiler, whose open upvalues are the
+		first in the list.
+		"""
+		prevUpvalue = None
+		upvalue = self.openUpvalues
+		while upvalue != None and upvalue.values is values and upvalue.location > local:
+			prevUpvalue = upvalue
+			upvalue = upvalue.next
+		if upvalue != None and upvalue.values is values and upvalue.location == local:
+			return upvalue
+		createdUpvalue = ObjUpvalue(values, local)
+		createdUpvalue.next = upvalue
+		if prevUpvalue == None:
+			self.openUpvalues = createdUpvalue
+		else:
+			prevUpvalue.next = createdUpvalue
+		return createdUpvalue
+
+	def closeUpvalues(self, values, last):
+		"""Close the open upvalues for slot last and above of values"""
+		upvalue = self.openUpvalues
+		while upvalue != None and upvalue.values is values and upvalue.location >= last:
+			upvalue.values = [values[upvalue.location]]
+			upvalue.location = 0
+			upvalue = upvalue.next
+		self.openUpvalues = upvalue
 
 	def defineMethod(self, name):
-		method = self.peek(0).AS_OBJ()
-		klass = self.peek(1).AS_OBJ()
-		klass.methods.set(name, method)
+		method = self.peek(0)
+		klass = self.peek(1)
+		klass.defineMethod(name, method)
 		self.pop()
 
+	def add(self):
+		"""Replace top two values on stack with their sum or concatenation"""
+		if self.checkStringBinaryOperands():
+			self.concatenate()
+		elif self.checkNumberBinaryOperands():
+			b = self.pop()
+			a = self.pop()
+			self.push(a + b)
+		else:
+			self.runtimeError("Operands must be numbers.")
+			return False
+		return True
+
+	def subtract(self):
+		"""Replace top two values on stack with their difference"""
+		if not self.checkNumberBinaryOperands():
+			self.runtimeError("Operands must be numbers.")
+			return False
+		b = self.pop()
+		a = self.pop()
+		self.push(a - b)
+		return True
+
 	def isFalsey(self, value):
-		if value.IS_NIL():
-			return True
-		if value.IS_BOOL():
-			return value.AS_BOOL() == False
-		return False
+		return value is None or value is False
+
+	def valuesEqual(self, a, b):
+		if type(a) is not type(b):
+			return False
+		return a == b
+
+	def printValue(self, value):
+		if value is None:
+			print('nil', end='')
+		elif value is True:
+			print('true', end='')
+		elif value is False:
+			print('false', end='')
+		elif type(value) is float:
+			print('{0:g}'.format(value), end='')
+		else:
+			value.printObject()
 
 	def concatenate(self):
-		b = self.pop().AS_OBJ().AS_STRING()
-		a = self.pop().AS_OBJ().AS_STRING()
-		s = ObjString(a + b)
-		self.push(Value.OBJ_VAL(s))
+		b = self.pop().AS_STRING()
+		a = self.pop().AS_STRING()
+		s = copyString(a + b)
+		self.push(s)